@@ -0,0 +1,460 @@
+"""
+asyncbatch.py: batch-collecting using asyncio
+
+The functions in this module collect pages the same way ``pack.collect()``
+does, but all network I/O for all pages is performed from a single event loop,
+and CPU-heavy processing (preprocessing, extraction, packaging) is handed off
+to a process pool. This allows a large number of fetches to be in flight
+without keeping an idle process around for each one.
+
+When aiohttp is installed, pages and images are fetched natively within the
+event loop. Otherwise, the blocking fetch functions from ``artexin.fetch`` are
+run in a thread pool. Pages that need JavaScript are always rendered in the
+thread pool.
+
+This module requires Python 3.7 or newer.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import asyncio
+import copy
+import datetime
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import urllib.parse as urlparse
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import __version__ as _version, __author__ as _author
+from .batch import JOB_TIMEOUT, error_meta, get_host
+from .extract import find_images, update_images
+from .fetch import (fetch_content, fetch_image, fetch_rendered, store_image,
+                    check_image, MAX_IMAGE_SIZE, SNIFF_SIZE, CHUNK_SIZE)
+from .imagestore import get_store
+from .manifest import fingerprint, get_manifest
+from .htmlutils import get_soup
+from .pack import (BASE_DIR, percent_escape, prepare_page, package_page,
+                   package_options)
+from .preprocessor_mappings import get_preps, get_ready
+from .scheduler import DomainScheduler, MAX_PER_HOST, MIN_INTERVAL
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('Collector', 'abatch')
+
+
+MAX_FETCHES = 100  # Maximum number of concurrent fetches
+MAX_RENDERED = 4  # Maximum number of concurrently rendered pages
+MAX_PAGES = 50  # Maximum number of pages collected concurrently in a batch
+MAX_TIMEOUT = 12  # Same as in ``fetch.fetch_content()``
+
+
+def prepare(url, page, prep, do_extract):
+    """ Prepare the page and find its images
+
+    This function is executed in the process pool.
+
+    :param url:         URL of the page
+    :param page:        String containing the HTML document
+    :param prep:        Iterable containing HTML preprocessors
+    :param do_extract:  Whether to perform article extraction
+    :returns:           Three-tuple containing title, processed HTML and list
+                        of image URLs
+    """
+    title, soup = prepare_page(page, prep, do_extract)
+    # Serialized before ``find_images()`` removes images without ``src``, so
+    # that the fingerprint is the same as in ``pack.collect()``
+    html = str(soup)
+    urls = find_images(soup, url)[0]
+    return title, html, urls
+
+
+def package(url, html, results, meta, temp_dir, **kwargs):
+    """ Update images in the prepared page and package it
+
+    This function is executed in the process pool.
+
+    :param url:         URL of the page
+    :param html:        HTML returned by ``prepare()``
+    :param results:     List of image paths (or ``None`` for failed images) in
+                        the order in which ``prepare()`` returned the URLs
+    :param meta:        Page metadata
+    :param temp_dir:    Directory containing the downloaded images
+    :param **kwargs:    Keyword arguments for ``pack.package_page()``
+    :returns:           Metadata returned by ``pack.package_page()``
+    """
+    soup = get_soup(html)
+    tags, dupes = find_images(soup, url)[1:]
+    images = update_images(tags, dupes, results)
+    meta['images'] = len(images)
+    return package_page(soup, meta, temp_dir, images=images, **kwargs)
+
+
+class Collector(object):
+    """ Collect pages concurrently within an event loop
+
+    The collector must be used as an asynchronous context manager, within
+    which any number of ``collect()`` coroutines may run concurrently::
+
+        async with Collector(base_dir='/srv/zipballs') as collector:
+            metas = await asyncio.gather(*[collector.collect(u, get_preps(u))
+                                           for u in urls])
+
+    :param keyring:         Keyring directory
+    :param key:             Key to use for signing
+    :param passphrase:      Key passphrase
+    :param base_dir:        Base directory in which to operate
+    :param keep_dir:        Keep the directory in which content was collected
+    :param javascript:      Whether to execute JavaScript on the page
+    :param do_extract:      Whether to perform article extraction
+    :param max_fetches:     Maximum number of concurrent fetches
+    :param max_rendered:    Maximum number of concurrently rendered pages
+    :param executor:        Executor for CPU-heavy processing (defaults to a
+                            process pool with ``max_procs`` processes)
+    :param max_procs:       Number of processes in the default executor
+    """
+
+    def __init__(self, keyring=None, key=None, passphrase=None,
+                 base_dir=BASE_DIR, keep_dir=False, javascript=True,
+                 do_extract=True, max_fetches=MAX_FETCHES,
+                 max_rendered=MAX_RENDERED, executor=None, max_procs=None):
+        self.package_args = {'base_dir': base_dir,
+                             'keep_dir': keep_dir,
+                             'keyring': keyring,
+                             'key': key,
+                             'passphrase': passphrase}
+        self.javascript = javascript
+        self.do_extract = do_extract
+        self.max_fetches = max_fetches
+        self.max_rendered = max_rendered
+        self.executor = executor
+        self.max_procs = max_procs
+        self.own_executor = executor is None
+        self.threads = None
+        self.session = None
+        self.fetch_slots = None
+        self.render_slots = None
+
+    async def __aenter__(self):
+        self.fetch_slots = asyncio.Semaphore(self.max_fetches)
+        self.render_slots = asyncio.Semaphore(self.max_rendered)
+        self.threads = ThreadPoolExecutor(max_workers=self.max_fetches)
+        if self.own_executor:
+            self.executor = ProcessPoolExecutor(self.max_procs)
+        if aiohttp is not None:
+            connector = aiohttp.TCPConnector(limit=self.max_fetches)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.threads.shutdown()
+        if self.own_executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run_in_threads(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.threads, fn, *args)
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor,
+                                    functools.partial(fn, *args, **kwargs))
+
+    async def read_image(self, resp, url):
+        """ Read image from the response, giving up early on non-images
+
+        This is an asynchronous counterpart of ``fetch.read_image()``.
+
+        :param resp:    ``aiohttp.ClientResponse`` object
+        :param url:     Image URL
+        :returns:       Image content as bytestring
+        """
+        if (resp.content_length or 0) > MAX_IMAGE_SIZE:
+            raise OSError('Image at %s is too large' % url)
+        head = b''
+        while len(head) < SNIFF_SIZE:
+            chunk = await resp.content.read(SNIFF_SIZE - len(head))
+            if not chunk:
+                break
+            head += chunk
+        check_image(head, url)
+        chunks = [head]
+        size = len(head)
+        while True:
+            chunk = await resp.content.read(CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > MAX_IMAGE_SIZE:
+                raise OSError('Image at %s is too large' % url)
+
+    async def fetch(self, url, image=False):
+        """ Fetch content from specified URL
+
+        Retries with increasing timeouts the same way
+        ``fetch.fetch_content()`` does.
+
+        :param url:     Document's URL
+        :param image:   Whether to read the content using ``read_image()``
+        :returns:       Document contents as bytestring
+        """
+        async with self.fetch_slots:
+            if self.session is None:
+                return await self.run_in_threads(fetch_content, url)
+            timeout = 2
+            while timeout < MAX_TIMEOUT:
+                try:
+                    client_timeout = aiohttp.ClientTimeout(total=timeout)
+                    async with self.session.get(
+                            url, timeout=client_timeout) as resp:
+                        resp.raise_for_status()
+                        if image:
+                            return await self.read_image(resp, url)
+                        return await resp.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    timeout += 2
+            raise RuntimeError("Maximum timeout exceeding fetching URL: %s" %
+                               url)
+
+    async def fetch_page(self, url, ready=None):
+        """ Fetch the page, rendering it if JavaScript is enabled
+
+        :param url:     Document's URL
+        :param ready:   Readiness condition for ``fetch.fetch_rendered()``
+        :returns:       Document contents
+        """
+        if not self.javascript:
+            return await self.fetch(url)
+        async with self.render_slots:
+            return await self.run_in_threads(fetch_rendered,
+                                             percent_escape(url), ready)
+
+    async def fetch_image(self, idx, url, imgdir):
+        """ Download and store single image
+
+        This is an asynchronous counterpart of ``extract.process_image()``.
+
+        :param idx:     Index of the image
+        :param url:     Image URL
+        :param imgdir:  Directory in which to store the image
+        :returns:       Either image path if image was successfully downloaded
+                        and stored, or ``None`` otherwise
+        """
+        path = os.path.join(imgdir, 'image%04d' % idx)
+        try:
+            store = get_store()
+            entry = None
+            if store is not None:
+                entry = await self.run_in_threads(store.lookup, url)
+            if entry is not None:
+                result = await self.run_in_threads(store.export, entry, path)
+            elif self.session is None:
+                async with self.fetch_slots:
+                    result = await self.run_in_threads(fetch_image, url, path)
+            else:
+                content = await self.fetch(url, image=True)
+                result = await self.run_in_threads(store_image, url, content,
+                                                   path)
+            return result[1]
+        except Exception:
+            # FIXME: ``Exception`` might be a bit too broad
+            return None
+
+    async def collect(self, url, prep=[], meta={}, ready=None):
+        """ Collect the page at ``url``
+
+        This coroutine works like ``pack.collect()`` and returns the same
+        metadata. Failures are reported using the ``error`` key.
+
+        :param url:     URL of the page
+        :param prep:    Iterable containing HTML preprocessors from
+                        ``artexin.preprocessors``
+        :param meta:    Document extra metadata
+        :param ready:   Readiness condition for ``fetch.fetch_rendered()``
+        :returns:       Page metadata
+        """
+        meta = copy.copy(meta)
+        meta.update({'url': url,
+                     'domain': urlparse.urlparse(url).netloc})
+        temp_dir = None
+        try:
+            page = await self.fetch_page(url, ready)
+            meta['timestamp'] = datetime.datetime.utcnow()
+            title, html, urls = await self.run_in_executor(
+                prepare, url, page, prep, self.do_extract)
+            meta['title'] = meta.get('title') or title
+
+            manifest = get_manifest()
+            if manifest is not None:
+                args = self.package_args
+                fp = fingerprint(html, meta, package_options(
+                    args['base_dir'], args['keyring'], args['key']))
+                unchanged = await self.run_in_threads(manifest.lookup, url, fp)
+                if unchanged is not None:
+                    unchanged['unchanged'] = True
+                    return unchanged
+
+            temp_dir = tempfile.mkdtemp()
+            results = await asyncio.gather(*[
+                self.fetch_image(idx, imgurl, temp_dir)
+                for idx, imgurl in enumerate(urls)])
+
+            meta = await self.run_in_executor(package, url, html, results,
+                                              meta, temp_dir,
+                                              **self.package_args)
+            temp_dir = None  # Removed by ``package_page()``
+            if manifest is not None and 'error' not in meta:
+                await self.run_in_threads(manifest.put, url, fp, meta)
+            return meta
+        except Exception as err:
+            # Same as in ``pack.collect()``, all errors are trapped and
+            # reported using the 'error' key
+            logging.exception('Error %s while processing %s' % (err, url))
+            meta.setdefault('timestamp', datetime.datetime.utcnow())
+            meta['error'] = str(err)
+            return meta
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def collect_within(self, url, timeout=None):
+        """ Collect the page at ``url``, giving up after ``timeout`` seconds
+
+        Preprocessors and readiness conditions are selected using
+        ``get_preps()`` and ``get_ready()``. Pages that time out are reported
+        using the ``error`` key. Blocking work that is already running in a
+        thread or process is not interrupted, but its result is discarded.
+
+        :param url:     URL of the page
+        :param timeout: Number of seconds the page is allowed to take, or
+                        ``None`` for no limit
+        :returns:       Page metadata
+        """
+        try:
+            return await asyncio.wait_for(
+                self.collect(url, get_preps(url), ready=get_ready(url)),
+                timeout)
+        except asyncio.TimeoutError:
+            logging.error('Timed out while processing %s', url)
+            return error_meta(url, 'Timed out after %s seconds' % timeout)
+
+    async def batch(self, urls, timeout=JOB_TIMEOUT,
+                    max_per_host=MAX_PER_HOST, min_interval=MIN_INTERVAL,
+                    max_pages=MAX_PAGES):
+        """ Collect all URLs in ``urls`` concurrently
+
+        Pages are handed out by a ``DomainScheduler`` to ``max_pages`` tasks,
+        so no more than ``max_pages`` pages are in flight at a time, hosts
+        take turns, and per-host limits are observed the same way as in
+        ``batch.batch()``.
+
+        :param urls:            Iterable containing URLs to process
+        :param timeout:         Number of seconds each page is allowed to
+                                take, or ``None`` for no limit
+        :param max_per_host:    Maximum number of concurrently processed
+                                pages from a single host
+        :param min_interval:    Minimum number of seconds between starting
+                                pages from a single host
+        :param max_pages:       Maximum number of pages collected at a time
+        :returns:               List of page metadata in the order of URLs
+        """
+        scheduler = DomainScheduler(max_per_host, min_interval)
+        urls = list(urls)
+        for idx, url in enumerate(urls):
+            scheduler.add(get_host(url), idx)
+        results = [None] * len(urls)
+        changed = asyncio.Condition()
+
+        async def take():
+            async with changed:
+                while len(scheduler):
+                    idx = scheduler.next()
+                    if idx is not None:
+                        return idx
+                    try:
+                        # Wakes up when a page is done, or when a page that
+                        # is rate-limited can be started
+                        await asyncio.wait_for(changed.wait(),
+                                               scheduler.wait_time())
+                    except asyncio.TimeoutError:
+                        pass
+            return None
+
+        async def work():
+            while True:
+                idx = await take()
+                if idx is None:
+                    return
+                url = urls[idx]
+                try:
+                    results[idx] = await self.collect_within(url, timeout)
+                finally:
+                    async with changed:
+                        scheduler.done(get_host(url))
+                        changed.notify_all()
+
+        await asyncio.gather(*[work() for _ in range(max(max_pages, 1))])
+        return results
+
+
+def abatch(urls, keyring=None, key=None, passphrase=None, base_dir=BASE_DIR,
+           keep_dir=False, max_procs=None, timeout=JOB_TIMEOUT,
+           max_per_host=MAX_PER_HOST, min_interval=MIN_INTERVAL,
+           max_fetches=MAX_FETCHES, max_pages=MAX_PAGES, javascript=True):
+    """ Batch-collect URLs within an event loop
+
+    This function is a drop-in replacement for ``batch.batch()``, and takes
+    the same arguments, followed by limits on concurrency within the event
+    loop.
+
+    :param urls:        Iterable containing URLs to process
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :param base_dir:    Base directory in which to operate
+    :param keep_dir:    Keep the directory in which content was collected
+    :param max_procs:   Maximum number of processes that handle extraction and
+                        packaging. Defaults to ``None``, which uses as many
+                        processes as there are CPUs.
+    :param timeout:     Number of seconds each page is allowed to take
+    :param max_per_host:    Maximum number of concurrently processed pages
+                            from a single host
+    :param min_interval:    Minimum number of seconds between starting pages
+                            from a single host
+    :param max_fetches: Maximum number of concurrent fetches
+    :param max_pages:   Maximum number of pages collected at a time
+    :param javascript:  Whether to execute JavaScript on the pages
+    :returns:           List of page metadata in the order of URLs
+    """
+    async def run():
+        async with Collector(keyring=keyring, key=key, passphrase=passphrase,
+                             base_dir=base_dir, keep_dir=keep_dir,
+                             javascript=javascript, max_fetches=max_fetches,
+                             max_procs=max_procs) as collector:
+            return await collector.batch(urls, timeout, max_per_host,
+                                         min_interval, max_pages)
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
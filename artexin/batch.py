@@ -10,16 +10,32 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 from __future__ import unicode_literals
 
+import datetime
+import logging
 import multiprocessing
+import os
+import signal
+import sys
+import time
+import urllib.parse as urlparse
+
+from multiprocessing.connection import wait
 
 from . import __version__ as _version, __author__ as _author
 from .pack import collect, BASE_DIR
-from .preprocessor_mappings import get_preps
+from .preprocessor_mappings import get_preps, get_ready
+from .scheduler import DomainScheduler, MAX_PER_HOST, MIN_INTERVAL
 
 
 __version__ = _version
 __author__ = _author
-__all__ = ('batch',)
+__all__ = ('batch', 'ibatch')
+
+
+MAX_PENDING = 16  # Number of jobs per process read ahead from the input
+JOB_TIMEOUT = 300  # Number of seconds after which a job is given up on
+KILL_TIMEOUT = 2  # Number of seconds to wait for worker to exit after SIGTERM
+POLL_INTERVAL = 0.1  # Number of seconds between polls with nothing to wait on
 
 
 def wrapper(data):
@@ -28,13 +44,309 @@ def wrapper(data):
     :param data:    Tuple containing ``pack.collect()`` arguments
     :return:        Results of calling ``pack.collect()``
     """
-    url, keyring, key, passphrase, preps, base_dir, keep_dir = data
+    url, keyring, key, passphrase, preps, ready, base_dir, keep_dir = data
     return collect(url, keyring, key, passphrase, prep=preps,
-                   base_dir=base_dir, keep_dir=keep_dir)
+                   base_dir=base_dir, keep_dir=keep_dir, ready=ready)
+
+
+def get_host(url):
+    """ Return the host part of the URL, same as ``meta['domain']``
+
+    Example::
+
+        >>> get_host('http://en.wikipedia.org/wiki/Sunflower')
+        'en.wikipedia.org'
+
+    """
+    return urlparse.urlparse(url).netloc
+
+
+def error_meta(url, err):
+    """ Create metadata for URL whose processing failed
+
+    The metadata has the same format as metadata returned by
+    ``pack.collect()`` for pages that could not be fetched.
+
+    Example::
+
+        >>> meta = error_meta('http://www.example.com/', ValueError('foo'))
+        >>> meta['domain'], meta['error']
+        ('www.example.com', 'foo')
+
+    :param url:     URL of the page
+    :param err:     Exception object
+    :returns:       Metadata dict
+    """
+    return {'url': url,
+            'domain': get_host(url),
+            'timestamp': datetime.datetime.utcnow(),
+            'error': str(err)}
+
+
+def work(conn):
+    """ Worker process main loop
+
+    Receives jobs over ``conn`` and sends back the results until it receives
+    ``None`` or the connection is closed. Each job is a two-tuple of job ID
+    and ``wrapper()`` arguments, and each result is a two-tuple of job ID and
+    page metadata.
+
+    :param conn:    Connection to the parent process
+    """
+    # Exit gracefully on SIGTERM, so that finalizers (e.g., the one that shuts
+    # down browser sessions) get a chance to run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job_id, data = job
+        try:
+            result = wrapper(data)
+        except Exception as err:
+            logging.exception('Error %s while processing %s' % (err, data[0]))
+            result = error_meta(data[0], err)
+        conn.send((job_id, result))
+    conn.close()
+
+
+class Worker(object):
+    """ Worker process that handles one job at a time
+
+    Unlike ``multiprocessing.Pool`` workers, a worker can be killed while
+    processing a job without affecting other workers.
+    """
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=work,
+                                               args=(child_conn,),
+                                               daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job_id = None
+        self.url = None
+        self.host = None
+        self.deadline = None
+        self.dead = False
+
+    @property
+    def busy(self):
+        return self.job_id is not None
+
+    def submit(self, job_id, data, timeout=None):
+        """ Send job to the worker process
+
+        :param job_id:  Job ID
+        :param data:    Arguments for ``wrapper()``
+        :param timeout: Number of seconds the job is allowed to take
+        """
+        self.job_id = job_id
+        self.url = data[0]
+        self.host = get_host(self.url)
+        self.deadline = time.time() + timeout if timeout else None
+        self.conn.send((job_id, data))
+
+    def receive(self):
+        """ Receive the result of the current job
+
+        If the worker process died while processing the job, a result with
+        ``error`` key is returned.
+
+        :returns:   Two-tuple of job ID and page metadata
+        """
+        try:
+            result = self.conn.recv()
+        except (EOFError, OSError):
+            self.dead = True
+            logging.error('Worker died while processing %s', self.url)
+            result = (self.job_id,
+                      error_meta(self.url, 'Worker process died'))
+        self.job_id = self.url = self.host = self.deadline = None
+        return result
+
+    def kill(self):
+        """ Terminate the worker process """
+        self.process.terminate()
+        self.process.join(KILL_TIMEOUT)
+        if self.process.exitcode is None:
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """ Ask the worker process to exit and wait for it """
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(KILL_TIMEOUT)
+        if self.process.exitcode is None:
+            self.kill()
+        else:
+            self.conn.close()
+
+
+def run_jobs(jobs, max_procs=None, max_pending=None, timeout=JOB_TIMEOUT,
+             scheduler=None):
+    """ Process jobs in worker processes, yielding results as they complete
+
+    Jobs whose processing takes longer than ``timeout`` seconds are given up
+    on, and the worker processing them is killed and replaced by a new one.
+    Such jobs are reported as metadata with the ``error`` key.
+
+    At most ``max_pending`` jobs are read from ``jobs`` ahead of their
+    completion. Jobs that have been read are handed out to workers by the
+    ``scheduler``, which interleaves hosts and limits the number and rate of
+    jobs for each host (see ``artexin.scheduler.DomainScheduler``).
+
+    :param jobs:        Iterable of ``wrapper()`` arguments
+    :param max_procs:   Number of worker processes
+    :param max_pending: Maximum number of jobs read ahead
+    :param timeout:     Number of seconds each job is allowed to take
+    :param scheduler:   ``DomainScheduler`` instance (a scheduler with default
+                        limits is used if omitted)
+    :returns:           Generator yielding two-tuples of job index and page
+                        metadata
+    """
+    max_procs = max_procs or os.cpu_count() or 1
+    max_pending = max(max_pending or max_procs * MAX_PENDING, max_procs)
+    if scheduler is None:
+        scheduler = DomainScheduler()
+    jobs = enumerate(jobs)
+    exhausted = False
+    pending = 0  # number of jobs read from input but not yet completed
+    workers = [Worker() for _ in range(max_procs)]
+    try:
+        while True:
+            while not exhausted and pending < max_pending:
+                try:
+                    job_id, data = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                scheduler.add(get_host(data[0]), (job_id, data))
+                pending += 1
+            for worker in workers:
+                if worker.busy:
+                    continue
+                job = scheduler.next()
+                if job is None:
+                    break
+                worker.submit(job[0], job[1], timeout)
+            if not pending:
+                break
+
+            # Wait until a job finishes, a job times out, or a job that is
+            # rate-limited can be started
+            busy = [w for w in workers if w.busy]
+            waits = [w.deadline - time.time()
+                     for w in busy if w.deadline is not None]
+            if len(busy) < len(workers):
+                waits.append(scheduler.wait_time())
+            waits = [t for t in waits if t is not None]
+            wait_timeout = max(min(waits), 0) if waits else None
+            if not busy:
+                # Nothing to wait on if the scheduler does not know when a
+                # job can start, so poll instead of spinning
+                time.sleep(POLL_INTERVAL if wait_timeout is None
+                           else wait_timeout)
+                continue
+            ready = wait([w.conn for w in busy], wait_timeout)
+
+            now = time.time()
+            for idx, worker in enumerate(workers):
+                if not worker.busy:
+                    continue
+                host = worker.host
+                if worker.conn in ready:
+                    result = worker.receive()
+                    if worker.dead:
+                        worker.kill()
+                        workers[idx] = Worker()
+                elif worker.deadline is not None and worker.deadline <= now:
+                    logging.error('Timed out while processing %s', worker.url)
+                    result = (worker.job_id, error_meta(
+                        worker.url, 'Timed out after %s seconds' % timeout))
+                    worker.kill()
+                    workers[idx] = Worker()
+                else:
+                    continue
+                scheduler.done(host)
+                pending -= 1
+                yield result
+    finally:
+        for worker in workers:
+            if worker.busy:
+                worker.kill()
+            else:
+                worker.stop()
+
+
+def make_job(url, keyring, key, passphrase, base_dir, keep_dir):
+    """ Create ``wrapper()`` arguments for given URL """
+    return (url, keyring, key, passphrase, get_preps(url), get_ready(url),
+            base_dir, keep_dir)
+
+
+def ibatch(urls, keyring=None, key=None, passphrase=None, base_dir=BASE_DIR,
+           keep_dir=False, max_procs=None, max_pending=None,
+           timeout=JOB_TIMEOUT, max_per_host=MAX_PER_HOST,
+           min_interval=MIN_INTERVAL):
+    """ Batch-collect URLs, yielding results as they become available
+
+    Unlike ``batch()``, this function returns a generator which yields the
+    metadata of each page as soon as it is collected, in order of completion.
+    URLs are read from ``urls`` only as workers become available, with at most
+    ``max_pending`` jobs in flight, so ``urls`` can be a generator over an
+    input of any size.
+
+    Pages whose processing fails with an exception or takes longer than
+    ``timeout`` seconds are reported using the ``error`` key, same as pages
+    that ``pack.collect()`` fails to fetch. Workers that time out are killed
+    and replaced.
+
+    URLs are not processed in input order. Instead, they are grouped by host,
+    and hosts take turns, so that workers are kept busy even when the input
+    is dominated by a few hosts. No more than ``max_per_host`` pages are
+    processed at a time for any host, and no two pages from the same host are
+    started within ``min_interval`` seconds.
+
+    If the generator is closed before all results are consumed, the worker
+    processes are terminated.
+
+    :param urls:        Iterable containing URLs to process
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :param base_dir:    Base directory in which to operate
+    :param keep_dir:    Keep the directory in which content was collected
+    :param max_procs:   Number of worker processes. Defaults to the number of
+                        CPUs.
+    :param max_pending: Maximum number of URLs read ahead of completion.
+                        Defaults to ``MAX_PENDING`` jobs per worker process.
+    :param timeout:     Number of seconds each page is allowed to take.
+                        Defaults to ``JOB_TIMEOUT``. ``None`` disables the
+                        timeout.
+    :param max_per_host:    Maximum number of concurrently processed pages
+                            from a single host
+    :param min_interval:    Minimum number of seconds between starting pages
+                            from a single host
+    :returns:           Generator yielding page metadata
+    """
+    jobs = (make_job(url, keyring, key, passphrase, base_dir, keep_dir)
+            for url in urls)
+    scheduler = DomainScheduler(max_per_host, min_interval)
+    for _, meta in run_jobs(jobs, max_procs, max_pending, timeout, scheduler):
+        yield meta
 
 
 def batch(urls, keyring=None, key=None, passphrase=None, base_dir=BASE_DIR,
-          keep_dir=False, max_procs=None):
+          keep_dir=False, max_procs=None, timeout=JOB_TIMEOUT,
+          max_per_host=MAX_PER_HOST, min_interval=MIN_INTERVAL):
     """ Batch-collect URLs using ``pack.collect()``
 
     :param urls:        Iterable containing URLs to process
@@ -43,16 +355,23 @@ def batch(urls, keyring=None, key=None, passphrase=None, base_dir=BASE_DIR,
     :param passphrase:  Key passphrase
     :param base_dir:    Base directory in which to operate
     :param keep_dir:    Keep the directory in which content was collected
-    :param max_procs:   Maximum number of processes in the process pool that
-                        handles the batch job. Defaults to ``None``, which uses
-                        a single process. This corresponds to
-                        ``multiprocessing.Pool()`` constructor's ``processes``
-                        argument.
-    """
-    urls = ((u, keyring, key, passphrase, get_preps(u), base_dir, keep_dir)
-            for u in urls)
-    pool = multiprocessing.Pool(max_procs)
-    results = pool.map(wrapper, urls)
-    pool.close()
-    pool.join()
+    :param max_procs:   Maximum number of processes that handle the batch
+                        job. Defaults to ``None``, which uses as many
+                        processes as there are CPUs.
+    :param timeout:     Number of seconds each page is allowed to take (see
+                        ``ibatch()``)
+    :param max_per_host:    Maximum number of concurrently processed pages
+                            from a single host
+    :param min_interval:    Minimum number of seconds between starting pages
+                            from a single host
+    :returns:           List of page metadata in the order of URLs
+    """
+    urls = list(urls)
+    jobs = (make_job(url, keyring, key, passphrase, base_dir, keep_dir)
+            for url in urls)
+    scheduler = DomainScheduler(max_per_host, min_interval)
+    results = [None] * len(urls)
+    for idx, meta in run_jobs(jobs, max_procs, timeout=timeout,
+                              scheduler=scheduler):
+        results[idx] = meta
     return results
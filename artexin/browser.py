@@ -0,0 +1,229 @@
+"""
+browser.py: pool of reusable headless browser sessions
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+
+from multiprocessing import util
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('BrowserPool', 'get_pool', 'close_pool')
+
+
+POOL_SIZE = 4  # Maximum number of browser sessions per process
+MAX_PAGES = 50  # Number of pages after which a session is recycled
+MAX_MEMORY = 512 * 1024 * 1024  # Memory usage at which a session is recycled
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_pool = None  # pool belonging to the current process
+_pool_pid = None  # pid of the process that created the pool
+_pool_lock = threading.Lock()
+
+
+def get_rss(driver):
+    """ Return resident memory size of the browser process in bytes
+
+    Returns ``None`` if memory usage cannot be determined, e.g., because the
+    driver does not expose the browser process or ``/proc`` is unavailable.
+
+    Example::
+
+        >>> get_rss(object()) is None
+        True
+
+    :param driver:  WebDriver instance
+    :returns:       Memory usage in bytes or ``None``
+    """
+    try:
+        pid = driver.service.process.pid
+        with open('/proc/%s/statm' % pid, 'r') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (AttributeError, OSError, IndexError, ValueError):
+        return None
+
+
+class Session(object):
+    """ Browser session belonging to a pool
+
+    :param driver:  WebDriver instance
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            # The browser may already be gone, and there is nothing we can do
+            # about it anyway.
+            logging.exception('Error while quitting browser session')
+
+
+class BrowserPool(object):
+    """ Pool of warm browser sessions
+
+    Sessions are started on demand using the ``factory`` callable, up to
+    ``size`` sessions. When all sessions are in use, callers wait for one to
+    be returned to the pool. Sessions are recycled (quit and replaced by new
+    ones when needed) after ``max_pages`` pages, when the browser process uses
+    more than ``max_memory`` bytes of memory, or when an error occurs while
+    the session is in use.
+
+    Example::
+
+        >>> class FakeDriver(object):
+        ...     def quit(self):
+        ...         print('quit')
+        >>> pool = BrowserPool(FakeDriver, max_pages=2)
+        >>> with pool.session() as driver:
+        ...     pass
+        >>> with pool.session() as driver:
+        ...     pass
+        quit
+        >>> pool.close()
+
+    :param factory:     Callable that starts a browser and returns its driver
+    :param size:        Maximum number of sessions
+    :param max_pages:   Number of pages after which a session is recycled
+    :param max_memory:  Browser memory usage (in bytes) at which a session is
+                        recycled
+    """
+
+    def __init__(self, factory, size=POOL_SIZE, max_pages=MAX_PAGES,
+                 max_memory=MAX_MEMORY):
+        self.factory = factory
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.idle = []  # sessions that are not in use, last used on top
+        self.count = 0  # number of live sessions
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """ Get a session from the pool, starting a new one if needed
+
+        :returns:   ``Session`` instance
+        """
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError('Browser pool is closed')
+                if self.idle:
+                    return self.idle.pop()
+                if self.count < self.size:
+                    self.count += 1
+                    break
+                self.cond.wait()
+        # Start the browser outside the lock, since it takes a while
+        try:
+            return Session(self.factory())
+        except Exception:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, session, discard=False):
+        """ Return the session to the pool
+
+        The session is quit instead of returned if it needs to be recycled or
+        ``discard`` is ``True``.
+
+        :param session: ``Session`` instance obtained using ``acquire()``
+        :param discard: Whether to discard the session unconditionally
+        """
+        session.pages += 1
+        if not discard and not self.closed:
+            rss = get_rss(session.driver)
+            discard = (session.pages >= self.max_pages or
+                       (rss is not None and rss > self.max_memory))
+        with self.cond:
+            if not discard and not self.closed:
+                self.idle.append(session)
+                self.cond.notify()
+                return
+            self.count -= 1
+            self.cond.notify()
+        session.quit()
+
+    @contextlib.contextmanager
+    def session(self):
+        """ Context manager that provides a driver from the pool
+
+        If an exception is raised within the context, the session is
+        discarded, since the state of the browser is unknown.
+        """
+        session = self.acquire()
+        try:
+            yield session.driver
+        except BaseException:
+            self.release(session, discard=True)
+            raise
+        self.release(session)
+
+    def close(self):
+        """ Quit all idle sessions and prevent further use of the pool
+
+        Sessions that are in use at the time of closing are quit as soon as
+        they are returned to the pool.
+        """
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.count -= len(idle)
+            self.cond.notify_all()
+        for session in idle:
+            session.quit()
+
+
+def get_pool(factory):
+    """ Return the browser pool for the current process
+
+    The pool is created on first use. Each process (e.g., a batch worker)
+    gets its own pool, which is closed when the process exits.
+
+    :param factory:     Callable that starts a browser, used when creating
+                        the pool
+    :returns:           ``BrowserPool`` instance
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        pid = os.getpid()
+        if _pool is None or _pool_pid != pid:
+            # Pools inherited from the parent process belong to the parent
+            _pool = BrowserPool(factory)
+            _pool_pid = pid
+            # Finalizers with exit priority also run in worker processes
+            # where regular ``atexit`` handlers do not.
+            util.Finalize(_pool, _pool.close, exitpriority=10)
+        return _pool
+
+
+def close_pool():
+    """ Close the browser pool of the current process if there is one """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and _pool_pid == os.getpid():
+        pool.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -9,20 +9,26 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import os
+import shutil
 import tempfile
+import threading
+import time
 
-from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from breadability.readable import Article
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Doctype
 
 from . import __version__ as _version, __author__ as _author
+from . import lxmlutils
 from .fetch import fetch_image
-from .urlutils import (absolute_path,
+from .htmlutils import get_soup, soup_transform, to_html
+from .imageopt import optimize_images
+from .urlutils import (URLResolver,
+                       absolute_path,
                        full_url,
                        is_http_url,
-                       normalize_scheme,
-                       split)
+                       normalize_scheme)
 
 
 __version__ = _version
@@ -30,6 +36,8 @@ __author__ = _author
 
 
 PROCESSED_IMG_DIR = tempfile.gettempdir()
+IMAGE_WORKERS = 8  # Number of images downloaded concurrently for each page
+IMAGE_DEADLINE = None  # Seconds allowed for downloading all images of a page
 
 
 def get_title(soup):
@@ -102,14 +110,21 @@ def extract(html, **kwargs):
         >>> '<div id="navigation">' in s
         False
 
-    :param html:        String containing the HTML document
+    When a soup object is passed instead of HTML source, the article body is
+    returned as a new soup object rather than a string.
+
+    :param html:        String containing the HTML document or soup object
     :param **kwargs:    Extra arguments for readability's ``Document()`` class
     :returns:           Two-tuple containing document title and article body
     """
     # Extract article
-    soup = BeautifulSoup(html, 'lxml')
+    is_soup = isinstance(html, BeautifulSoup)
+    soup = get_soup(html)
     title_text = get_title(soup)
 
+    # Readability does its own parsing, so it needs the source
+    if is_soup:
+        html = str(soup)
     doc = Article(html, return_fragment=False, **kwargs)
 
     # Create basic <head> tag with <title> and charset tags
@@ -127,13 +142,19 @@ def extract(html, **kwargs):
     soup.head.append(title)
 
     # Add doctype
-    final = '<!DOCTYPE html>\n' + soup.prettify()
-    return (title_text, final)
+    soup.insert(0, Doctype('html'))
+    if is_soup:
+        return (title_text, soup)
+    return (title_text, to_html(soup))
 
 
 def no_extract(html):
-    soup = BeautifulSoup(html, 'lxml')
-    title = get_title(soup)
+    """ Get the title of the document without performing extraction
+
+    :param html:        String containing the HTML document or soup object
+    :returns:           Two-tuple containing document title and the document
+    """
+    title = get_title(get_soup(html))
     return title, html
 
 
@@ -187,6 +208,97 @@ def process_image(data):
         return None
 
 
+class ImageDownloads(object):
+    """ Images downloaded by a pool of threads before a deadline
+
+    Each image is downloaded into its own staging directory, and it is moved
+    into the image directory only if the results are still wanted. Moving
+    images and giving up on the results are done while holding the same lock,
+    so no image is placed in the image directory after ``cancel()`` returns,
+    even if downloads that were running at the time complete later.
+
+    :param imgdata:     List of image data tuples (see ``process_image()``)
+    """
+
+    def __init__(self, imgdata):
+        self.imgdata = imgdata
+        self.results = [None] * len(imgdata)
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def process(self, n):
+        """ Download and process image number ``n`` """
+        idx, imgurl, imgdir = self.imgdata[n]
+        staging = tempfile.mkdtemp(prefix='artexin-')
+        try:
+            imgpath = process_image((idx, imgurl, staging))
+            with self.lock:
+                if imgpath is None or self.cancelled:
+                    return
+                self.results[n] = shutil.move(
+                    imgpath, os.path.join(imgdir, os.path.basename(imgpath)))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def cancel(self):
+        """ Give up on unfinished downloads and return the results """
+        with self.lock:
+            self.cancelled = True
+            return list(self.results)
+
+
+def process_image_list(imgdata, workers=None, deadline=None):
+    """ Download and process images using a pool of threads
+
+    The results are returned in the same order as the image data, regardless
+    of the order in which the downloads complete. When ``deadline`` is
+    reached, images that were not processed yet are given up on and their
+    result is ``None``, same as for images that failed to download. Downloads
+    that are still running at that point are left to finish in the
+    background, but their images are discarded instead of being written to
+    the image directory (see ``ImageDownloads``).
+
+    If ``workers`` is 1 and there is no deadline, images are processed one by
+    one in the calling thread.
+
+    Example::
+
+        >>> process_image_list([], workers=4, deadline=10)
+        []
+
+    :param imgdata:     Iterable of image data tuples (see ``process_image()``)
+    :param workers:     Maximum number of concurrent downloads (defaults to
+                        ``IMAGE_WORKERS``)
+    :param deadline:    Number of seconds after which unfinished images are
+                        given up on (defaults to ``IMAGE_DEADLINE``)
+    :returns:           List of image paths or ``None`` for each image
+    """
+    if workers is None:
+        workers = IMAGE_WORKERS
+    if deadline is None:
+        deadline = IMAGE_DEADLINE
+    imgdata = list(imgdata)
+    if not imgdata:
+        return []
+    if workers == 1 and deadline is None:
+        return list(map(process_image, imgdata))
+
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(imgdata)))
+    if deadline is None:
+        futures = [executor.submit(process_image, data) for data in imgdata]
+        executor.shutdown()
+        return [f.result() for f in futures]
+    downloads = ImageDownloads(imgdata)
+    futures = [executor.submit(downloads.process, n)
+               for n in range(len(imgdata))]
+    wait(futures, timeout=deadline)
+    for future in futures:
+        future.cancel()
+    # Don't wait for the stragglers, their images will not be used
+    executor.shutdown(wait=False)
+    return downloads.cancel()
+
+
 def imgsrc(path):
     """ Get ``src`` attribute value from image path
 
@@ -201,47 +313,34 @@ def imgsrc(path):
     return './%s' % os.path.basename(path)
 
 
-def process_images(html, base_url, imgdir=PROCESSED_IMG_DIR):
-    """ Return list of absolute URLs for all images in pecified HTML
-
-    Images found in the HTML will be downloaded. If the image file is not
-    reachable or invalid, the <img> element will be stripped. Please note that
-    network connections problems may also cause this to happen.
+def find_images(soup, base_url):
+    """ Find all images in the document and prepare their URLs for download
 
-    The downloaded images will have a new filename in the following format:
-    ``imageNNNN`` where ``NNNN`` is the index of its first appearance in the
-    document.
-
-    The ``imgdir`` should point to a directory where the images will be
-    downloaded and stored temporarily in order to determine their format. The
-    images are not processed in any way. It defaults to system's temporary
-    directory or value of ``tempfile.tempdir`` when it is set to a value other
-    than ``None``.
+    Images without ``src`` attribute are removed from the document. Images
+    that share the same ``src`` are only listed once, and the others are
+    returned as duplicates of the first one.
 
     Example::
 
-        >>> imgurl = '/static/img/outernet/site_logo_white.png'
-        >>> docurl = 'https://www.outernet.is/test.html'  # not a real URL, tho
-        >>> html = '<html><body><p><img src="%s"></p></body></html>' % imgurl
-        >>> html, images = process_images(html, docurl)
-        >>> len(images)
-        1
-        >>> '/tmp/image0000.png' in images
-        True
-        >>> os.path.exists(images[0])
-        True
-
-    :param html:        String containing the HTML document
+        >>> soup = get_soup('<img src="a.png"><img src="b.png"><img>'
+        ...                 '<img src="a.png">')
+        >>> urls, tags, dupes = find_images(soup, 'http://example.com/doc')
+        >>> urls
+        ['http://example.com/a.png', 'http://example.com/b.png']
+        >>> [idx for tag, idx in dupes]
+        [0]
+        >>> len(soup.find_all('img'))
+        3
+
+    :param soup:        Soup object
     :param base_url:    Base URL of the document
-    :param imgdir:      Directory to use for temporary image storage
-    :returns:           Tuple of processed document and image path list
+    :returns:           Three-tuple containing a list of unique image URLs, a
+                        list of tags matching the URLs, and a list of
+                        duplicate tags paired with indices of their URLs
     """
-
-    seen = []     # All unique paths that have been seen thus far
+    seen = {}     # All unique paths that have been seen thus far
     tags = []     # List of tags belonging to unique paths
     dupes = []    # Duplicate images (tuple: tag, index in uniques)
-    images = []  # list of valid image paths
-    soup = BeautifulSoup(html, 'lxml')
 
     # The reason uniques have a bit of cruft is we anticipate sending all
     # necessary data to process the image as a single tuple to another
@@ -255,22 +354,28 @@ def process_images(html, base_url, imgdir=PROCESSED_IMG_DIR):
             img.decompose()  # Don't keep images with no src
             continue
         if src in seen:
-            dupes.append([img, seen.index(src)])
+            dupes.append([img, seen[src]])
         else:
-            seen.append(src)
+            seen[src] = len(tags)
             tags.append(img)
 
-    nurls = len(seen)  # Number of unique URLs
-    fornurls = lambda x: repeat(x, nurls)  # Repeat anything ``nurls`` times
+    # Prepare all URLs (dicts keep insertion order, so this is tag order)
+    return URLResolver(base_url).resolve_many(seen), tags, dupes
 
-    # Prepare all URLs
-    base, docpath = split(base_url)
-    urls = map(prepare_url, seen, fornurls(base), fornurls(docpath))
 
-    # Process all unique images
-    imgdata = ((idx, url, imgdir) for idx, url in enumerate(urls))
-    # TODO: Make the following line branch off into separate (light) thread
-    results = list(map(process_image, imgdata))
+def update_images(tags, dupes, results):
+    """ Point image tags to processed images or remove them
+
+    The ``results`` list should contain image paths (or ``None`` for images
+    that could not be processed) in the same order as the URLs returned by
+    ``find_images()``.
+
+    :param tags:        List of unique image tags
+    :param dupes:       List of duplicate tags and indices of their URLs
+    :param results:     List of image paths or ``None``
+    :returns:           List of valid image paths
+    """
+    images = []  # list of valid image paths
 
     # Update src in all image tags
     for tag, imgpath in zip(tags, results):
@@ -288,26 +393,113 @@ def process_images(html, base_url, imgdir=PROCESSED_IMG_DIR):
         else:
             tag['src'] = imgsrc(imgpath)
 
+    return images
+
+
+def process_images(html, base_url, imgdir=PROCESSED_IMG_DIR, workers=None,
+                   deadline=None, optimize=False, stats=None):
+    """ Return list of absolute URLs for all images in pecified HTML
+
+    Images found in the HTML will be downloaded. If the image file is not
+    reachable or invalid, the <img> element will be stripped. Please note that
+    network connections problems may also cause this to happen.
+
+    The downloaded images will have a new filename in the following format:
+    ``imageNNNN`` where ``NNNN`` is the index of its first appearance in the
+    document.
+
+    The ``imgdir`` should point to a directory where the images will be
+    downloaded and stored temporarily in order to determine their format. The
+    images are not processed in any way. It defaults to system's temporary
+    directory or value of ``tempfile.tempdir`` when it is set to a value other
+    than ``None``.
+
+    Example::
+
+        >>> imgurl = '/static/img/outernet/site_logo_white.png'
+        >>> docurl = 'https://www.outernet.is/test.html'  # not a real URL, tho
+        >>> html = '<html><body><p><img src="%s"></p></body></html>' % imgurl
+        >>> html, images = process_images(html, docurl)
+        >>> len(images)
+        1
+        >>> '/tmp/image0000.png' in images
+        True
+        >>> os.path.exists(images[0])
+        True
+
+    Images are downloaded concurrently by up to ``workers`` threads. If
+    ``deadline`` is specified, images that are not downloaded within that many
+    seconds are stripped as if they could not be fetched. See
+    ``process_image_list()`` for more information.
+
+    If ``optimize`` is set, downloaded images are downscaled and re-encoded
+    using ``artexin.imageopt.optimize_images()``. It may be a dict of keyword
+    arguments for ``artexin.imageopt.optimize_image()``.
+
+    If a soup object is passed instead of HTML source, it is modified in place
+    and returned as the processed document.
+
+    When a ``stats`` dict is passed, it is updated with the number of images
+    (``images``), bytes downloaded (``fetched_bytes``), and seconds spent
+    downloading (``fetch_time``). With ``optimize``, the statistics returned by
+    ``optimize_images()`` are added as well.
+
+    :param html:        String containing the HTML document or soup object
+    :param base_url:    Base URL of the document
+    :param imgdir:      Directory to use for temporary image storage
+    :param workers:     Maximum number of concurrent downloads
+    :param deadline:    Number of seconds allowed for downloading all images
+    :param optimize:    Whether to optimize images, or dict of options
+    :param stats:       Dict to update with image processing statistics
+    :returns:           Tuple of processed document and image path list
+    """
+
+    soup = get_soup(html)
+    urls, tags, dupes = find_images(soup, base_url)
+
+    # Process all unique images
+    start = time.time()
+    imgdata = ((idx, url, imgdir) for idx, url in enumerate(urls))
+    results = process_image_list(imgdata, workers, deadline)
+    if stats is not None:
+        stats.update({
+            'images': len([r for r in results if r is not None]),
+            'fetched_bytes': sum(os.stat(r).st_size
+                                 for r in results if r is not None),
+            'fetch_time': round(time.time() - start, 3)})
+    if optimize:
+        options = optimize if isinstance(optimize, dict) else {}
+        results, optstats = optimize_images(results, **options)
+        if stats is not None:
+            stats.update(optstats)
+    images = update_images(tags, dupes, results)
+
+    if soup is html:
+        return soup, images
     return str(soup), images
 
 
-def strip_links(html):
+@lxmlutils.fast_path(lxmlutils.strip_links)
+@soup_transform
+def strip_links(soup):
     """ Strips all links that don't point to fragments
 
+    HTML source is processed by ``artexin.lxmlutils.strip_links()`` when
+    possible, which gives the same result without building a soup object.
+
     Example::
 
         >>> html = '<html><body><a href="/foo">foo</a></body></html>'
         >>> strip_links(html)
         '<html><body>foo</body></html>'
 
-    :param html:    HTML source
-    :returns:       Processed HTML
+    :param soup:    Soup object (or HTML source, see ``soup_transform()``)
+    :returns:       Processed soup object
     """
-    soup = BeautifulSoup(html, 'lxml')
     for tag in soup.find_all('a'):
         if not tag.get('href', '').startswith('#'):
             tag.unwrap()
-    return str(soup)
+    return soup
 
 
 if __name__ == '__main__':
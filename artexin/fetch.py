@@ -8,29 +8,78 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
-import os
-import shutil
-import tempfile
 import time
 
 from io import BytesIO
-from urllib.request import urlopen, URLError
+from urllib.error import URLError
+
+import urllib3
 
 from bs4 import BeautifulSoup
 from PIL import Image
 from selenium import webdriver
 
 from . import __version__ as _version, __author__ as _author
+from .browser import get_pool
+from .imagestore import get_store
+from .session import get_session
 
 
 __version__ = _version
 __author__ = _author
-__all__ = ('fetch_content', 'fetch_rendered', 'fetch_image', 'get_parsed')
+__all__ = ('fetch_content', 'fetch_rendered', 'fetch_image', 'save_image',
+           'store_image', 'sniff_image', 'check_image', 'verify_image',
+           'get_parsed', 'start_browser', 'wait_until_ready')
 
 
-AJAX_TIMEOUT = 5  # 5 seconds
+AJAX_TIMEOUT = 5  # Maximum number of seconds to wait for the page to load
+READY_POLL = 0.1  # Interval between page readiness checks
+READY_CHECKS = 3  # Number of unchanged checks after which DOM is quiescent
 GHOST_LOG_PATH = '/dev/null'  # Set this to a file to enable logging
 
+# Returns document state, number of elements in the DOM, number of loaded
+# resources, and number of jQuery AJAX requests in progress
+READY_SCRIPT = """
+var perf = window.performance;
+return [document.readyState,
+        document.getElementsByTagName('*').length,
+        perf && perf.getEntriesByType ?
+            perf.getEntriesByType('resource').length : 0,
+        window.jQuery && window.jQuery.active || 0];
+"""
+SELECTOR_SCRIPT = "return document.querySelector(arguments[0]) !== null;"
+
+MAX_IMAGE_SIZE = 10 * 1024 * 1024  # Images larger than this are rejected
+SNIFF_SIZE = 2052  # Number of bytes needed to recognize image format
+CHUNK_SIZE = 64 * 1024
+IMAGE_SIGNATURES = (  # Offsets and bytes that identify supported formats
+    (0, b'\xff\xd8\xff', 'JPEG'),
+    (0, b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (0, b'GIF87a', 'GIF'),
+    (0, b'GIF89a', 'GIF'),
+    (0, b'BM', 'BMP'),
+    (0, b'II*\x00', 'TIFF'),
+    (0, b'MM\x00*', 'TIFF'),
+    (0, b'8BPS', 'PSD'),
+    (0, b'\xb1\x68\xde\x3a', 'DCX'),
+    (0, b'#define', 'XBM'),
+    (0, b'/* XPM */', 'XPM'),
+    (0, b'%!PS', 'EPS'),
+    (0, b'\xc5\xd0\xd3\xc6', 'EPS'),  # EPS with DOS binary header
+    (0, b'Image type:', 'IM'),
+    (0, b'\x0a\x00', 'PCX'),
+    (0, b'\x0a\x02', 'PCX'),
+    (0, b'\x0a\x03', 'PCX'),
+    (0, b'\x0a\x05', 'PCX'),
+    (0, b'P1', 'PPM'),
+    (0, b'P2', 'PPM'),
+    (0, b'P3', 'PPM'),
+    (0, b'P4', 'PPM'),
+    (0, b'P5', 'PPM'),
+    (0, b'P6', 'PPM'),
+    (2048, b'PCD_', 'PCD'),
+)
+
 IEXTENSIONS = {  # Image file extensions
     'BMP':   '.bmp',
     'DCX':   '.dcx',
@@ -68,6 +117,11 @@ def fetch_content(url):
         ... except urllib.error.URLError:
         ...     pass
 
+    Connections are reused across calls through the session shared by the
+    current process (see ``artexin.session``). If an HTTP cache is configured
+    using ``artexin.session.set_cache()``, unchanged content is read from the
+    cache.
+
     :param url:     Document's URL
     :returns:       Document contents as bytestring
     """
@@ -76,13 +130,72 @@ def fetch_content(url):
     timeout = 2
     while timeout < max_timeout:
         try:
-            return urlopen(url, timeout=timeout).read()
+            return get_session().fetch(url, timeout=timeout)
         except URLError:
             timeout += 2
     raise RuntimeError("Maximum timeout exceeding fetching URL: %s" % url)
 
 
-def fetch_rendered(url):
+def start_browser():
+    """ Start headless browser
+
+    This is the factory used for the browser sessions in the pool used by
+    ``fetch_rendered()``.
+
+    :returns:       WebDriver instance
+    """
+    return webdriver.PhantomJS(service_log_path=GHOST_LOG_PATH)
+
+
+def wait_until_ready(driver, ready=None, timeout=AJAX_TIMEOUT,
+                     poll=READY_POLL):
+    """ Wait for the page loaded in the browser to become ready
+
+    The ``ready`` argument can be a CSS selector, in which case the page is
+    ready once an element matching the selector is present, or a callable,
+    which is passed the driver and should return ``True`` when the page is
+    ready.
+
+    When ``ready`` is not specified, the page is ready once the document has
+    finished loading, there are no jQuery AJAX requests in progress, and
+    neither the number of elements in the DOM nor the number of loaded
+    resources has changed during the last ``READY_CHECKS`` checks.
+
+    Either way, this function gives up waiting after ``timeout`` seconds.
+
+    :param driver:  WebDriver instance
+    :param ready:   CSS selector or callable
+    :param timeout: Maximum number of seconds to wait
+    :param poll:    Number of seconds between checks
+    :returns:       ``True`` if page became ready, ``False`` on timeout
+    """
+    if isinstance(ready, str):
+        selector = ready
+        ready = lambda d: d.execute_script(SELECTOR_SCRIPT, selector)
+    deadline = time.time() + timeout
+    previous = None
+    unchanged = 0
+    while True:
+        if ready is not None:
+            if ready(driver):
+                return True
+        else:
+            state, elements, resources, active = driver.execute_script(
+                READY_SCRIPT)
+            current = (elements, resources)
+            if state == 'complete' and not active and current == previous:
+                unchanged += 1
+                if unchanged >= READY_CHECKS:
+                    return True
+            else:
+                unchanged = 0
+            previous = current
+        if time.time() + poll > deadline:
+            return False
+        time.sleep(poll)
+
+
+def fetch_rendered(url, ready=None):
     """ Fetch content using headless browser
 
     The difference between this function and ``fetch_content()`` is that this
@@ -104,15 +217,21 @@ def fetch_rendered(url):
         >>> s.h1.string
         'Hi Crowbar!'
 
+    Browser sessions are taken from a per-process pool (see
+    ``artexin.browser``) so that browsers are reused across pages.
+
+    After the page is loaded, the function waits for it to become ready (for
+    AJAX events to occur) for at most ``AJAX_TIMEOUT`` seconds. See
+    ``wait_until_ready()`` for information about the ``ready`` argument.
+
     :param url:     Document's URL
+    :param ready:   CSS selector or callable that tells when page is ready
     :returns:       Document contents as bytestring
     """
-    driver = webdriver.PhantomJS(service_log_path=GHOST_LOG_PATH)
-    driver.get(url)
-    time.sleep(AJAX_TIMEOUT)  # Wait for AJAX events to occur
-    html = driver.page_source
-    driver.quit  # This is correct usage, not a function call by design
-    return html
+    with get_pool(start_browser).session() as driver:
+        driver.get(url)
+        wait_until_ready(driver, ready, timeout=AJAX_TIMEOUT)
+        return driver.page_source
 
 
 def fetch_image(url, path):
@@ -146,28 +265,179 @@ def fetch_image(url, path):
         Traceback (most recent call last):
         OSError: ...
 
+    The download is aborted as soon as the leading bytes show that the
+    content is not an image (e.g., an HTML error page), or when it exceeds
+    ``MAX_IMAGE_SIZE``. The image is written to disk once, after it has been
+    verified.
+
+    If an image store is configured (see ``artexin.imagestore.set_store()``)
+    images found in the store are not downloaded again, and downloaded images
+    are added to it.
+
     :param url:     Image's URL
     :param path:    Image path without extension
     :returns:       Tuple containing image format and temporary image path
     """
-    content = fetch_content(url)
+    store = get_store()
+    if store is not None:
+        entry = store.lookup(url)
+        if entry is not None:
+            return store.export(entry, path)
+    session = get_session()
+    if session.cache is not None:
+        # Cached responses are read whole, so only the checks can be done
+        content = fetch_content(url)
+        check_image(content[:SNIFF_SIZE], url)
+        if len(content) > MAX_IMAGE_SIZE:
+            raise OSError('Image at %s is too large' % url)
+    else:
+        content = fetch_image_content(session, url)
+    return store_image(url, content, path)
+
+
+def sniff_image(head):
+    """ Recognize image format from the leading bytes of the content
+
+    Example::
 
-    # Store the content in temporary file
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    tmp.write(content)
-    tmp.close()
-    assert os.path.exists(tmp.name), 'Missing temp file %s' % tmp.name
+        >>> sniff_image(b'\\x89PNG\\r\\n\\x1a\\n\\x00\\x00')
+        'PNG'
+        >>> sniff_image(b'<!DOCTYPE html>') is None
+        True
 
-    # Open the content as image and deduce its format
+    :param head:    First ``SNIFF_SIZE`` bytes of the content
+    :returns:       Image format or ``None`` if content is not an image
+    """
+    for offset, signature, fmt in IMAGE_SIGNATURES:
+        if head.startswith(signature, offset):
+            return fmt
+    return None
+
+
+def check_image(head, url):
+    """ Raise ``OSError`` if the content of ``url`` is not an image """
+    if sniff_image(head) is None:
+        raise OSError('Content at %s is not an image' % url)
+
+
+def read_image(resp, url, max_size=MAX_IMAGE_SIZE):
+    """ Read image from a streamed response
+
+    Reading stops as soon as the content turns out not to be an image, or
+    exceeds ``max_size`` bytes, in which case ``OSError`` is raised. Content
+    is recognized as an image as soon as its format is known, but it is only
+    rejected once ``SNIFF_SIZE`` bytes are read, since some formats are
+    identified by bytes further into the content.
+
+    :param resp:        ``urllib3.HTTPResponse`` object
+    :param url:         Image's URL
+    :param max_size:    Maximum size of the image in bytes
+    :returns:           Image content as bytestring
+    """
+    length = resp.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_size:
+        raise OSError('Image at %s is too large' % url)
+    chunks = []
+    size = 0
+    sniffed = False
+    for chunk in resp.stream(CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_size:
+            raise OSError('Image at %s is too large' % url)
+        if not sniffed:
+            head = b''.join(chunks)[:SNIFF_SIZE]
+            sniffed = sniff_image(head) is not None
+            if not sniffed and size >= SNIFF_SIZE:
+                check_image(head, url)
+    content = b''.join(chunks)
+    if not sniffed:
+        check_image(content, url)
+    return content
+
+
+def fetch_image_content(session, url, max_size=MAX_IMAGE_SIZE):
+    """ Fetch image content, giving up early on content that isn't an image
+
+    Retries with increasing timeouts the same way ``fetch_content()`` does.
+
+    :param session:     ``artexin.session.Session`` instance
+    :param url:         Image's URL
+    :param max_size:    Maximum size of the image in bytes
+    :returns:           Image content as bytestring
+    """
+    max_timeout = 12
+    timeout = 2
+    while timeout < max_timeout:
+        try:
+            resp = session.request(url, timeout=timeout, stream=True)
+        except URLError:
+            timeout += 2
+            continue
+        try:
+            return read_image(resp, url, max_size)
+        except urllib3.exceptions.HTTPError:
+            resp.close()
+            timeout += 2
+        except BaseException:
+            # Don't read the rest of the response, just drop the connection
+            resp.close()
+            raise
+        finally:
+            resp.release_conn()
+    raise RuntimeError("Maximum timeout exceeding fetching URL: %s" % url)
+
+
+def store_image(url, content, path):
+    """ Verify image content fetched from ``url`` and store it on disk
+
+    The image is added to the image store if one is configured (see
+    ``fetch_image()``). Otherwise, this function works the same way as
+    ``save_image()``.
+
+    :param url:     Image's URL
+    :param content: Image content as bytestring
+    :param path:    Image path without extension
+    :returns:       Tuple containing image format and full image path
+    """
+    store = get_store()
+    if store is None:
+        return save_image(content, path)
+    fmt = verify_image(content)
+    entry = store.add(url, content, fmt, IEXTENSIONS[fmt])
+    return store.export(entry, path)
+
+
+def verify_image(content):
+    """ Verify image content and return its format
+
+    If content is not a usable image, Pillow/PIL exceptions are propagated.
+
+    :param content: Image content as bytestring
+    :returns:       Image format
+    """
     img = Image.open(BytesIO(content))
     img.verify()  # caller will have to trap exceptions
-    fmt = img.format
+    return img.format
+
+
+def save_image(content, path):
+    """ Verify image content and store it on disk
+
+    The image format is deduced from the content, and appropriate extension is
+    added to the ``path``. If content is not a usable image, Pillow/PIL
+    exceptions are propagated.
+
+    :param content: Image content as bytestring
+    :param path:    Image path without extension
+    :returns:       Tuple containing image format and full image path
+    """
+    # Open the content as image and deduce its format
+    fmt = verify_image(content)
 
-    # Calculate the full path of the image and move the temporary file there
     full_path = "%s%s" % (path, IEXTENSIONS[fmt])
-    shutil.move(tmp.name, full_path)
-    assert os.path.exists(full_path), 'Missing image at %s' % full_path
-    assert not os.path.exists(tmp.name), 'Temp file not removed'
+    with open(full_path, 'wb') as image_file:
+        image_file.write(content)
 
     return fmt, full_path
 
@@ -0,0 +1,215 @@
+"""
+htmlrules.py: declarative HTML cleanup rules applied in a single tree walk
+
+Cleanup rules are three- or four-tuples of a selector, an action, and action
+arguments. Selectors are simple CSS selectors consisting of an optional tag
+name, followed by any number of ``#id``, ``.class``, ``[attr]``,
+``[attr=value]``, and ``[attr^=value]`` parts. Several selectors can be
+separated by commas. Combinators are not supported, since each element is
+matched on its own.
+
+The following actions are supported:
+
+- ``('decompose',)``: remove the element and its contents
+- ``('unwrap',)``: replace the element with its contents
+- ``('rename', name[, attrs])``: change the tag name of the element, and
+  replace its attributes with ``attrs`` if given
+- ``('collect', key)``: make the element available to the caller under
+  ``key`` (see ``RuleSet.apply()``)
+- ``('move', key[, position])``: move the element into the first element
+  collected under ``key``, at given position (appended if omitted)
+
+A ``RuleSet`` applies all rules in one walk over the document. Elements inside
+removed elements are not visited at all.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import collections
+import re
+
+from bs4.element import Tag
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('RuleSet', 'compile_selector')
+
+
+ACTIONS = ('decompose', 'unwrap', 'rename', 'collect', 'move')
+COMPOUND_RE = re.compile(r'(\*|[a-z][a-z0-9]*)?'
+                         r'((?:[#.][\w-]+|\[[^\]]+\])*)$', re.IGNORECASE)
+PART_RE = re.compile(r'([#.])([\w-]+)|'
+                     r'\[\s*([\w-]+)\s*(?:(\^?=)\s*(["\']?)(.*?)\5\s*)?\]')
+
+
+def attr_value(tag, name):
+    """ Return attribute value as string, or ``None`` if it is not set """
+    value = tag.get(name)
+    if isinstance(value, list):
+        return ' '.join(value)
+    return value
+
+
+def compile_selector(selector):
+    """ Compile a simple selector into tag name and matching function
+
+    Example::
+
+        >>> from bs4 import BeautifulSoup
+        >>> soup = BeautifulSoup('<a class="new x" href="/w/foo">', 'lxml')
+        >>> name, match = compile_selector('a.new[href^="/w/"]')
+        >>> name, match(soup.a)
+        ('a', True)
+        >>> compile_selector('.x')[1](soup.a)
+        True
+        >>> compile_selector('a#foo')[1](soup.a)
+        False
+
+    :param selector:    Selector without commas
+    :returns:           Two-tuple of lower-case tag name (``None`` for any
+                        tag) and function that takes a tag and returns
+                        whether it matches the rest of the selector
+    """
+    match = COMPOUND_RE.match(selector.strip())
+    if not match or not selector.strip():
+        raise ValueError("Unsupported selector '%s'" % selector)
+    name, rest = match.groups()
+    name = None if name in (None, '*') else name.lower()
+    tests = []
+    for part in PART_RE.finditer(rest):
+        prefix, ident, attr, op, _, value = part.groups()
+        if prefix == '#':
+            tests.append(lambda tag, i=ident: tag.get('id') == i)
+        elif prefix == '.':
+            tests.append(lambda tag, c=ident: c in (tag.get('class') or ()))
+        elif op is None:
+            tests.append(lambda tag, a=attr: tag.get(a) is not None)
+        elif op == '=':
+            tests.append(lambda tag, a=attr, v=value: attr_value(tag, a) == v)
+        else:
+            tests.append(lambda tag, a=attr, v=value:
+                         (attr_value(tag, a) or '').startswith(v))
+    if PART_RE.sub('', rest):
+        raise ValueError("Unsupported selector '%s'" % selector)
+
+    def matches(tag):
+        for test in tests:
+            if not test(tag):
+                return False
+        return True
+    return name, matches
+
+
+class RuleSet(object):
+    """ Compiled set of cleanup rules
+
+    Rules are indexed by tag name, so each element is only tested against
+    rules that can match it. An element is matched against rules in order.
+    ``rename`` and ``collect`` rules apply as soon as the element matches.
+    The first matching ``decompose``, ``unwrap``, or ``move`` rule ends
+    matching for the element, and its action is carried out once the walk is
+    complete.
+
+    Example::
+
+        >>> from bs4 import BeautifulSoup
+        >>> rules = RuleSet([
+        ...     ('div#main', 'collect', 'main'),
+        ...     ('span.edit, div.nav', 'decompose'),
+        ...     ('a[href^="/wiki/"]', 'unwrap'),
+        ...     ('div.caption', 'rename', 'p'),
+        ...     ('div.note', 'rename', 'p', {}),
+        ...     ('h1', 'move', 'main', 0),
+        ... ])
+        >>> soup = BeautifulSoup('<h1>T</h1><div class="nav">x</div>'
+        ...                      '<div id="main"><a href="/wiki/A">A</a>'
+        ...                      '<span class="edit">e</span>'
+        ...                      '<div class="caption">c</div>'
+        ...                      '<div class="note">n</div></div>', 'lxml')
+        >>> found = rules.apply(soup)
+        >>> found['main'][0]
+        <div id="main"><h1>T</h1>A<p class="caption">c</p><p>n</p></div>
+
+    :param rules:   Iterable of rules
+    """
+
+    def __init__(self, rules):
+        by_name = {}
+        universal = []
+        for number, rule in enumerate(rules):
+            selectors, action, args = rule[0], rule[1], tuple(rule[2:])
+            if action not in ACTIONS:
+                raise ValueError("Unknown action '%s'" % action)
+            for selector in selectors.split(','):
+                name, matches = compile_selector(selector)
+                entry = (number, matches, action, args)
+                if name is None:
+                    universal.append(entry)
+                else:
+                    by_name.setdefault(name, []).append(entry)
+        self.universal = universal
+        # Rules for each tag name, including universal rules, in rule order
+        self.by_name = dict((name, sorted(entries + universal,
+                                          key=lambda e: e[0]))
+                            for name, entries in by_name.items())
+
+    def apply(self, soup):
+        """ Apply the rules to elements in the document in a single walk
+
+        :param soup:    Soup object, or tag whose descendants are processed
+        :returns:       Default dict mapping ``collect`` keys to lists of
+                        elements in document order
+        """
+        by_name = self.by_name
+        universal = self.universal
+        found = collections.defaultdict(list)
+        deferred = []  # (action, args, tag) in document order
+        stack = [child for child in reversed(soup.contents)
+                 if isinstance(child, Tag)]
+        while stack:
+            node = stack.pop()
+            descend = True
+            for _, matches, action, args in by_name.get(node.name,
+                                                        universal):
+                if not matches(node):
+                    continue
+                if action == 'rename':
+                    node.name = args[0]
+                    if len(args) > 1:
+                        node.attrs = dict(args[1])
+                elif action == 'collect':
+                    found[args[0]].append(node)
+                else:
+                    deferred.append((action, args, node))
+                    descend = action != 'decompose'
+                    break
+            if descend:
+                stack.extend(child for child in reversed(node.contents)
+                             if isinstance(child, Tag))
+        for action, args, tag in deferred:
+            if action == 'decompose':
+                tag.decompose()
+            elif action == 'unwrap':
+                tag.unwrap()
+            else:
+                targets = found.get(args[0])
+                if not targets:
+                    continue
+                tag.extract()
+                if len(args) > 1:
+                    targets[0].insert(args[1], tag)
+                else:
+                    targets[0].append(tag)
+        return found
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
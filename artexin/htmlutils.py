@@ -8,12 +8,38 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import functools
+import io
+import re
+
+from bs4 import BeautifulSoup, Comment, NavigableString
+from bs4.element import AttributeValueWithCharsetSubstitution
+from bs4.formatter import HTMLFormatter
+
 from . import __version__ as _version, __author__ as _author
 
 
 __version__ = _version
 __author__ = _author
-__all__ = ('get_cls',)
+__all__ = ('get_cls', 'get_soup', 'soup_transform', 'write_html',
+           'to_html')
+
+
+FORMATTER = HTMLFormatter.REGISTRY['minimal']  # Same as ``str(soup)``
+OUTPUT_ENCODING = 'utf-8'  # Declared in <meta> tags
+WRITE_SIZE = 64 * 1024  # Number of characters buffered before writing
+# Elements whose whitespace is significant
+PRESERVE_WHITESPACE = ('pre', 'textarea', 'script', 'style')
+# Elements around which whitespace-only strings are dropped when minifying
+BLOCK_ELEMENTS = (
+    'html', 'head', 'body', 'title', 'meta', 'link', 'script', 'style',
+    'address', 'article', 'aside', 'blockquote', 'dd', 'details', 'dialog',
+    'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav',
+    'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th',
+    'thead', 'tr', 'ul',
+)
+WHITESPACE_RE = re.compile(r'[ \t\n\r\f]+')
 
 
 def get_cls(tag):
@@ -37,6 +63,240 @@ def get_cls(tag):
     return tag.attrs and tag.get('class', []) or []
 
 
+def get_soup(html):
+    """ Parse ``html`` unless it is already a parsed document
+
+    This allows functions that operate on documents to take either HTML
+    source or a soup object. Soup objects are returned as is, so the same tree
+    can be passed through any number of such functions without reparsing it.
+
+    Example::
+
+        >>> soup = get_soup('<p>foo</p>')
+        >>> isinstance(soup, BeautifulSoup)
+        True
+        >>> get_soup(soup) is soup
+        True
+
+    :param html:    String containing the HTML document or soup object
+    :returns:       Soup object
+    """
+    if isinstance(html, BeautifulSoup):
+        return html
+    return BeautifulSoup(html, 'lxml')
+
+
+def soup_transform(fn):
+    """ Decorate a function that transforms the soup object
+
+    The decorated function receives a soup object and should return the
+    transformed soup (which may be the same object it received). When the
+    decorated function is called with HTML source, it is parsed before the
+    transformation and the result is serialized back to string. When it is
+    called with a soup object, the transformed soup object is returned.
+
+    Decorated functions have the ``soup_transform`` attribute set, which tells
+    ``pack.prepare_page()`` that they can be given the soup object. Other
+    preprocessors are given HTML source and are expected to return it.
+
+    Example::
+
+        >>> @soup_transform
+        ... def pp_bold(soup):
+        ...     for tag in soup.find_all('b'):
+        ...         tag.name = 'strong'
+        ...     return soup
+        >>> pp_bold('<b>foo</b>')
+        '<html><body><strong>foo</strong></body></html>'
+        >>> soup = get_soup('<b>foo</b>')
+        >>> pp_bold(soup) is soup
+        True
+        >>> pp_bold.soup_transform
+        True
+
+    :param fn:      Function that takes and returns a soup object
+    :returns:       Decorated function
+    """
+    @functools.wraps(fn)
+    def wrapper(html, *args, **kwargs):
+        if isinstance(html, BeautifulSoup):
+            return fn(html, *args, **kwargs)
+        return str(fn(get_soup(html), *args, **kwargs))
+    wrapper.soup_transform = True
+    return wrapper
+
+
+def start_tag(tag):
+    """ Format the opening tag of an element the way ``str()`` does
+
+    Example::
+
+        >>> soup = get_soup('<p class="a b" title="x &amp; y">foo</p>')
+        >>> start_tag(soup.p)
+        '<p class="a b" title="x &amp; y">'
+
+    :param tag:     Tag object
+    :returns:       Opening tag as string
+    """
+    attrs = []
+    for key, value in FORMATTER.attributes(tag):
+        if value is None:
+            attrs.append(' ' + key)
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(value)
+        elif isinstance(value, AttributeValueWithCharsetSubstitution):
+            value = value.substitute_encoding(OUTPUT_ENCODING)
+        value = FORMATTER.quoted_attribute_value(
+            FORMATTER.attribute_value(value))
+        attrs.append(' %s=%s' % (key, value))
+    prefix = tag.prefix + ':' if tag.prefix else ''
+    close = '/' if tag.is_empty_element else ''
+    return '<%s%s%s%s>' % (prefix, tag.name, ''.join(attrs), close)
+
+
+def is_block(node, parent):
+    """ Whether ``node`` is a block-level element
+
+    A missing sibling (``None``) counts as block-level if ``parent`` is a
+    block-level element or the document itself, since whitespace at the edges
+    of a block is not rendered.
+
+    Example::
+
+        >>> soup = get_soup('<p><span> </span></p>')
+        >>> is_block(None, soup.p), is_block(None, soup.span)
+        (True, False)
+        >>> is_block(soup.span, soup.p)
+        False
+
+    :param node:    Sibling node or ``None``
+    :param parent:  Parent of the sibling
+    :returns:       ``True`` if whitespace next to the sibling is insignificant
+    """
+    if node is None:
+        if parent is None or parent.hidden:
+            return True
+        node = parent
+    return getattr(node, 'name', None) in BLOCK_ELEMENTS
+
+
+def minify_string(node, preserve):
+    """ Return minified text of a string node or ``None`` to drop it
+
+    Comments are dropped, except conditional comments. Whitespace is
+    collapsed outside elements where it is significant, and whitespace-only
+    strings between block-level elements are dropped.
+    """
+    if isinstance(node, Comment):
+        return node.output_ready(FORMATTER) if node.startswith('[if') else None
+    if preserve or type(node) is not NavigableString:
+        return node.output_ready(FORMATTER)
+    text = WHITESPACE_RE.sub(' ', node)
+    if text == ' ' and is_block(node.previous_sibling, node.parent) and \
+            is_block(node.next_sibling, node.parent):
+        return None
+    return node.output_ready(FORMATTER) if text == node else \
+        FORMATTER.substitute(text)
+
+
+def iter_html(soup, minify=False):
+    """ Generate pieces of compact HTML for the document
+
+    The document is walked without recursion, so deeply nested documents do
+    not hit the recursion limit, and no string for the whole document is
+    built. Without ``minify``, the pieces add up to ``str(soup)``.
+
+    :param soup:    Soup object or tag
+    :param minify:  Whether to drop comments and insignificant whitespace
+    :returns:       Generator of strings
+    """
+    stack = [(soup, iter(soup.contents) if soup.hidden else iter((soup,)))]
+    preserve = 0  # number of open elements that preserve whitespace
+    space = False  # whether the last piece was text ending in a space
+    while stack:
+        tag, children = stack[-1]
+        node = next(children, None)
+        if node is None:
+            stack.pop()
+            if stack:
+                if tag.name in PRESERVE_WHITESPACE:
+                    preserve -= 1
+                if not tag.is_empty_element:
+                    space = False
+                    yield '</%s%s>' % (tag.prefix + ':' if tag.prefix else '',
+                                       tag.name)
+            continue
+        if not isinstance(node, NavigableString):
+            space = False
+            yield start_tag(node)
+            if node.name in PRESERVE_WHITESPACE:
+                preserve += 1
+            stack.append((node, iter(node.contents)))
+        elif not minify:
+            yield node.output_ready(FORMATTER)
+        else:
+            text = minify_string(node, preserve)
+            if text and space and text[0] == ' ':
+                text = text[1:]
+            if text:
+                space = not preserve and text[-1] == ' '
+                yield text
+
+
+def write_html(html, out, minify=False):
+    """ Write the document to a text file as compact HTML
+
+    Soup objects are serialized piece by piece and written in chunks of about
+    ``WRITE_SIZE`` characters, so that the serialized document is never held
+    in memory as a whole. Unlike ``soup.prettify()``, no indentation is
+    added. HTML source is written as is, unless it needs to be minified.
+
+    Example::
+
+        >>> out = io.StringIO()
+        >>> soup = get_soup('<p>foo  <!-- x --> <b>bar</b></p>  <p>baz</p>')
+        >>> write_html(soup, out)
+        >>> out.getvalue() == str(soup)
+        True
+        >>> out = io.StringIO()
+        >>> write_html(soup, out, minify=True)
+        >>> out.getvalue()
+        '<html><body><p>foo <b>bar</b></p><p>baz</p></body></html>'
+
+    :param html:    HTML source or soup object
+    :param out:     Text file or other object with a ``write()`` method
+    :param minify:  Whether to drop comments and insignificant whitespace
+    """
+    if not isinstance(html, BeautifulSoup):
+        if not minify:
+            out.write(html)
+            return
+        html = get_soup(html)
+    buff = []
+    size = 0
+    for piece in iter_html(html, minify):
+        buff.append(piece)
+        size += len(piece)
+        if size >= WRITE_SIZE:
+            out.write(''.join(buff))
+            buff = []
+            size = 0
+    out.write(''.join(buff))
+
+
+def to_html(html, minify=False):
+    """ Return the document as compact HTML source
+
+    :param html:    HTML source or soup object
+    :param minify:  Whether to drop comments and insignificant whitespace
+    :returns:       HTML source
+    """
+    out = io.StringIO()
+    write_html(html, out, minify)
+    return out.getvalue()
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,364 @@
+"""
+httpcache.py: on-disk HTTP cache with conditional requests
+
+Responses are stored in a directory that may be shared by any number of
+processes. Each response is stored as two files named after the MD5 checksum
+of the URL: the response body, and a JSON file with validators (ETag and
+Last-Modified) and expiry time. Cached responses are used as is while they are
+fresh, and revalidated using conditional requests afterwards.
+
+The total size of cached bodies is kept under a configurable limit by evicting
+least recently used responses.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import email.utils
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('HTTPCache', 'parse_cache_control', 'get_expiry')
+
+
+MAX_SIZE = 512 * 1024 * 1024  # Maximum size of cached bodies in bytes
+LOW_WATER = 0.9  # Eviction frees space until this fraction of MAX_SIZE
+META_EXT = '.json'
+CACHE_CONTROL_RE = re.compile(r'\s*([\w-]+)\s*(?:=\s*"?([^",]*)"?)?\s*(?:,|$)')
+
+
+def parse_cache_control(value):
+    """ Parse Cache-Control header value into a dict
+
+    Directives without a value are mapped to ``None``.
+
+    Example::
+
+        >>> cc = parse_cache_control('public, max-age="3600", No-Cache')
+        >>> sorted(cc.items())
+        [('max-age', '3600'), ('no-cache', None), ('public', None)]
+        >>> parse_cache_control('')
+        {}
+
+    :param value:   Header value
+    :returns:       Dict of directives
+    """
+    return dict((name.lower(), arg or None)
+                for name, arg in CACHE_CONTROL_RE.findall(value or ''))
+
+
+def parse_date(value):
+    """ Parse HTTP date into a timestamp
+
+    Example::
+
+        >>> parse_date('Thu, 01 Jan 1970 00:01:00 GMT')
+        60.0
+        >>> parse_date('garbage') is None
+        True
+
+    :param value:   Header value
+    :returns:       Timestamp or ``None`` if value is not a valid date
+    """
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def get_expiry(headers, now=None):
+    """ Calculate the time until which a response is fresh
+
+    Returns ``None`` if the response must not be stored at all. If it may be
+    stored but has to be revalidated before each use, returns 0.
+
+    Example::
+
+        >>> get_expiry({'Cache-Control': 'max-age=60'}, now=100)
+        160
+        >>> get_expiry({'Cache-Control': 'max-age=60', 'Age': '10'}, now=100)
+        150
+        >>> get_expiry({'Cache-Control': 'no-cache, max-age=60'}, now=100)
+        0
+        >>> get_expiry({'Cache-Control': 'no-store'}, now=100) is None
+        True
+        >>> get_expiry({'Date': 'Thu, 01 Jan 1970 00:01:00 GMT',
+        ...             'Expires': 'Thu, 01 Jan 1970 00:02:00 GMT'}, now=100)
+        160.0
+        >>> get_expiry({'Expires': '0'}, now=100)
+        0
+        >>> get_expiry({}, now=100)
+        0
+
+    :param headers: Response headers (dict-like object)
+    :param now:     Current timestamp (defaults to ``time.time()``)
+    :returns:       Expiry timestamp, 0, or ``None``
+    """
+    if now is None:
+        now = time.time()
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cc or headers.get('Vary', '').strip() == '*':
+        return None
+    if 'no-cache' in cc:
+        return 0
+    if (cc.get('max-age') or '').isdigit():
+        age = headers.get('Age', '0')
+        age = int(age) if age.isdigit() else 0
+        return now + int(cc['max-age']) - age
+    expires = parse_date(headers.get('Expires'))
+    if expires is None:
+        return 0
+    # Expires is relative to server's clock
+    date = parse_date(headers.get('Date')) or now
+    return max(now + expires - date, 0)
+
+
+class HTTPCache(object):
+    """ On-disk HTTP cache
+
+    The cache is used by ``artexin.session.Session`` when configured using
+    ``artexin.session.set_cache()``.
+
+    :param path:        Directory in which to store responses
+    :param max_size:    Maximum total size of stored response bodies
+    """
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.size = None  # approximate total size, calculated on first store
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        # Caches are passed to worker processes, but locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def paths(self, url):
+        """ Return paths of the body and metadata files for ``url`` """
+        key = hashlib.md5(url.encode('utf-8')).hexdigest()
+        body_path = os.path.join(self.path, key)
+        return body_path, body_path + META_EXT
+
+    def get(self, url):
+        """ Return metadata of a stored response or ``None``
+
+        :param url:     URL of the response
+        :returns:       Dict containing ``etag``, ``last_modified`` and
+                        ``expires`` keys, or ``None`` if not stored
+        """
+        body_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(body_path):
+            return None
+        return meta
+
+    def read(self, url):
+        """ Read a stored response body and mark it as recently used
+
+        :param url:     URL of the response
+        :returns:       Body as bytestring or ``None`` if not stored
+        """
+        body_path = self.paths(url)[0]
+        try:
+            with open(body_path, 'rb') as body_file:
+                content = body_file.read()
+            os.utime(body_path)
+        except OSError:
+            # Evicted by another process in the meantime
+            return None
+        return content
+
+    def is_fresh(self, meta, now=None):
+        """ Whether stored response can be used without revalidation """
+        return meta['expires'] > (now or time.time())
+
+    def validators(self, meta):
+        """ Return conditional request headers for a stored response
+
+        Example::
+
+            >>> cache = HTTPCache(tempfile.mkdtemp())
+            >>> cache.validators({'etag': '"abc"', 'last_modified': None})
+            {'If-None-Match': '"abc"'}
+
+        :param meta:    Metadata returned by ``get()``
+        :returns:       Dict of request headers
+        """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def write_file(self, path, data, mode='wb'):
+        """ Atomically write ``data`` to ``path`` """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with open(fd, mode) as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def write_meta(self, url, headers, expires):
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'expires': expires}
+        self.write_file(self.paths(url)[1], json.dumps(meta), 'w')
+
+    def store(self, url, headers, content):
+        """ Store a response if it is cacheable
+
+        Responses that can be neither used while fresh nor revalidated are
+        not stored.
+
+        :param url:     URL of the response
+        :param headers: Response headers
+        :param content: Response body as bytestring
+        :returns:       ``True`` if response was stored
+        """
+        expires = get_expiry(headers)
+        if expires is None:
+            return False
+        if not expires and not (headers.get('ETag') or
+                                headers.get('Last-Modified')):
+            return False
+        if len(content) > self.max_size:
+            return False
+        body_path = self.paths(url)[0]
+        try:
+            replaced_size = os.path.getsize(body_path)
+        except OSError:
+            replaced_size = 0
+        self.write_file(body_path, content)
+        self.write_meta(url, headers, expires)
+        with self.lock:
+            if self.size is None:
+                self.size = self.total_size()
+            else:
+                self.size += len(content) - replaced_size
+            if self.size > self.max_size:
+                self.evict()
+        return True
+
+    def refresh(self, url, meta, headers):
+        """ Update stored response after successful revalidation
+
+        :param url:     URL of the response
+        :param meta:    Metadata returned by ``get()``
+        :param headers: Headers of the 304 response
+        """
+        expires = get_expiry(headers)
+        if expires is None:
+            expires = 0
+        self.write_meta(url, {'ETag': headers.get('ETag') or meta['etag'],
+                              'Last-Modified': (headers.get('Last-Modified') or
+                                                meta['last_modified'])},
+                        expires)
+
+    def entries(self):
+        """ Return list of (last use, size, body path) for all bodies """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(META_EXT) or name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size,
+                            os.path.join(self.path, name)))
+        return entries
+
+    def total_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Remove least recently used responses to free up space
+
+        Responses are removed until the total size drops below ``LOW_WATER``
+        fraction of the maximum size, so that eviction does not have to be
+        performed on every store.
+        """
+        entries = sorted(self.entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_size * LOW_WATER
+        for _, entry_size, body_path in entries:
+            if size <= target:
+                break
+            for path in (body_path, body_path + META_EXT):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            size -= entry_size
+        logging.debug('Evicted HTTP cache entries down to %s bytes', size)
+        self.size = size
+
+    def fetch(self, session, url, timeout=None):
+        """ Fetch ``url`` using ``session``, using the cache where possible
+
+        Fresh responses are read from the cache without a request. Stale
+        responses are revalidated using a conditional request, and read from
+        the cache if the server responds with 304 Not Modified.
+
+        :param session: ``artexin.session.Session`` instance
+        :param url:     URL to fetch
+        :param timeout: Connect and read timeout in seconds
+        :returns:       Response body as bytestring
+        """
+        meta = self.get(url)
+        if meta is not None and self.is_fresh(meta):
+            content = self.read(url)
+            if content is not None:
+                return content
+        headers = self.validators(meta) if meta else None
+        resp = session.request(url, timeout=timeout, headers=headers)
+        if resp.status == 304 and meta is not None:
+            content = self.read(url)
+            if content is not None:
+                self.refresh(url, meta, resp.headers)
+                return content
+            # Evicted while revalidating, so fetch unconditionally
+            resp = session.request(url, timeout=timeout)
+        content = resp.data
+        if resp.status == 200:
+            self.store(url, resp.headers, content)
+        return content
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
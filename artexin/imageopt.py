@@ -0,0 +1,217 @@
+"""
+imageopt.py: reduce the size of downloaded images
+
+Images are downscaled to a maximum dimension, re-encoded with a target
+quality, and stripped of metadata (EXIF, comments, color profiles, etc.).
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import logging
+import os
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('optimize_image', 'optimize_images')
+
+
+MAX_DIMENSION = 1024  # Maximum width or height of images in pixels
+QUALITY = 75  # JPEG quality
+WORKERS = os.cpu_count() or 1  # Number of images optimized concurrently
+# Formats that are re-encoded in the same format, others are converted to PNG
+KEEP_FORMATS = ('JPEG', 'PNG', 'GIF')
+ORIENTATION = 0x0112  # EXIF orientation tag
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+}
+
+
+def get_target_format(img, fmt=None):
+    """ Return format in which the image should be saved
+
+    Images with transparency are never converted to JPEG.
+
+    Example::
+
+        >>> get_target_format(Image.new('RGB', (1, 1)), 'JPEG')
+        'JPEG'
+        >>> get_target_format(Image.new('RGBA', (1, 1)), 'JPEG')
+        'PNG'
+
+    :param img:     Image object
+    :param fmt:     Requested format or ``None`` to keep the current one
+    :returns:       Format name
+    """
+    fmt = fmt or img.format
+    if fmt not in KEEP_FORMATS:
+        return 'PNG'
+    if fmt == 'JPEG' and (img.mode in ('RGBA', 'LA') or
+                          'transparency' in img.info):
+        return 'PNG'
+    return fmt
+
+
+def save_options(img, fmt, quality):
+    """ Convert image for saving in ``fmt`` and return it with save options
+
+    :param img:     Image object
+    :param fmt:     Target format
+    :param quality: JPEG quality
+    :returns:       Two-tuple of converted image and dict of save options
+    """
+    if fmt == 'JPEG':
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img, {'quality': quality, 'optimize': True,
+                     'progressive': True}
+    if fmt == 'PNG':
+        if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        return img, {'optimize': True}
+    return img, {}
+
+
+def optimize_image(path, max_dimension=MAX_DIMENSION, quality=QUALITY,
+                   fmt=None):
+    """ Downscale and re-encode the image at ``path``
+
+    The optimized image is written to a new file, and it replaces the original
+    image only if it is smaller or had to be downscaled or rotated according
+    to its EXIF orientation. If the format changes, the image file extension
+    changes accordingly. The original file is never modified in place, so it
+    is safe to optimize images that are hard links to blobs in
+    ``artexin.imagestore``.
+
+    Animated images are left as they are.
+
+    Example::
+
+        >>> path = os.path.join(tempfile.mkdtemp(), 'image0000.bmp')
+        >>> Image.new('RGB', (2000, 1000), 'red').save(path, 'BMP')
+        >>> new_path, before, after = optimize_image(path, fmt='JPEG')
+        >>> os.path.basename(new_path), before > after
+        ('image0000.jpg', True)
+        >>> Image.open(new_path).size
+        (1024, 512)
+        >>> os.path.exists(path)
+        False
+
+    :param path:            Path of the image
+    :param max_dimension:   Maximum width and height
+    :param quality:         JPEG quality
+    :param fmt:             Target format (``None`` keeps the current format
+                            if it is in ``KEEP_FORMATS``)
+    :returns:               Three-tuple containing path of the image, and its
+                            sizes before and after optimization
+    """
+    size = os.stat(path).st_size
+    with Image.open(path) as img:
+        if getattr(img, 'n_frames', 1) > 1:
+            return path, size, size
+        img.load()
+    original_format = img.format
+    target = get_target_format(img, fmt)
+    # Orientation is stored in EXIF data, which is not saved, so the pixels
+    # are rotated instead.
+    transposed = img.getexif().get(ORIENTATION, 1) != 1
+    img = ImageOps.exif_transpose(img)
+    resized = max(img.size) > max_dimension
+    if resized:
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    img, options = save_options(img, target, quality)
+
+    # Metadata is only written when passed to ``save()`` explicitly, so
+    # images are saved without it.
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            img.save(f, target, **options)
+        new_size = os.stat(tmp_path).st_size
+        converted = target != original_format
+        changed = resized or converted or transposed
+        if new_size >= size and not changed:
+            os.unlink(tmp_path)
+            return path, size, size
+        new_path = os.path.splitext(path)[0] + EXTENSIONS[target]
+        os.replace(tmp_path, new_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if new_path != path:
+        os.unlink(path)
+    return new_path, size, new_size
+
+
+def optimize_or_keep(path, options):
+    """ Optimize the image, keeping the original if optimization fails """
+    try:
+        return optimize_image(path, **options)
+    except Exception:
+        logging.exception('Error while optimizing %s', path)
+        size = os.stat(path).st_size
+        return path, size, size
+
+
+def optimize_images(paths, workers=None, executor=None, **options):
+    """ Optimize images concurrently
+
+    Pillow releases the GIL while resizing and encoding images, so images are
+    optimized on multiple cores by a pool of threads. A different executor
+    (e.g., a process pool) may be passed in using ``executor``.
+
+    ``None`` in ``paths`` are passed through. Images that cannot be optimized
+    are kept as they are.
+
+    Example::
+
+        >>> paths, stats = optimize_images([None])
+        >>> paths, stats['optimized_bytes']
+        ([None], 0)
+
+    :param paths:       List of image paths
+    :param workers:     Number of threads (defaults to ``WORKERS``)
+    :param executor:    Executor used instead of a thread pool
+    :param **options:   Keyword arguments for ``optimize_image()``
+    :returns:           Two-tuple of list of new image paths, and dict of
+                        statistics (``original_bytes``, ``optimized_bytes``,
+                        and ``optimize_time`` in seconds)
+    """
+    start = time.time()
+    todo = [path for path in paths if path is not None]
+    if not todo:
+        results = []
+    elif executor is not None:
+        results = list(executor.map(optimize_or_keep, todo,
+                                    [options] * len(todo)))
+    else:
+        workers = min(workers or WORKERS, len(todo))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(optimize_or_keep, todo,
+                                    [options] * len(todo)))
+    new_paths = dict((path, result[0]) for path, result in zip(todo, results))
+    stats = {'original_bytes': sum(r[1] for r in results),
+             'optimized_bytes': sum(r[2] for r in results),
+             'optimize_time': round(time.time() - start, 3) if todo else 0.0}
+    return [new_paths.get(path) for path in paths], stats
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,248 @@
+"""
+imagestore.py: content-addressed store for downloaded images
+
+The same images (logos, avatars, agency photos) appear in many pages. The
+image store keeps every image that was downloaded once, so that it does not
+have to be downloaded and verified again for each page that uses it.
+
+Images are stored as blobs named after the SHA-256 checksum of their content,
+so identical images found at different URLs are only stored once. A separate
+index maps each URL to the checksum of the image found there. Both are plain
+files written atomically, so the store can be shared by any number of
+processes (e.g., batch workers).
+
+Blobs that were sent to receivers as part of a package are marked as
+published. Packages only reference published blobs instead of including them
+(see ``artexin.pack.find_shared()``), since only those are known to exist on
+the receiving end.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('ImageStore', 'get_store', 'set_store')
+
+
+BLOB_DIR = 'blobs'
+INDEX_DIR = 'urls'
+PUBLISHED_DIR = 'published'
+CHUNK_SIZE = 64 * 1024
+
+_store = None  # image store used by ``fetch.fetch_image()``
+_store_lock = threading.Lock()
+
+
+def file_digest(path):
+    """ Return SHA-256 checksum of the file at ``path``
+
+    :param path:    Path of the file
+    :returns:       Hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ImageStore(object):
+    """ Content-addressed image store
+
+    Example::
+
+        >>> store = ImageStore(tempfile.mkdtemp())
+        >>> entry = store.add('http://example.com/a.png', b'PNG data', 'PNG',
+        ...                   '.png')
+        >>> entry['digest'][:8]
+        'e0aca812'
+        >>> store.lookup('http://example.com/a.png') == entry
+        True
+        >>> store.lookup('http://example.com/b.png') is None
+        True
+        >>> imgdir = tempfile.mkdtemp()
+        >>> fmt, path = store.export(entry, os.path.join(imgdir, 'image0000'))
+        >>> fmt, os.path.basename(path)
+        ('PNG', 'image0000.png')
+
+    :param path:        Directory in which to store images
+    :param max_age:     Number of seconds after which URLs are looked up again
+                        (``None`` means URLs are never looked up again)
+    """
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(os.path.join(path, BLOB_DIR), exist_ok=True)
+        os.makedirs(os.path.join(path, INDEX_DIR), exist_ok=True)
+        os.makedirs(os.path.join(path, PUBLISHED_DIR), exist_ok=True)
+
+    def index_path(self, url):
+        """ Return path of the index file for ``url`` """
+        key = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, INDEX_DIR, key + '.json')
+
+    def blob_path(self, digest, ext=''):
+        """ Return path of the blob with given checksum and extension """
+        return os.path.join(self.path, BLOB_DIR, digest[:2], digest + ext)
+
+    def published_path(self, digest):
+        """ Return path of the marker for a published blob """
+        return os.path.join(self.path, PUBLISHED_DIR, digest)
+
+    def write_file(self, path, data, mode='wb'):
+        """ Atomically write ``data`` to ``path`` """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with open(fd, mode) as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def lookup(self, url):
+        """ Return the index entry for ``url`` or ``None``
+
+        :param url:     Image URL
+        :returns:       Dict containing ``url``, ``digest``, ``format``,
+                        ``ext``, and ``time`` keys, or ``None`` if the image
+                        at ``url`` is not stored
+        """
+        try:
+            with open(self.index_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        if self.max_age is not None and \
+                entry['time'] + self.max_age < time.time():
+            return None
+        if not os.path.exists(self.blob(entry)):
+            return None
+        return entry
+
+    def blob(self, entry):
+        """ Return path of the blob for an index entry """
+        return self.blob_path(entry['digest'], entry['ext'])
+
+    def add(self, url, content, fmt, ext):
+        """ Store verified image content found at ``url``
+
+        The blob is only written if no image with the same content is stored
+        yet.
+
+        :param url:     Image URL
+        :param content: Image content as bytestring
+        :param fmt:     Image format
+        :param ext:     File extension for the format
+        :returns:       Index entry (see ``lookup()``)
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        entry = {'url': url,
+                 'digest': digest,
+                 'format': fmt,
+                 'ext': ext,
+                 'time': time.time()}
+        blob_path = self.blob(entry)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            self.write_file(blob_path, content)
+        self.write_file(self.index_path(url), json.dumps(entry), 'w')
+        return entry
+
+    def export(self, entry, path):
+        """ Place a copy of the stored image at ``path``
+
+        The copy is a hard link to the blob where possible, so it should not
+        be modified in place.
+
+        :param entry:   Index entry (see ``lookup()``)
+        :param path:    Image path without extension
+        :returns:       Tuple containing image format and full image path
+        """
+        full_path = path + entry['ext']
+        blob_path = self.blob(entry)
+        try:
+            os.link(blob_path, full_path)
+        except OSError:
+            # Different filesystem, or the target already exists
+            shutil.copyfile(blob_path, full_path)
+        return entry['format'], full_path
+
+    def find(self, path):
+        """ Return checksum of the image at ``path`` if it is stored
+
+        :param path:    Path of the image file
+        :returns:       Hex digest or ``None`` if there is no such blob
+        """
+        digest = file_digest(path)
+        ext = os.path.splitext(path)[1]
+        if os.path.exists(self.blob_path(digest, ext)):
+            return digest
+        return None
+
+    def publish(self, digest):
+        """ Mark the blob with given checksum as sent to receivers
+
+        Example::
+
+            >>> store = ImageStore(tempfile.mkdtemp())
+            >>> store.is_published('e0aca812')
+            False
+            >>> store.publish('e0aca812')
+            >>> store.is_published('e0aca812')
+            True
+
+        :param digest:  Hex digest of the blob
+        """
+        path = self.published_path(digest)
+        if not os.path.exists(path):
+            self.write_file(path, b'')
+
+    def is_published(self, digest):
+        """ Whether the blob with given checksum was sent to receivers """
+        return os.path.exists(self.published_path(digest))
+
+
+def get_store():
+    """ Return the image store used when fetching images or ``None`` """
+    return _store
+
+
+def set_store(store):
+    """ Set the image store used when fetching images
+
+    The store is used by the current process, as well as worker processes
+    started afterwards. Pass ``None`` to disable the store.
+
+    :param store:   ``ImageStore`` instance or ``None``
+    """
+    global _store
+    with _store_lock:
+        _store = store
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -8,8 +8,16 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import functools
+import heapq
+import os
 import re
 
+from array import array
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                as_completed, wait)
+from itertools import chain, groupby, islice
+
 import nltk
 
 from . import __version__ as _version, __author__ as _author
@@ -17,11 +25,17 @@ from . import __version__ as _version, __author__ as _author
 
 __version__ = _version
 __author__ = _author
-__all__ = ('split_sentences', 'split_words', 'get_counts')
+__all__ = ('split_sentences', 'split_words', 'get_counts',
+           'tokenize_documents', 'count_shard', 'merge_runs',
+           'iter_shard_counts', 'get_corpus_counts', 'CompactCounts')
 
 
 WSRE = re.compile(r'\s+')
 NONWORD_RE = re.compile(r'^\W+$')
+TDATA = 'nltkdata/tokenizers/punkt/english.pickle'
+SHARD_SIZE = 50  # Number of documents counted by a worker at a time
+SHARDS_AHEAD = 2  # Number of shards per process read ahead of completion
+PAIR_SHIFT = 32  # Pair keys are ``(term1 ID << PAIR_SHIFT) | term2 ID``
 
 
 def fix_ws(s):
@@ -83,7 +97,30 @@ def is_word(t):
     return NONWORD_RE.match(t) is None
 
 
-def split_sentences(t, tdata='nltkdata/tokenizers/punkt/english.pickle'):
+@functools.lru_cache(maxsize=None)
+def get_sentence_tokenizer(tdata=TDATA):
+    """ Return sentence tokenizer for given tokenizer data file
+
+    Tokenizers are created once per process for each data file.
+
+    Example::
+
+        >>> get_sentence_tokenizer() is get_sentence_tokenizer()
+        True
+
+    :param tdata:   tokenizer data file path
+    :returns:       ``PunktSentenceTokenizer`` instance
+    """
+    return nltk.tokenize.punkt.PunktSentenceTokenizer(tdata)
+
+
+@functools.lru_cache(maxsize=None)
+def get_word_tokenizer():
+    """ Return word tokenizer, created once per process """
+    return nltk.tokenize.TreebankWordTokenizer()
+
+
+def split_sentences(t, tdata=TDATA):
     """ Split text ``t`` into sentences
 
     Optional tokenizer data file can be specified. Default is
@@ -100,11 +137,11 @@ def split_sentences(t, tdata='nltkdata/tokenizers/punkt/english.pickle'):
     :param tdata:   tokenizer data file path
     :returns:       iterator of all sentences
     """
-    tokenizer = nltk.tokenize.punkt.PunktSentenceTokenizer(tdata)
+    tokenizer = get_sentence_tokenizer(tdata)
     return (fix_ws(s) for s in tokenizer.tokenize(t))
 
 
-def split_words(t, tdata='nltkdata/tokenizers/punkt/english.pickle'):
+def split_words(t, tdata=TDATA):
     """ Splits text ``t`` into words
 
     Example::
@@ -116,11 +153,30 @@ def split_words(t, tdata='nltkdata/tokenizers/punkt/english.pickle'):
     :param tdata:   tokenizer data file path
     :returns:       iterator of all words
     """
-    tokenizer = nltk.tokenize.TreebankWordTokenizer()
-    tokens = tokenizer.tokenize(t)
+    tokens = get_word_tokenizer().tokenize(t)
     return (strip_period(w) for w in tokens if is_word(w))
 
 
+def tokenize_documents(texts, tdata=TDATA):
+    """ Split many texts into sentences and words in one call
+
+    Example::
+
+        >>> tokenize_documents(['One sentence. Two words.', 'Three.'])
+        [[['One', 'sentence'], ['Two', 'words']], [['Three']]]
+
+    :param texts:   iterable of source texts
+    :param tdata:   tokenizer data file path
+    :returns:       list containing a list of sentences for each text, where
+                    each sentence is a list of words
+    """
+    sent_tokenize = get_sentence_tokenizer(tdata).tokenize
+    word_tokenize = get_word_tokenizer().tokenize
+    return [[[strip_period(w) for w in word_tokenize(fix_ws(s)) if is_word(w)]
+             for s in sent_tokenize(t)]
+            for t in texts]
+
+
 def get_counts(sentences):
     """ Obtain term and term-pair counts from sentences iterable
 
@@ -182,6 +238,9 @@ def get_counts(sentences):
         >>> pc.get('the events', 0)
         3
 
+    Sentences may also be given as lists of words, as returned by
+    ``tokenize_documents()``.
+
     :parm sentences:    iterable containing sentences
     :returns:           tuple of term, term-pair, and word counts
     """
@@ -191,7 +250,11 @@ def get_counts(sentences):
 
     for sentence in sentences:
         pterm = None  # previously seen terms
-        for term in split_words(sentence):
+        if isinstance(sentence, list):
+            words = sentence
+        else:
+            words = split_words(sentence)
+        for term in words:
             term = term.lower()
             word_count += 1
             term_counts.setdefault(term, 0)
@@ -204,6 +267,253 @@ def get_counts(sentences):
     return term_counts, pair_counts, word_count
 
 
+class CompactCounts(object):
+    """ Term and term-pair counts with terms interned to integer IDs
+
+    This is a compact alternative to the dicts returned by ``get_counts()``.
+    Each distinct term is stored once and assigned an integer ID. Term counts
+    are kept in an array indexed by term ID, and term pairs are keyed by the
+    two IDs packed into a single integer, so no string is created for a pair.
+
+    Example::
+
+        >>> counts = CompactCounts()
+        >>> counts.add_sentences(split_sentences('Foo bar. Foo bar baz.'))
+        >>> counts.count('foo'), counts.pair_count('foo', 'bar')
+        (2, 2)
+        >>> counts.word_count
+        5
+        >>> tc, pc, wc = counts.to_dicts()
+        >>> sorted(pc.items())
+        [('bar baz', 1), ('foo bar', 2)]
+        >>> CompactCounts.from_dicts(tc, pc, wc).to_dicts() == (tc, pc, wc)
+        True
+    """
+
+    def __init__(self):
+        self.ids = {}  # term -> ID
+        self.terms = []  # ID -> term
+        self.term_counts = array('Q')  # ID -> count
+        self.pair_counts = {}  # packed IDs -> count
+        self.word_count = 0
+
+    def term_id(self, term):
+        """ Return ID of ``term``, assigning a new one if necessary """
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+            self.term_counts.append(0)
+        return tid
+
+    def add_words(self, words):
+        """ Count words of a single sentence
+
+        :param words:   iterable of words
+        """
+        ids = self.ids
+        term_counts = self.term_counts
+        pair_counts = self.pair_counts
+        pid = None  # ID of previously seen term
+        nwords = 0
+        for term in words:
+            term = term.lower()
+            tid = ids.get(term)
+            if tid is None:
+                tid = self.term_id(term)
+            nwords += 1
+            term_counts[tid] += 1
+            if pid is not None:
+                key = (pid << PAIR_SHIFT) | tid
+                pair_counts[key] = pair_counts.get(key, 0) + 1
+            pid = tid
+        self.word_count += nwords
+
+    def add_sentences(self, sentences):
+        """ Count words in sentences
+
+        :param sentences:   iterable containing sentences (strings or lists
+                            of words, same as for ``get_counts()``)
+        """
+        for sentence in sentences:
+            if not isinstance(sentence, list):
+                sentence = split_words(sentence)
+            self.add_words(sentence)
+
+    def count(self, term):
+        """ Return number of occurrences of ``term`` """
+        tid = self.ids.get(term)
+        return 0 if tid is None else self.term_counts[tid]
+
+    def pair_count(self, term1, term2):
+        """ Return number of occurrences of the term pair """
+        id1 = self.ids.get(term1)
+        id2 = self.ids.get(term2)
+        if id1 is None or id2 is None:
+            return 0
+        return self.pair_counts.get((id1 << PAIR_SHIFT) | id2, 0)
+
+    def unpack_pair(self, key):
+        """ Return the two terms of a packed pair key """
+        return (self.terms[key >> PAIR_SHIFT],
+                self.terms[key & ((1 << PAIR_SHIFT) - 1)])
+
+    def to_dicts(self):
+        """ Return counts in the format used by ``get_counts()``
+
+        :returns:   tuple of term, term-pair, and word counts
+        """
+        term_counts = dict((term, self.term_counts[tid])
+                           for tid, term in enumerate(self.terms))
+        pair_counts = dict(('%s %s' % self.unpack_pair(key), count)
+                           for key, count in self.pair_counts.items())
+        return term_counts, pair_counts, self.word_count
+
+    @classmethod
+    def from_dicts(cls, term_counts, pair_counts, word_count):
+        """ Create compact counts from the output of ``get_counts()``
+
+        :param term_counts: dict of term counts
+        :param pair_counts: dict of term-pair counts
+        :param word_count:  number of words
+        :returns:           ``CompactCounts`` instance
+        """
+        counts = cls()
+        for term, count in term_counts.items():
+            counts.term_counts[counts.term_id(term)] = count
+        for pair, count in pair_counts.items():
+            term1, term2 = pair.split(' ', 1)
+            key = (counts.term_id(term1) << PAIR_SHIFT) | counts.term_id(term2)
+            counts.pair_counts[key] = count
+        counts.word_count = word_count
+        return counts
+
+
+def count_shard(texts, tdata=TDATA):
+    """ Obtain term and term-pair counts for a number of documents
+
+    Counts are returned as runs of (key, count) sorted by key, which can be
+    merged with runs from other shards using ``merge_runs()``.
+
+    Example::
+
+        >>> terms, pairs, wc = count_shard(['Foo bar.', 'Bar baz.'])
+        >>> terms
+        [('bar', 2), ('baz', 1), ('foo', 1)]
+        >>> pairs
+        [('bar baz', 1), ('foo bar', 1)]
+        >>> wc
+        4
+
+    :param texts:   iterable of source texts
+    :param tdata:   tokenizer data file path
+    :returns:       tuple of sorted term counts, sorted term-pair counts, and
+                    word count
+    """
+    # Pairs do not span sentences, so all sentences can be counted together
+    sentences = chain.from_iterable(tokenize_documents(texts, tdata))
+    term_counts, pair_counts, word_count = get_counts(sentences)
+    return sorted(term_counts.items()), sorted(pair_counts.items()), word_count
+
+
+def merge_runs(runs):
+    """ Merge sorted runs of (key, count), adding up counts of equal keys
+
+    Example::
+
+        >>> list(merge_runs([[('a', 1), ('c', 2)], [('a', 3), ('b', 1)]]))
+        [('a', 4), ('b', 1), ('c', 2)]
+
+    :param runs:    iterable of runs sorted by key
+    :returns:       iterator of (key, count) sorted by key
+    """
+    merged = heapq.merge(*runs)
+    for key, group in groupby(merged, key=lambda item: item[0]):
+        yield key, sum(count for _, count in group)
+
+
+def shards(texts, size):
+    """ Split iterable of texts into lists of at most ``size`` texts """
+    texts = iter(texts)
+    while True:
+        shard = list(islice(texts, size))
+        if not shard:
+            return
+        yield shard
+
+
+def iter_shard_counts(texts, processes=None, shard_size=SHARD_SIZE,
+                      tdata=TDATA):
+    """ Count shards of ``texts`` and yield results as they become available
+
+    Shards are read from ``texts`` only as workers become available, with at
+    most ``SHARDS_AHEAD`` shards per process waiting to be counted, so
+    ``texts`` can be a generator over a corpus of any size.
+
+    :param texts:       iterable of source texts
+    :param processes:   number of processes (defaults to number of CPUs, and
+                        1 means counting in the current process)
+    :param shard_size:  number of documents in a shard
+    :param tdata:       tokenizer data file path
+    :returns:           iterator of ``count_shard()`` results in order of
+                        completion
+    """
+    if processes == 1:
+        for shard in shards(texts, shard_size):
+            yield count_shard(shard, tdata)
+        return
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as pool:
+        pending = set()
+        for shard in shards(texts, shard_size):
+            pending.add(pool.submit(count_shard, shard, tdata))
+            if len(pending) > processes * SHARDS_AHEAD:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def get_corpus_counts(texts, processes=None, shard_size=SHARD_SIZE,
+                      tdata=TDATA):
+    """ Obtain term and term-pair counts for a corpus using many processes
+
+    Texts are split into shards of ``shard_size`` documents, which are
+    counted in a pool of ``processes`` processes (see
+    ``iter_shard_counts()``). The counts of each shard are added to the
+    totals as soon as the shard is counted, so only the totals and the
+    shards in flight are held in memory.
+
+    The result is the same as that of ``get_counts()`` for all sentences in
+    all texts.
+
+    Example::
+
+        >>> tc, pc, wc = get_corpus_counts(['Foo bar.', 'Bar baz.'],
+        ...                                processes=1)
+        >>> tc['bar'], pc['foo bar'], wc
+        (2, 1, 4)
+
+    :param texts:       iterable of source texts
+    :param processes:   number of processes (defaults to number of CPUs, and
+                        1 means counting in the current process)
+    :param shard_size:  number of documents in a shard
+    :param tdata:       tokenizer data file path
+    :returns:           tuple of term, term-pair, and word counts
+    """
+    term_counts = {}
+    pair_counts = {}
+    word_count = 0
+    for terms, pairs, count in iter_shard_counts(texts, processes,
+                                                 shard_size, tdata):
+        for totals, run in ((term_counts, terms), (pair_counts, pairs)):
+            for key, n in run:
+                totals[key] = totals.get(key, 0) + n
+        word_count += count
+    return term_counts, pair_counts, word_count
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
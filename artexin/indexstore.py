@@ -0,0 +1,529 @@
+"""
+indexstore.py: persistent inverted index of term and term-pair counts
+
+Term and term-pair counts obtained using ``artexin.index.get_counts()`` are
+added to the index one document at a time. Documents are buffered in memory
+and written out as immutable segments. Each segment contains a sorted lexicon
+of terms and pairs, and a postings list of (document number, count) for each
+of them. Segments are memory-mapped when reading, and lexicon lookups use
+binary search, so looking up a term does not require loading the index into
+memory.
+
+Segment file layout (all integers are in native byte order)::
+
+    header          magic, number of keys, size of the key data
+    key offsets     (n + 1) x uint64, offsets of keys within the key data
+    post offsets    (n + 1) x uint64, offsets of postings of each key
+    key data        UTF-8 encoded keys, padded to 8 bytes
+    postings        (document number, count) x uint32 pairs
+
+The index is meant to be written by a single process at a time.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import collections
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import __version__ as _version, __author__ as _author
+from .index import (split_sentences, get_counts, tokenize_documents, shards,
+                    SHARD_SIZE, SHARDS_AHEAD, TDATA)
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('IndexStore', 'Segment', 'write_segment')
+
+
+MAGIC = b'AXIX'
+HEADER = struct.Struct('=4sIQ')
+HEADER_SIZE = 16  # ``HEADER.size`` rounded up to 8 bytes
+FLUSH_DOCS = 1000  # Number of buffered documents that triggers a flush
+SPILL_SIZE = 65536  # Number of offsets buffered before they are written out
+META_FILE = 'index.json'
+DOCS_FILE = 'docs.tsv'
+
+
+def pad8(n):
+    """ Round ``n`` up to a multiple of 8 """
+    return (n + 7) & ~7
+
+
+def write_segment(path, items):
+    """ Write a segment containing ``items`` to ``path``
+
+    Example::
+
+        >>> path = os.path.join(tempfile.mkdtemp(), 'seg')
+        >>> write_segment(path, [('bar', [(0, 2)]), ('foo', [(0, 1), (1, 3)])])
+        >>> seg = Segment(path)
+        >>> seg.postings('foo')
+        [(0, 1), (1, 3)]
+        >>> seg.postings('baz')
+        []
+        >>> seg.close()
+
+    Items are consumed one at a time. Each part of the segment is written to
+    a temporary file as it is produced, and the parts are joined once all
+    items are written, so ``items`` can be a generator over an index of any
+    size.
+
+    :param path:    Path of the segment file
+    :param items:   Iterable of (key, postings) sorted by key, where postings
+                    is a list of (document number, count) tuples sorted by
+                    document number
+    """
+    dirname = os.path.dirname(path)
+    # Key offsets, postings offsets, key data, and postings
+    parts = [tempfile.TemporaryFile(dir=dirname) for _ in range(4)]
+    key_offsets_file, post_offsets_file, keys_file, postings_file = parts
+    key_offsets = array('Q', [0])
+    post_offsets = array('Q', [0])
+    nkeys = keys_size = nposts = 0
+    try:
+        for key, posts in items:
+            key = key.encode('utf-8')
+            keys_file.write(key)
+            keys_size += len(key)
+            key_offsets.append(keys_size)
+            postings = array('I')
+            for docnum, count in posts:
+                postings.append(docnum)
+                postings.append(count)
+            postings.tofile(postings_file)
+            nposts += len(postings) // 2
+            post_offsets.append(nposts)
+            nkeys += 1
+            if len(key_offsets) >= SPILL_SIZE:
+                key_offsets.tofile(key_offsets_file)
+                post_offsets.tofile(post_offsets_file)
+                del key_offsets[:], post_offsets[:]
+        key_offsets.tofile(key_offsets_file)
+        post_offsets.tofile(post_offsets_file)
+        keys_file.write(b'\0' * (pad8(keys_size) - keys_size))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, nkeys, pad8(keys_size)).ljust(
+                    HEADER_SIZE, b'\0'))
+                for part in parts:
+                    part.seek(0)
+                    shutil.copyfileobj(part, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    finally:
+        for part in parts:
+            part.close()
+
+
+class Segment(object):
+    """ Memory-mapped read-only index segment
+
+    :param path:    Path of the segment file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nkeys, keys_size = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError('%s is not an index segment' % path)
+        view = memoryview(self.mm)
+        offsets_size = (self.nkeys + 1) * 8
+        start = HEADER_SIZE
+        self.key_offsets = view[start:start + offsets_size].cast('Q')
+        start += offsets_size
+        self.post_offsets = view[start:start + offsets_size].cast('Q')
+        start += offsets_size
+        self.keys = view[start:start + keys_size]
+        start += keys_size
+        self.postings_data = view[start:].cast('I')
+        self.view = view
+
+    def __len__(self):
+        return self.nkeys
+
+    def key(self, idx):
+        """ Return encoded key at ``idx`` """
+        return bytes(self.keys[self.key_offsets[idx]:
+                               self.key_offsets[idx + 1]])
+
+    def find(self, key):
+        """ Return index of ``key`` in the lexicon or ``None``
+
+        :param key:     Key as string
+        :returns:       Index or ``None`` if key is not in the segment
+        """
+        key = key.encode('utf-8')
+        lo, hi = 0, self.nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nkeys and self.key(lo) == key:
+            return lo
+        return None
+
+    def postings_at(self, idx):
+        """ Return postings of the key at ``idx`` """
+        start = self.post_offsets[idx] * 2
+        end = self.post_offsets[idx + 1] * 2
+        data = self.postings_data[start:end]
+        return list(zip(data[::2], data[1::2]))
+
+    def postings(self, key):
+        """ Return list of (document number, count) for ``key``
+
+        :param key:     Term or pair of terms separated by a blank
+        :returns:       List of postings (empty if key is not in the segment)
+        """
+        idx = self.find(key)
+        if idx is None:
+            return []
+        return self.postings_at(idx)
+
+    def items(self):
+        """ Iterate over (key, postings) in key order """
+        for idx in range(self.nkeys):
+            yield self.key(idx).decode('utf-8'), self.postings_at(idx)
+
+    def close(self):
+        # Views must be released before the map can be closed
+        for view in (self.key_offsets, self.post_offsets, self.keys,
+                     self.postings_data, self.view):
+            view.release()
+        self.mm.close()
+
+
+def merge_items(iterables):
+    """ Merge sorted (key, postings) iterables into one
+
+    Postings of the same key are concatenated in the order of
+    ``iterables``, so document numbers in later iterables are expected to be
+    higher than those in earlier ones.
+
+    Example::
+
+        >>> list(merge_items([[('a', [(0, 1)]), ('c', [(1, 1)])],
+        ...                   [('a', [(2, 5)]), ('b', [(3, 1)])]]))
+        [('a', [(0, 1), (2, 5)]), ('b', [(3, 1)]), ('c', [(1, 1)])]
+
+    :param iterables:   Iterables of (key, postings) sorted by key
+    :returns:           Iterator of (key, postings) sorted by key
+    """
+    def tag(n, items):
+        # The index of the iterable keeps postings of equal keys in order
+        for key, posts in items:
+            yield key, n, posts
+    merged = heapq.merge(*[tag(n, it) for n, it in enumerate(iterables)])
+    for key, group in groupby(merged, key=lambda item: item[0]):
+        posts = []
+        for _, _, p in group:
+            posts.extend(p)
+        yield key, posts
+
+
+def index_shard(path, start, texts, tdata=TDATA):
+    """ Count terms in ``texts`` and write them out as a segment
+
+    This function is executed in worker processes by
+    ``IndexStore.add_corpus()``.
+
+    :param path:    Path of the segment file
+    :param start:   Document number of the first text
+    :param texts:   List of document texts
+    :param tdata:   Tokenizer data file path
+    :returns:       List of word counts of the documents
+    """
+    postings = {}
+    word_counts = []
+    for docnum, sentences in enumerate(tokenize_documents(texts, tdata),
+                                       start):
+        term_counts, pair_counts, word_count = get_counts(sentences)
+        word_counts.append(word_count)
+        for counts in (term_counts, pair_counts):
+            for key, count in counts.items():
+                postings.setdefault(key, []).append((docnum, count))
+    write_segment(path, sorted(postings.items()))
+    return word_counts
+
+
+class IndexStore(object):
+    """ Persistent inverted index of terms and term pairs
+
+    Example::
+
+        >>> store = IndexStore(tempfile.mkdtemp())
+        >>> store.add('doc1', {'foo': 2, 'bar': 1}, {'foo bar': 1}, 3)
+        0
+        >>> store.add_text('doc2', 'The foo is here.')
+        1
+        >>> store.flush()
+        >>> store.lookup('foo')
+        [('doc1', 2), ('doc2', 1)]
+        >>> store.lookup_pair('the', 'foo')
+        [('doc2', 1)]
+        >>> store.count('foo')
+        3
+        >>> store.close()
+
+    :param path:        Directory in which the index is stored
+    :param flush_docs:  Number of buffered documents after which they are
+                        written out as a new segment
+    """
+
+    def __init__(self, path, flush_docs=FLUSH_DOCS):
+        self.path = path
+        self.flush_docs = flush_docs
+        os.makedirs(path, exist_ok=True)
+        meta = self.read_meta()
+        self.segment_names = meta['segments']
+        self.next_segment = meta['next_segment']
+        self.segments = [Segment(os.path.join(path, name))
+                         for name in self.segment_names]
+        self.docs = self.read_docs(meta['docs'])
+        self.buffer = {}  # key -> postings of buffered documents
+        self.buffered_docs = []  # (doc_id, word count) of buffered documents
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.path, META_FILE), 'r',
+                      encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'next_segment': 0, 'docs': 0}
+
+    def write_meta(self):
+        meta = {'segments': self.segment_names,
+                'next_segment': self.next_segment,
+                'docs': len(self.docs)}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(meta))
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+    def read_docs(self, ndocs):
+        """ Read the first ``ndocs`` document records
+
+        Records past ``ndocs`` belong to an interrupted flush and are
+        ignored.
+        """
+        docs = []
+        try:
+            with open(os.path.join(self.path, DOCS_FILE), 'r',
+                      encoding='utf-8') as f:
+                for line in f:
+                    if len(docs) == ndocs:
+                        break
+                    word_count, doc_id = line.rstrip('\n').split('\t', 1)
+                    docs.append((doc_id, int(word_count)))
+        except FileNotFoundError:
+            pass
+        return docs
+
+    def add(self, doc_id, term_counts, pair_counts, word_count):
+        """ Add document counts to the index
+
+        :param doc_id:      Document identifier (e.g., URL), must not contain
+                            newlines
+        :param term_counts: Dict of term counts
+        :param pair_counts: Dict of term-pair counts
+        :param word_count:  Number of words in the document
+        :returns:           Document number
+        """
+        docnum = len(self.docs) + len(self.buffered_docs)
+        self.buffered_docs.append((doc_id, word_count))
+        for counts in (term_counts, pair_counts):
+            for key, count in counts.items():
+                self.buffer.setdefault(key, []).append((docnum, count))
+        if len(self.buffered_docs) >= self.flush_docs:
+            self.flush()
+        return docnum
+
+    def add_text(self, doc_id, text):
+        """ Count terms in ``text`` and add them to the index
+
+        :param doc_id:      Document identifier
+        :param text:        Document text
+        :returns:           Document number
+        """
+        return self.add(doc_id, *get_counts(split_sentences(text)))
+
+    def append_docs(self, docs):
+        with open(os.path.join(self.path, DOCS_FILE), 'a',
+                  encoding='utf-8') as f:
+            for doc_id, word_count in docs:
+                f.write('%s\t%s\n' % (word_count, doc_id))
+        self.docs.extend(docs)
+
+    def new_segment_name(self):
+        name = 'seg%06d' % self.next_segment
+        self.next_segment += 1
+        return name
+
+    def flush(self):
+        """ Write buffered documents out as a new segment """
+        if not self.buffered_docs:
+            return
+        name = self.new_segment_name()
+        write_segment(os.path.join(self.path, name),
+                      sorted(self.buffer.items()))
+        self.segment_names.append(name)
+        self.segments.append(Segment(os.path.join(self.path, name)))
+        self.append_docs(self.buffered_docs)
+        self.buffer = {}
+        self.buffered_docs = []
+        self.write_meta()
+
+    def add_corpus(self, docs, processes=None, shard_size=SHARD_SIZE,
+                   merge=True, tdata=TDATA):
+        """ Count terms in many documents in parallel and add them
+
+        Documents are split into shards, and each shard is counted and
+        written out as a segment by a worker process (see
+        ``index_shard()``). Only document identifiers and word counts are
+        sent back to this process. Documents are read from ``docs`` only as
+        workers become available, with at most ``SHARDS_AHEAD`` shards per
+        process waiting to be counted, so ``docs`` can be a generator over a
+        corpus of any size. The segments are merged afterwards unless
+        ``merge`` is ``False``.
+
+        :param docs:        Iterable of (document identifier, text)
+        :param processes:   Number of worker processes (defaults to number of
+                            CPUs)
+        :param shard_size:  Number of documents in a segment
+        :param merge:       Whether to merge segments afterwards
+        :param tdata:       Tokenizer data file path
+        :returns:           Number of documents added
+        """
+        self.flush()
+        processes = processes or os.cpu_count() or 1
+        start = len(self.docs)
+        pending = collections.deque()  # (name, document ids, future)
+        names = []
+        new_docs = []  # (document identifier, word count)
+        ndocs = 0
+
+        def finish():
+            name, doc_ids, future = pending.popleft()
+            names.append(name)
+            new_docs.extend(zip(doc_ids, future.result()))
+
+        with ProcessPoolExecutor(processes) as pool:
+            for shard in shards(docs, shard_size):
+                name = self.new_segment_name()
+                future = pool.submit(index_shard,
+                                     os.path.join(self.path, name),
+                                     start + ndocs,
+                                     [text for _, text in shard], tdata)
+                pending.append((name, [doc_id for doc_id, _ in shard],
+                                future))
+                ndocs += len(shard)
+                if len(pending) > processes * SHARDS_AHEAD:
+                    finish()
+            while pending:
+                finish()
+        if not ndocs:
+            return 0
+        self.segment_names.extend(names)
+        self.segments.extend(Segment(os.path.join(self.path, name))
+                             for name in names)
+        self.append_docs(new_docs)
+        self.write_meta()
+        if merge:
+            self.merge()
+        return ndocs
+
+    def merge(self):
+        """ Merge all segments into one
+
+        Lookups need to search every segment, so merging keeps them fast as
+        documents are added over time.
+        """
+        self.flush()
+        if len(self.segments) < 2:
+            return
+        name = self.new_segment_name()
+        write_segment(os.path.join(self.path, name),
+                      merge_items([s.items() for s in self.segments]))
+        old = self.segments
+        self.segment_names = [name]
+        self.segments = [Segment(os.path.join(self.path, name))]
+        self.write_meta()
+        for segment in old:
+            segment.close()
+            os.unlink(segment.path)
+
+    def postings(self, key):
+        """ Return list of (document number, count) for ``key``
+
+        Only documents that were flushed are included.
+        """
+        postings = []
+        for segment in self.segments:
+            postings.extend(segment.postings(key))
+        return postings
+
+    def lookup(self, term):
+        """ Return documents containing ``term`` and number of occurrences
+
+        :param term:    Term (lower-case, as counted by ``get_counts()``)
+        :returns:       List of (document identifier, count)
+        """
+        return [(self.docs[docnum][0], count)
+                for docnum, count in self.postings(term)]
+
+    def lookup_pair(self, term1, term2):
+        """ Return documents containing the term pair and its occurrences
+
+        :param term1:   First term
+        :param term2:   Second term
+        :returns:       List of (document identifier, count)
+        """
+        return self.lookup('%s %s' % (term1, term2))
+
+    def count(self, term):
+        """ Return total number of occurrences of ``term`` in the corpus """
+        return sum(count for _, count in self.postings(term))
+
+    def close(self):
+        """ Flush buffered documents and close the segments """
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
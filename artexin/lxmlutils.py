@@ -0,0 +1,346 @@
+"""
+lxmlutils.py: lxml-based fast path for simple document transforms
+
+Simple transforms, like unwrapping links, do not need the BeautifulSoup object
+model. When they are called with HTML source, the functions in this module
+feed it to an lxml parser whose target applies the transform and serializes
+the document as the parser goes, without building any tree. Output is the same
+as that of ``str()`` on a soup object parsed with the ``'lxml'`` parser and
+transformed the same way, since BeautifulSoup receives the same parser events
+and the writer follows the same serialization rules.
+
+The fast path is only taken if lxml is installed. Functions in this module
+return ``None`` for documents the parser rejects, in which case the
+BeautifulSoup implementation is used instead.
+
+The fast path is an entry point for HTML source only. ``pack.collect()``
+parses each page once and hands the soup object to every step (see
+``pack.prepare_page()``), so collected pages use the BeautifulSoup
+implementation. Callers that transform HTML source outside of collection,
+such as scripts that post-process stored pages, get the fast path.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import functools
+import re
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('Writer', 'fast_path', 'transform', 'strip_links', 'fixheaders')
+
+
+ENABLED = etree is not None  # Set to ``False`` to always use BeautifulSoup
+
+# Serialization rules used by BeautifulSoup for documents parsed with lxml
+_builder = builder_registry.lookup('lxml', 'html')
+VOID_ELEMENTS = _builder.DEFAULT_EMPTY_ELEMENT_TAGS if _builder else ()
+LIST_ATTRIBUTES = _builder.DEFAULT_CDATA_LIST_ATTRIBUTES if _builder else {}
+PRESERVE_WHITESPACE = ('pre', 'textarea')
+RAW_TEXT_ELEMENTS = ('script', 'style')
+ASCII_SPACES = ' \n\t\x0c\r'
+ESCAPE_RE = re.compile(r'[&<>]')
+ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+WORD_RE = re.compile(r'\S+')
+HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+# Declared encoding in <meta> tags is replaced with the output encoding
+OUTPUT_ENCODING = 'utf-8'
+CHARSET_RE = re.compile(r'((^|;)\s*charset=)([^;]*)', re.M)
+
+
+def escape(text):
+    """ Escape text the same way as BeautifulSoup's minimal formatter """
+    return ESCAPE_RE.sub(lambda m: ESCAPES[m.group()], text)
+
+
+def quote_attr(value):
+    """ Return escaped and quoted attribute value
+
+    Example::
+
+        >>> quote_attr('a & b')
+        '"a &amp; b"'
+        >>> quote_attr('say "hi"')
+        '\\'say "hi"\\''
+        >>> quote_attr('it\\'s "hi"')
+        '"it\\'s &quot;hi&quot;"'
+
+    """
+    value = escape(value)
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    return '"%s"' % value.replace('"', '&quot;')
+
+
+def substitute_charset(attrib):
+    """ Replace declared encoding in ``<meta>`` tag attributes
+
+    Example::
+
+        >>> substitute_charset({'charset': 'latin1'})
+        {'charset': 'utf-8'}
+        >>> substitute_charset({'http-equiv': 'Content-Type',
+        ...                     'content': 'text/html; charset=latin1'})
+        {'http-equiv': 'Content-Type', 'content': 'text/html; charset=utf-8'}
+
+    :param attrib:  Attributes of the ``<meta>`` tag
+    :returns:       New dict of attributes
+    """
+    attrib = dict(attrib)
+    if 'charset' in attrib:
+        attrib['charset'] = OUTPUT_ENCODING
+    elif 'content' in attrib and \
+            attrib.get('http-equiv', '').lower() == 'content-type':
+        attrib['content'] = CHARSET_RE.sub(
+            lambda m: m.group(1) + OUTPUT_ENCODING, attrib['content'])
+    return attrib
+
+
+def format_attrs(tag, attrib):
+    """ Return sorted and normalized attributes as a string """
+    attrs = []
+    for name, value in sorted(attrib.items()):
+        if name in LIST_ATTRIBUTES['*'] or \
+                name in LIST_ATTRIBUTES.get(tag, ()):
+            value = ' '.join(WORD_RE.findall(value))
+        attrs.append(' %s=%s' % (name, quote_attr(value)))
+    return ''.join(attrs)
+
+
+class Writer(object):
+    """ lxml parser target that serializes the document like BeautifulSoup
+
+    Subclasses can override ``unwrap()`` to leave elements out while keeping
+    their contents, and extend ``start()``, ``end()`` and ``close()`` to
+    transform the document in other ways.
+
+    Example::
+
+        >>> print(transform('<!DOCTYPE html><p class=" a  b">1 < 2<br>',
+        ...                 Writer()))
+        <!DOCTYPE html>
+        <html><body><p class="a b">1 &lt; 2<br/></p></body></html>
+
+    """
+
+    def __init__(self):
+        self.out = []  # output pieces
+        self.pending = []  # character data not yet written
+        self.stack = []  # open elements as (name, written, index) tuples
+        self.parents = []  # names of open elements that are written
+        self.preserve = 0  # number of open elements preserving whitespace
+
+    def unwrap(self, tag, attrib):
+        """ Return whether the element should be replaced by its contents """
+        return False
+
+    def flush(self, prefix=None, suffix=None):
+        """ Write pending character data
+
+        Character data is escaped unless it is inside a raw text element.
+        With ``prefix`` and ``suffix``, it is written as is, wrapped in them
+        (e.g., as a comment).
+        """
+        if not self.pending:
+            return
+        text = ''.join(self.pending)
+        self.pending = []
+        if not self.preserve and not text.strip(ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+        if prefix is not None:
+            self.out.append(prefix + text + suffix)
+        elif self.parents and self.parents[-1] in RAW_TEXT_ELEMENTS:
+            self.out.append(text)
+        else:
+            self.out.append(escape(text))
+
+    def start(self, tag, attrib):
+        self.flush()
+        if tag in PRESERVE_WHITESPACE:
+            self.preserve += 1
+        written = not self.unwrap(tag, attrib)
+        self.stack.append((tag, written, len(self.out)))
+        if not written:
+            return
+        self.parents.append(tag)
+        if tag == 'meta':
+            attrib = substitute_charset(attrib)
+        attrs = format_attrs(tag, attrib) if attrib else ''
+        if tag in VOID_ELEMENTS:
+            # Turned into a normal tag in ``end()`` if it has any contents
+            self.out.append('<%s%s/>' % (tag, attrs))
+        else:
+            self.out.append('<%s%s>' % (tag, attrs))
+
+    def end(self, tag):
+        self.flush()
+        if tag in PRESERVE_WHITESPACE:
+            self.preserve -= 1
+        tag, written, index = self.stack.pop()
+        if not written:
+            return
+        self.parents.pop()
+        if tag not in VOID_ELEMENTS:
+            self.out.append('</%s>' % tag)
+        elif index < len(self.out) - 1:
+            self.out[index] = self.out[index][:-2] + '>'
+            self.out.append('</%s>' % tag)
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def comment(self, text):
+        self.flush()
+        self.pending.append(text)
+        self.flush('<!--', '-->')
+
+    def pi(self, target, data):
+        self.flush()
+        self.pending.append(target + ' ' + data)
+        self.flush('<?', '>')
+
+    def doctype(self, name, pubid, system):
+        self.flush()
+        value = name or ''
+        if pubid is not None:
+            value += ' PUBLIC "%s"' % pubid
+            if system is not None:
+                value += ' "%s"' % system
+        elif system is not None:
+            value += ' SYSTEM "%s"' % system
+        self.pending.append(value)
+        self.flush('<!DOCTYPE ', '>\n')
+
+    def close(self):
+        self.flush()
+        return ''.join(self.out)
+
+
+class LinkStripper(Writer):
+    """ Writer that unwraps all links that don't point to fragments """
+
+    def unwrap(self, tag, attrib):
+        return tag == 'a' and not attrib.get('href', '').startswith('#')
+
+
+class HeadingFixer(Writer):
+    """ Writer that promotes all headings so that top-most is H1 """
+
+    def __init__(self):
+        super(HeadingFixer, self).__init__()
+        self.headings = []  # (output index, level) of heading tags
+
+    def start(self, tag, attrib):
+        super(HeadingFixer, self).start(tag, attrib)
+        if tag in HEADINGS:
+            self.headings.append((len(self.out) - 1, int(tag[1])))
+
+    def end(self, tag):
+        super(HeadingFixer, self).end(tag)
+        if tag in HEADINGS:
+            self.headings.append((len(self.out) - 1, int(tag[1])))
+
+    def close(self):
+        self.flush()
+        if self.headings:
+            adjust = min(level for _, level in self.headings) - 1
+            for index, level in self.headings if adjust else ():
+                self.out[index] = self.out[index].replace(
+                    'h%s' % level, 'h%s' % (level - adjust), 1)
+        return ''.join(self.out)
+
+
+def transform(html, target):
+    """ Parse HTML source and return the result of the parser target
+
+    The source is fed to the parser the same way BeautifulSoup does it.
+
+    :param html:    HTML source
+    :param target:  Parser target (e.g., ``Writer`` instance)
+    :returns:       Return value of the target's ``close()`` method, or
+                    ``None`` if the source cannot be handled
+    """
+    if not ENABLED or not isinstance(html, str):
+        return None
+    if html.startswith('\ufeff'):
+        html = html[1:]
+    parser = etree.HTMLParser(target=target, recover=True)
+    try:
+        parser.feed(html)
+        return parser.close()
+    except (ValueError, LookupError, etree.LxmlError):
+        return None
+
+
+def strip_links(html):
+    """ Unwrap all links that don't point to fragments
+
+    Example::
+
+        >>> strip_links('<a href="/foo">foo</a> <a href="#bar">bar</a>')
+        '<html><body>foo <a href="#bar">bar</a></body></html>'
+
+    :param html:    HTML source
+    :returns:       Processed HTML or ``None``
+    """
+    return transform(html, LinkStripper())
+
+
+def fixheaders(html):
+    """ Promote all headings so that top-most is H1
+
+    Example::
+
+        >>> fixheaders('<h2>foo</h2><h3>bar</h3>')
+        '<html><body><h1>foo</h1><h2>bar</h2></body></html>'
+
+    :param html:    HTML source
+    :returns:       Processed HTML or ``None``
+    """
+    return transform(html, HeadingFixer())
+
+
+def fast_path(fast_fn):
+    """ Use ``fast_fn`` for HTML source given to a soup transform
+
+    The decorated function is expected to be decorated with
+    ``htmlutils.soup_transform()``. Soup objects, extra arguments, and
+    documents which ``fast_fn`` cannot handle go to the decorated function.
+
+    :param fast_fn:     Function that takes HTML source and returns processed
+                        HTML source or ``None``
+    :returns:           Decorator
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(html, *args, **kwargs):
+            if not args and not kwargs and not isinstance(html,
+                                                          BeautifulSoup):
+                result = fast_fn(html)
+                if result is not None:
+                    return result
+            return fn(html, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
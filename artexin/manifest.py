@@ -0,0 +1,205 @@
+"""
+manifest.py: record of collected pages for incremental re-collection
+
+The manifest maps each collected URL to a fingerprint of the page content
+after extraction, along with the metadata of the package that was built for
+it. When a page is collected again and its fingerprint has not changed, the
+existing package is reused instead of downloading the images, packaging and
+signing the page again.
+
+Each URL is recorded in a separate file named after the MD5 checksum of the
+URL, and files are written atomically, so the manifest can be shared by batch
+workers.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import copy
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from . import __version__ as _version, __author__ as _author
+from .htmlutils import write_html
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('Manifest', 'fingerprint', 'get_manifest', 'set_manifest')
+
+
+TS_FORMAT = '%Y-%m-%d %H:%M:%S UTC'  # Same as in ``artexin.pack``
+VOLATILE_KEYS = ('timestamp',)  # Metadata keys ignored by ``fingerprint()``
+
+_manifest = None  # manifest used by ``pack.collect()``
+_manifest_lock = threading.Lock()
+
+
+def fingerprint(html, meta={}, options={}):
+    """ Return fingerprint of the page content and extra metadata
+
+    The extra metadata is the metadata passed to ``pack.collect()`` by the
+    caller, which ends up in the package as well. Keys listed in
+    ``VOLATILE_KEYS`` are ignored. A soup object has the same fingerprint as
+    its serialized HTML, which is hashed without building the string.
+
+    Options that change how the page is packaged (see
+    ``pack.package_options()``) are part of the fingerprint as well, so a
+    package built with different options is not reused.
+
+    Example::
+
+        >>> fingerprint('<p>foo</p>') == fingerprint('<p>foo</p>')
+        True
+        >>> fingerprint('<p>foo</p>') == fingerprint('<p>bar</p>')
+        False
+        >>> fingerprint('<p>foo</p>') == fingerprint('<p>foo</p>',
+        ...                                          {'license': 'GFDL'})
+        False
+        >>> fingerprint('<p>foo</p>') == fingerprint('<p>foo</p>',
+        ...                                          options={'minify': True})
+        False
+
+    :param html:    Processed HTML of the page (string or soup object)
+    :param meta:    Extra metadata
+    :param options: Packaging options
+    :returns:       Hex digest
+    """
+    meta = dict((k, v) for k, v in meta.items() if k not in VOLATILE_KEYS)
+    sha = hashlib.sha256()
+    sha.update(json.dumps(meta, sort_keys=True, default=str).encode('utf-8'))
+    sha.update(b'\0')
+    if options:
+        sha.update(json.dumps(options, sort_keys=True,
+                              default=str).encode('utf-8'))
+        sha.update(b'\0')
+    write_html(html, HashWriter(sha))
+    return sha.hexdigest()
+
+
+class HashWriter(object):
+    """ File-like object that feeds written text to a hash object """
+
+    def __init__(self, sha):
+        self.sha = sha
+
+    def write(self, text):
+        self.sha.update(text.encode('utf-8'))
+
+
+class Manifest(object):
+    """ On-disk record of URL fingerprints and package metadata
+
+    Example::
+
+        >>> manifest = Manifest(tempfile.mkdtemp())
+        >>> zippath = os.path.join(manifest.path, 'page.zip')
+        >>> open(zippath, 'w').close()
+        >>> meta = {'url': 'http://example.com/', 'zipfile': zippath,
+        ...         'timestamp': datetime.datetime(2014, 1, 1)}
+        >>> manifest.put('http://example.com/', 'abc', meta)
+        >>> manifest.lookup('http://example.com/', 'abc') == meta
+        True
+        >>> manifest.lookup('http://example.com/', 'def') is None
+        True
+
+    :param path:    Directory in which to keep the manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, url):
+        """ Return path of the manifest file for ``url`` """
+        key = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, url):
+        """ Return the manifest record for ``url`` or ``None``
+
+        :param url:     URL of the page
+        :returns:       Dict containing ``url``, ``fingerprint``, and
+                        ``meta`` keys, or ``None`` if URL is not recorded
+        """
+        try:
+            with open(self.entry_path(url), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('url') != url:
+            return None
+        return record
+
+    def lookup(self, url, fp):
+        """ Return metadata of the package for ``url`` if it is up to date
+
+        The package is up to date if it was built from content with the same
+        fingerprint and the package file still exists.
+
+        :param url:     URL of the page
+        :param fp:      Fingerprint of the current content of the page
+        :returns:       Package metadata or ``None``
+        """
+        record = self.get(url)
+        if record is None or record['fingerprint'] != fp:
+            return None
+        meta = record['meta']
+        if not os.path.exists(meta.get('zipfile', '')):
+            return None
+        meta['timestamp'] = datetime.datetime.strptime(meta['timestamp'],
+                                                       TS_FORMAT)
+        return meta
+
+    def put(self, url, fp, meta):
+        """ Record the package built for ``url``
+
+        :param url:     URL of the page
+        :param fp:      Fingerprint of the page content
+        :param meta:    Metadata of the package
+        """
+        meta = copy.copy(meta)
+        meta['timestamp'] = meta['timestamp'].strftime(TS_FORMAT)
+        record = {'url': url, 'fingerprint': fp, 'meta': meta}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with open(fd, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.write(json.dumps(record))
+            os.replace(tmp_path, self.entry_path(url))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def get_manifest():
+    """ Return the manifest used for incremental collection or ``None`` """
+    return _manifest
+
+
+def set_manifest(manifest):
+    """ Enable incremental collection using ``manifest``
+
+    The manifest is used by the current process, as well as worker processes
+    started afterwards. Pass ``None`` to disable incremental collection.
+
+    :param manifest:    ``Manifest`` instance or ``None``
+    """
+    global _manifest
+    with _manifest_lock:
+        _manifest = manifest
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -11,6 +11,7 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 import copy
 import datetime
 import hashlib
+import io
 import logging
 import os
 import shutil
@@ -27,14 +28,23 @@ from . import __version__ as _version, __author__ as _author
 from .content_crypto import sign_content
 from .fetch import fetch_rendered, fetch_content
 from .extract import extract, no_extract, strip_links, process_images
+from .htmlutils import get_soup, write_html
+from .imagestore import get_store
+from .manifest import fingerprint, get_manifest
 
 
 __version__ = _version
 __author__ = _author
-__all__ = ('zipdir', 'collect', 'create_zipball', 'BASE_DIR')
+__all__ = ('zipdir', 'collect', 'create_zipball', 'create_package',
+           'write_zipball', 'prepare_page', 'package_page', 'BASE_DIR')
 
 
 COMPRESSION = zipfile.ZIP_DEFLATED
+COMPRESSION_LEVEL = 6  # Deflate level for compressible files (1-9)
+# Files in these formats are already compressed, so they are stored as is
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz')
+VERIFY = False  # Whether to read back and verify zipballs after writing
+MINIFY = False  # Whether to minify page HTML when packaging it
 BASE_DIR = tempfile.gettempdir()
 TS_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
 ESCAPE_MAPPINGS = (
@@ -65,22 +75,258 @@ def hash_data(*args):
     return md5.hexdigest()
 
 
-def zipdir(path, dirpath):
+def get_compression(name):
+    """ Return compression method for a file in the zipball
+
+    Files that are already compressed (e.g., images) are stored without
+    compression, since deflating them again costs time without making them
+    any smaller.
+
+    Example::
+
+        >>> get_compression('image0000.JPG') == zipfile.ZIP_STORED
+        True
+        >>> get_compression('index.html') == COMPRESSION
+        True
+
+    :param name:    File name
+    :returns:       Compression method constant from ``zipfile``
+    """
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return COMPRESSION
+
+
+def open_zipball(path, level=None):
+    """ Open a zipball for writing
+
+    :param path:    Path of the zipball (or a file-like object)
+    :param level:   Compression level (defaults to ``COMPRESSION_LEVEL``)
+    :returns:       ``ZipFile`` instance
+    """
+    if level is None:
+        level = COMPRESSION_LEVEL
+    return zipfile.ZipFile(path, 'w', COMPRESSION, compresslevel=level)
+
+
+def verify_zipball(zipball):
+    """ Read back all files in the zipball and check their CRCs
+
+    Checksums of the files are calculated while the zipball is written, so
+    this is only needed to guard against faulty storage.
+
+    :param zipball:     ``ZipFile`` instance
+    :raises:            ``zipfile.BadZipFile`` if a file is corrupt
+    """
+    bad = zipball.testzip()
+    if bad is not None:
+        raise zipfile.BadZipFile('Bad CRC for %s' % bad)
+
+
+def zipdir(path, dirpath, level=None, verify=None):
     """ Create a zipball at ``path`` containing the directory at ``dirpath``
 
     :param path:        Path of the zipball
     :param dirpath:     Path of the directory to zip up
+    :param level:       Compression level (see ``open_zipball()``)
+    :param verify:      Whether to verify the zipball after writing it
+                        (defaults to ``VERIFY``)
     """
+    if verify is None:
+        verify = VERIFY
+
     # Get the path of the directory's parent
     basepath = os.path.dirname(dirpath)
 
     # Compress all directory contents
-    with zipfile.ZipFile(path, 'w', COMPRESSION) as zipball:
+    with open_zipball(path, level) as zipball:
         for base_dir, subdirs, files in os.walk(dirpath):
             for path in files:
                 cpath = os.path.join(base_dir, path)
-                zipball.write(cpath, os.path.relpath(cpath, basepath))
-        zipball.testzip()
+                zipball.write(cpath, os.path.relpath(cpath, basepath),
+                              compress_type=get_compression(path))
+        if verify:
+            verify_zipball(zipball)
+
+
+def write_zipball(path, prefix, html, images, info, level=None, verify=None,
+                  minify=None):
+    """ Create a zipball at ``path`` containing the page and its images
+
+    The HTML and metadata are written straight from memory, and images are
+    read from their current location, so the package does not need to be
+    assembled in a directory first. A soup object is serialized directly into
+    the zipball (see ``htmlutils.write_html()``). All files are placed in a
+    directory named ``prefix`` within the zipball, which is the same layout
+    ``zipdir()`` produces for a directory named ``prefix``. Images are stored
+    without compression (see ``get_compression()``).
+
+    Example::
+
+        >>> import io
+        >>> buff = io.BytesIO()
+        >>> write_zipball(buff, 'abc', '<html></html>', [], '{}')
+        >>> sorted(zipfile.ZipFile(buff).namelist())
+        ['abc/index.html', 'abc/info.json']
+
+    :param path:    Path of the zipball (or a file-like object)
+    :param prefix:  Name of the directory containing the files in the zipball
+    :param html:    Processed HTML of the page (string or soup object)
+    :param images:  List of image paths
+    :param info:    Contents of the ``info.json`` file
+    :param level:   Compression level (see ``open_zipball()``)
+    :param verify:  Whether to verify the zipball after writing it (defaults
+                    to ``VERIFY``)
+    :param minify:  Whether to minify the HTML (defaults to ``MINIFY``)
+    """
+    if verify is None:
+        verify = VERIFY
+    if minify is None:
+        minify = MINIFY
+    with open_zipball(path, level) as zipball:
+        with zipball.open('%s/index.html' % prefix, 'w') as entry:
+            with io.TextIOWrapper(entry, encoding='utf-8') as html_file:
+                write_html(html, html_file, minify)
+        for imgpath in images:
+            name = os.path.basename(imgpath)
+            zipball.write(imgpath, '%s/%s' % (prefix, name),
+                          compress_type=get_compression(name))
+        zipball.writestr('%s/info.json' % prefix, info)
+        if verify:
+            verify_zipball(zipball)
+
+
+def export_dir(dest, html, images, info, minify=None):
+    """ Write the page and its images into ``dest`` directory
+
+    The directory has the same contents as the directory in the zipball
+    created by ``write_zipball()``. If it already exists, it is replaced.
+
+    :param dest:    Path of the directory
+    :param html:    Processed HTML of the page (string or soup object)
+    :param images:  List of image paths
+    :param info:    Contents of the ``info.json`` file
+    :param minify:  Whether to minify the HTML (defaults to ``MINIFY``)
+    """
+    if minify is None:
+        minify = MINIFY
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+    with open(os.path.join(dest, 'index.html'), 'w',
+              encoding='utf-8') as html_file:
+        write_html(html, html_file, minify)
+    for imgpath in images:
+        shutil.copy2(imgpath, dest)
+    with open(os.path.join(dest, 'info.json'), 'w',
+              encoding='utf-8') as meta_file:
+        meta_file.write(info)
+
+
+def sign_zipball(zippath, out_dir, keyring, key, passphrase):
+    """ Sign the zipball, replacing it with the signed file
+
+    :param zippath:     Path of the zipball
+    :param out_dir:     Directory in which to store the signed file
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :returns:           Path of the signed file, or ``None`` if signing failed
+    """
+    signed = sign_content(zippath,
+                          keyring,
+                          key,
+                          passphrase,
+                          output_dir=out_dir)
+    os.unlink(zippath)
+    if not os.path.exists(signed):
+        # Python-gnupg will silently fail. It will log a warning, but won't
+        # raise any exceptions. The only way to know is to test if the file
+        # exists. If the file does not exist, we assume it failed.
+        return None
+    return signed
+
+
+def finish_package(zippath, meta, checksum, timestamp, out_dir, keyring=None,
+                   key=None, passphrase=None):
+    """ Optionally sign the zipball and add package information to meta
+
+    :param zippath:     Path of the zipball
+    :param meta:        Metadata written to the zipball
+    :param checksum:    Checksum of the page URL
+    :param timestamp:   Timestamp as datetime object
+    :param out_dir:     Directory containing the zipball
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :returns:           Updated metadata
+    """
+    if all([keyring, key, passphrase]):
+        signed = sign_zipball(zippath, out_dir, keyring, key, passphrase)
+        if signed is None:
+            meta.update({'timestamp': timestamp,
+                         'error': "Error signing '{0}'".format(zippath)})
+            return meta
+        zippath = signed
+
+    meta.update({'zipfile': zippath,
+                 'size': os.stat(zippath).st_size,
+                 'hash': checksum,
+                 # Pass timestamp as native datetime object
+                 'timestamp': timestamp})
+    return meta
+
+
+def create_package(html, images, meta, out_dir, keep_dir=False, keyring=None,
+                   key=None, passphrase=None, shared=None, minify=None):
+    """ Zip up the page and its images into a zipball inside ``out_dir``
+
+    This function produces the same package as ``create_zipball()``, but
+    writes the page and its images directly into the zipball without copying
+    them into a directory first. The directory is only created if
+    ``keep_dir`` is set.
+
+    Images listed in ``shared`` are not included in the zipball. Instead, the
+    ``shared_images`` key in the metadata maps their file names to checksums
+    of the image store blobs they are identical to, so that the receiving end
+    can take them from its own copy of the blobs.
+
+    :param html:        Processed HTML of the page (string or soup object)
+    :param images:      List of image paths
+    :param meta:        Meta information to be added to info.json as well
+    :param out_dir:     Path where the zipball will be saved
+    :param keep_dir:    Boolean, if True the package contents are also
+                        exported into a folder in `out_dir`
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :param shared:      Dict mapping file names of shared images to blob
+                        checksums
+    :param minify:      Whether to minify the HTML (defaults to ``MINIFY``)
+    :returns:           Updated metadata (see ``collect()``)
+    """
+    meta = copy.copy(meta)
+    if shared:
+        meta['shared_images'] = shared
+        images = [path for path in images
+                  if os.path.basename(path) not in shared]
+
+    checksum = hash_data(meta['url'])
+
+    timestamp = meta['timestamp']
+    meta['timestamp'] = serialize_datetime(timestamp)
+    info = json.dumps(meta, indent=2)
+
+    # FIXME: Handle failure
+    zippath = os.path.join(out_dir, '{0}.zip'.format(checksum))
+    write_zipball(zippath, checksum, html, images, info, minify=minify)
+
+    if keep_dir:
+        export_dir(os.path.join(out_dir, checksum), html, images, info,
+                   minify=minify)
+
+    return finish_package(zippath, meta, checksum, timestamp, out_dir,
+                          keyring, key, passphrase)
 
 
 def create_zipball(src_dir, meta, out_dir, keep_dir=False, keyring=None,
@@ -93,6 +339,8 @@ def create_zipball(src_dir, meta, out_dir, keep_dir=False, keyring=None,
     Optionally preserve the newly created folder inside `out_dir`.
     Optionally encrypt the zip file, replacing it with the signed one.
 
+    Use ``create_package()`` to package a page without copying its files.
+
     :param src_dir:     Source directory where the html and other resources are
     :param meta:        Meta information to be added to info.json as well
     :param out_dir:     Path where the zipball will be saved
@@ -127,36 +375,167 @@ def create_zipball(src_dir, meta, out_dir, keep_dir=False, keyring=None,
     if not keep_dir:
         shutil.rmtree(dest)
 
-    # Encrypt zip file
-    if all([keyring, key, passphrase]):
-        signed = sign_content(zippath,
-                              keyring,
-                              key,
-                              passphrase,
-                              output_dir=out_dir)
-        if not os.path.exists(signed):
-            # Python-gnupg will silently fail. It will log a warning, but won't
-            # raise any exceptions. The only way to know is to test if the file
-            # exists. If the file does not exist, we assume it failed.
-            os.unlink(zippath)
-            meta.update({'timestamp': timestamp,
-                         'error': "Error signing '{0}'".format(zippath)})
-            return meta
+    return finish_package(zippath, meta, checksum, timestamp, out_dir,
+                          keyring, key, passphrase)
 
-        os.unlink(zippath)
-        zippath = signed
 
-    meta.update({'zipfile': zippath,
-                 'size': os.stat(zippath).st_size,
-                 'hash': checksum,
-                 # Pass timestamp as native datetime object
-                 'timestamp': timestamp})
-    return meta
+def prepare_page(page, prep=[], do_extract=True):
+    """ Preprocess the page, extract the article and strip links from it
+
+    The page is parsed once, and all processing steps operate on the same
+    document tree. Preprocessors decorated with
+    ``htmlutils.soup_transform()`` are given the tree. Other preprocessors
+    are given HTML source and should return HTML source, which is parsed
+    again only if a later step needs the tree.
+
+    :param page:        String containing the HTML document
+    :param prep:        Iterable containing HTML preprocessors from
+                        ``artexin.preprocessors``
+    :param do_extract:  Whether to perform article extraction
+    :returns:           Two-tuple containing title and processed soup object
+    """
+    html = page
+    soup = None  # parsed document, once a step needs it
+    for preprocessor in prep:
+        if getattr(preprocessor, 'soup_transform', False):
+            if soup is None:
+                soup = get_soup(html)
+            soup = preprocessor(soup)
+        else:
+            html = preprocessor(html if soup is None else str(soup))
+            soup = None
+    if soup is None:
+        soup = get_soup(html)
+
+    if do_extract:
+        title, soup = extract(soup)  # FIXME: Handle failure
+    else:
+        title, soup = no_extract(soup)
+
+    return title.strip(), strip_links(soup)
+
+
+def package_options(base_dir=BASE_DIR, keyring=None, key=None, minify=None,
+                    optimize_images=False, share_images=False):
+    """ Return options that determine the package built for a page
+
+    The options are included in the fingerprint of the page (see
+    ``artexin.manifest.fingerprint()``), so that changing them causes the
+    page to be packaged again. The passphrase is left out, since it does not
+    affect the package.
+
+    Example::
+
+        >>> package_options('/tmp', minify=True)['minify']
+        True
+        >>> package_options('/tmp')['minify'] == MINIFY
+        True
+
+    :param base_dir:        Base directory in which packages are created
+    :param keyring:         Keyring directory
+    :param key:             Key to use for signing
+    :param minify:          Whether to minify the HTML (defaults to
+                            ``MINIFY``)
+    :param optimize_images: Whether to optimize images, or dict of options
+    :param share_images:    Whether to reference published images
+    :returns:               Dict of options
+    """
+    return {'base_dir': base_dir,
+            'keyring': keyring,
+            'key': key,
+            'minify': MINIFY if minify is None else minify,
+            'optimize_images': optimize_images,
+            'share_images': share_images}
+
+
+def find_shared(images):
+    """ Return image store checksums of images found in the store
+
+    Only blobs that are published (i.e., were included in a package before)
+    can be referenced by packages. Stored images that are not published yet
+    are returned separately, so that they can be published once they are
+    packaged (see ``publish_images()``).
+
+    :param images:      List of image paths
+    :returns:           Two-tuple of dicts mapping file names to checksums,
+                        one for published images and one for the rest of
+                        the stored images
+    """
+    store = get_store()
+    if store is None:
+        return {}, {}
+    shared = {}
+    unpublished = {}
+    for path in images:
+        digest = store.find(path)
+        if digest is None:
+            continue
+        if store.is_published(digest):
+            shared[os.path.basename(path)] = digest
+        else:
+            unpublished[os.path.basename(path)] = digest
+    return shared, unpublished
+
+
+def publish_images(digests):
+    """ Mark image store blobs as published
+
+    :param digests:     Iterable of blob checksums
+    """
+    store = get_store()
+    if store is None:
+        return
+    for digest in digests:
+        store.publish(digest)
+
+
+def package_page(html, meta, src_dir, base_dir=BASE_DIR, keep_dir=False,
+                 keyring=None, key=None, passphrase=None, images=None,
+                 share_images=False, minify=None):
+    """ Zip up the page HTML and its images from ``src_dir``
+
+    The ``src_dir`` is expected to contain the page's images, and it is
+    removed once the zipball is created. If ``images`` is not specified, all
+    files in ``src_dir`` are treated as images.
+
+    :param html:        Processed HTML of the page (string or soup object)
+    :param meta:        Page metadata (see ``collect()``)
+    :param src_dir:     Directory in which the page is collected
+    :param base_dir:    Base directory in which to operate
+    :param keep_dir:    Export the package contents into a directory
+    :param keyring:     Keyring directory
+    :param key:         Key to use for signing
+    :param passphrase:  Key passphrase
+    :param images:      List of image paths within ``src_dir``
+    :param share_images:    Reference images that are in the image store
+                            and were already published instead of including
+                            them (see ``find_shared()``)
+    :param minify:      Whether to minify the HTML (defaults to ``MINIFY``)
+    :returns:           Metadata returned by ``create_package()``
+    """
+    if images is None:
+        images = [os.path.join(src_dir, name)
+                  for name in sorted(os.listdir(src_dir))]
+    try:
+        shared, unpublished = {}, {}
+        if share_images:
+            shared, unpublished = find_shared(images)
+        meta = create_package(html, images, meta, out_dir=base_dir,
+                              keep_dir=keep_dir, keyring=keyring, key=key,
+                              passphrase=passphrase, shared=shared,
+                              minify=minify)
+        # Receivers have the images in this package from now on
+        publish_images(unpublished.values())
+        return meta
+    finally:
+        # Cleanup
+        shutil.rmtree(src_dir)
 
 
 def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
             base_dir=BASE_DIR, keep_dir=False, javascript=True,
-            do_extract=True):
+            do_extract=True, ready=None, share_images=False,
+            optimize_images=False, minify=None):
     """ Collect at ``url`` into a directory within ``base_dir`` and zip it
 
     The directory is created within ``base_dir`` that is named after the md5
@@ -171,6 +550,8 @@ def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
     - ``timestamp``: time when page was retrieved
     - ``title``: page title
     - ``images``: number of images
+    - ``shared_images``: file names and checksums of images that are not
+      included in the zipball (only with ``share_images``)
 
     The above keys are writtein in the JSON file. The following keys are
     returned in addition:
@@ -178,6 +559,15 @@ def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
     - ``zipfile``: path to package file (zip or sig)
     - ``size``: size of the package
     - ``hash``: checksum of the page URL
+    - ``image_stats``: image download and optimization statistics (see
+      ``artexin.extract.process_images()``)
+
+    When incremental collection is enabled using
+    ``artexin.manifest.set_manifest()``, and the extracted page, extra
+    metadata, and packaging options are the same as when the page was last
+    collected, the page is not packaged again. Metadata of the existing
+    package is returned instead, with the ``unchanged`` key set to ``True``
+    and empty ``image_stats``.
 
     :param url:         Identifier for the batch (usually URL of the page)
     :param keyring:     Keyring directory
@@ -190,6 +580,16 @@ def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
     :param keep_dir:    Keep the directory in which content was collected
     :param javascript:  Whether to execute JavaScript on the page
     :param do_extract:  Whether to perform article extraction
+    :param ready:       CSS selector or callable that tells when the page
+                        rendered with JavaScript is ready (see
+                        ``artexin.fetch.wait_until_ready()``)
+    :param share_images:    Reference images already published from the
+                            image store instead of including them in the
+                            zipball (see ``find_shared()``)
+    :param optimize_images: Whether to downscale and re-encode images, or dict
+                            of options (see ``extract.process_images()``)
+    :param minify:      Whether to drop comments and insignificant whitespace
+                        from the HTML (defaults to ``MINIFY``)
     :returns:           Full path of the newly created zipball
     """
     meta = copy.copy(meta)
@@ -199,7 +599,7 @@ def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
     # Fetch and prepare the HTML
     try:
         if javascript:
-            page = fetch_rendered(percent_escape(url))
+            page = fetch_rendered(percent_escape(url), ready=ready)
         else:
             page = fetch_content(url)
     except Exception as err:
@@ -214,40 +614,39 @@ def collect(url, keyring=None, key=None, passphrase=None, prep=[], meta={},
 
     timestamp = datetime.datetime.utcnow()
 
-    for preprocessor in prep:
-        page = preprocessor(page)
-
-    if do_extract:
-        title, html = extract(page)  # FIXME: Handle failure
-    else:
-        title, html = no_extract(page)
-
-    title = title.strip()
-    html = strip_links(html)
+    title, soup = prepare_page(page, prep, do_extract)
+    meta['title'] = meta.get('title') or title
+
+    # Reuse the existing package if the page has not changed. The
+    # fingerprint is taken before images are processed, from the same
+    # metadata as in ``asyncbatch.Collector.collect()``.
+    manifest = get_manifest()
+    if manifest is not None:
+        fp = fingerprint(soup, meta, package_options(
+            base_dir, keyring, key, minify, optimize_images, share_images))
+        unchanged = manifest.lookup(url, fp)
+        if unchanged is not None:
+            # No images were processed in this run
+            unchanged.update({'unchanged': True, 'image_stats': {}})
+            return unchanged
 
     temp_dir = tempfile.mkdtemp()
     # Process images
-    html, images = process_images(html, url, imgdir=temp_dir)
-    # Write the HTML file
-    # FIXME: Handle failure
-    html_path = os.path.join(temp_dir, 'index.html')
-    with open(html_path, 'w', encoding='utf-8') as html_file:
-        html_file.write(html)
+    image_stats = {}
+    soup, images = process_images(soup, url, imgdir=temp_dir,
+                                  optimize=optimize_images, stats=image_stats)
 
     meta.update({'timestamp': timestamp,
-                 'title': meta.get('title') or title,
                  'images': len(images)})
 
-    meta = create_zipball(src_dir=temp_dir,
-                          meta=meta,
-                          out_dir=base_dir,
-                          keep_dir=keep_dir,
-                          keyring=keyring,
-                          key=key,
-                          passphrase=passphrase)
-    # Cleanup
-    shutil.rmtree(temp_dir)
-
+    meta = package_page(soup, meta, temp_dir, base_dir=base_dir,
+                        keep_dir=keep_dir, keyring=keyring, key=key,
+                        passphrase=passphrase, images=images,
+                        share_images=share_images, minify=minify)
+    if manifest is not None and 'error' not in meta:
+        manifest.put(url, fp, meta)
+    # Statistics are about this run, so they are not packaged or recorded
+    meta['image_stats'] = image_stats
     return meta
 
 
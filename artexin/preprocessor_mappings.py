@@ -8,15 +8,22 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
-import re
+import importlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from . import __version__ as _version, __author__ as _author
+from . import preprocessors
 from .preprocessors import pp_noop, pp_wikipedia, pp_dwelle, pp_fixheaders
+from .router import Router
 
 
 __version__ = _version
 __author__ = _author
-__all__ = ('get_preps',)
+__all__ = ('get_preps', 'get_ready', 'add_mapping', 'load_mappings')
 
 
 DEFAULT_PREPROCESSORS = [pp_noop]
@@ -32,6 +39,31 @@ MAPPINGS = (
     (r'.*', (pp_fixheaders,)),
 )
 
+# The readiness mappings contain two-tuples of regexp patterns and conditions
+# that tell when a page rendered with JavaScript is ready. The condition is
+# either a CSS selector or a callable that takes the WebDriver instance. See
+# ``artexin.fetch.wait_until_ready()`` for more information. Only the first
+# matching condition is used.
+READY_MAPPINGS = (
+    (r'^https?://..\.wikipedia\.org', '#mw-content-text'),
+    (r'^http://www\.dw\.de/', 'div.longText'),
+)
+
+
+def build_routers():
+    """ Compile ``MAPPINGS`` and ``READY_MAPPINGS`` into routers
+
+    The last set of ``MAPPINGS`` is added as a final rule, so that it stays
+    last when more mappings are added using ``add_mapping()``.
+    """
+    preps_router = Router(MAPPINGS[:-1])
+    for pattern, preps in MAPPINGS[-1:]:
+        preps_router.add(pattern, preps, final=True)
+    return preps_router, Router(READY_MAPPINGS)
+
+
+PREPS_ROUTER, READY_ROUTER = build_routers()
+
 
 def get_preps(url):
     """ Returns a list of preprocessors for given URL
@@ -48,12 +80,121 @@ def get_preps(url):
     """
 
     using_preps = ()
-    for pattern, preps in MAPPINGS:
-        if re.match(pattern, url, re.IGNORECASE):
-            using_preps += preps
+    for preps in PREPS_ROUTER.iter_match(url):
+        using_preps += preps
     return using_preps or DEFAULT_PREPROCESSORS
 
 
+def get_ready(url):
+    """ Returns the page readiness condition for given URL
+
+    Example::
+
+        >>> get_ready('http://en.wikipedia.org/wiki/Sunflower')
+        '#mw-content-text'
+        >>> get_ready('http://www.example.com') is None
+        True
+
+    :param url:     URL for which to retrieve the condition
+    :returns:       CSS selector, callable, or ``None`` if there is no
+                    site-specific condition
+    """
+    return READY_ROUTER.first(url)
+
+
+def get_preprocessor(name):
+    """ Return preprocessor function by name
+
+    Names without a dot refer to functions in ``artexin.preprocessors``,
+    other names are dotted paths to functions in any module.
+
+    Example::
+
+        >>> get_preprocessor('pp_dwelle') == pp_dwelle
+        True
+        >>> get_preprocessor('artexin.preprocessors.pp_noop') == pp_noop
+        True
+
+    :param name:    Function name or dotted path
+    :returns:       Preprocessor function
+    """
+    module = preprocessors
+    if '.' in name:
+        module_name, name = name.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise ValueError("No preprocessor named '%s'" % name)
+
+
+def add_mapping(pattern=None, preps=(), host=None, ready=None, routers=None):
+    """ Add site-specific preprocessors and readiness condition
+
+    The mapping is applied before the last set of ``MAPPINGS``, and after all
+    mappings that were added before it. At least one of ``pattern`` and
+    ``host`` is required. A URL matches if its host name ends with ``host``
+    and it matches ``pattern``.
+
+    Example::
+
+        >>> preps_router, ready_router = Router(), Router()
+        >>> add_mapping(host='example.invalid', preps=[pp_noop], ready='#main',
+        ...             routers=(preps_router, ready_router))
+        >>> preps_router.first('http://www.example.invalid/') == (pp_noop,)
+        True
+        >>> ready_router.first('http://www.example.invalid/')
+        '#main'
+
+    :param pattern: Regexp pattern matched against the beginning of the URL
+    :param preps:   Iterable of preprocessors
+    :param host:    Host name or domain of the site
+    :param ready:   Readiness condition (see ``READY_MAPPINGS``)
+    :param routers: Two-tuple of preprocessor and readiness routers to add
+                    the mapping to (defaults to the ones used by
+                    ``get_preps()`` and ``get_ready()``)
+    """
+    if pattern is None and host is None:
+        raise ValueError('Mapping needs a pattern or a host')
+    preps_router, ready_router = routers or (PREPS_ROUTER, READY_ROUTER)
+    if preps:
+        preps_router.add(pattern, tuple(preps), host=host)
+    if ready is not None:
+        ready_router.add(pattern, ready, host=host)
+
+
+def load_mappings(path):
+    """ Add mappings from a JSON file
+
+    The file contains a list of objects with keys corresponding to
+    ``add_mapping()`` arguments, except that preprocessors are given by name
+    (see ``get_preprocessor()``)::
+
+        [
+            {"host": "example.com",
+             "preps": ["pp_noop", "mypackage.preps.pp_example"],
+             "ready": "#content"},
+            {"pattern": "^https?://news\\.example\\.org/articles/",
+             "preps": ["pp_noop"]}
+        ]
+
+    Mappings are added in the order in which they appear in the file.
+    Preprocessors take and return HTML source, unless they are decorated with
+    ``artexin.htmlutils.soup_transform()`` (see ``pack.prepare_page()``).
+
+    :param path:    Path of the JSON file
+    :returns:       Number of mappings added
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        mappings = json.load(f)
+    for mapping in mappings:
+        mapping = dict(mapping)
+        mapping['preps'] = [get_preprocessor(name)
+                            for name in mapping.get('preps', ())]
+        add_mapping(**mapping)
+    return len(mappings)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -8,26 +8,76 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import logging
+
 from bs4 import BeautifulSoup
 from . import __version__ as _version, __author__ as _author
+from . import lxmlutils
+from .htmlrules import RuleSet
+from .htmlutils import soup_transform
 
 
 __version__ = _version
 __author__ = _author
 
 
+HEADINGS_RULES = RuleSet([
+    ('h1, h2, h3, h4, h5, h6', 'collect', 'headings'),
+])
+
+WIKIPEDIA_PAGE_RULES = RuleSet([
+    ('h1', 'collect', 'title'),
+    ('div#mw-content-text', 'collect', 'body'),
+])
+
+WIKIPEDIA_RULES = RuleSet([
+    # Strip [EDIT] links
+    ('span.mw-editsection', 'decompose'),
+    # Strip links to larger image
+    ('a.image', 'unwrap'),
+    # Strip magnify icon
+    ('div.magnify', 'decompose'),
+    # Convert all div.thumbcaption to paragraphs without attributes
+    ('div.thumbcaption', 'rename', 'p', {}),
+    # Remove all internal wiki links
+    ('a[href^="/wiki/"]', 'unwrap'),
+    # Remove create new page link
+    ('a.new[href^="/w/index.php"]', 'unwrap'),
+    # Remove navbox, wiki metadata, and small plainlinks
+    ('table.navbox, table.metadata, table.plainlinks', 'decompose'),
+    # Remove hat notes
+    ('div.hatnote', 'decompose'),
+])
+
+DWELLE_RULES = RuleSet([
+    ('h1', 'collect', 'title'),
+    ('p.intro', 'collect', 'intro'),
+    ('div.picBox', 'collect', 'picture'),
+    ('div.longText', 'collect', 'body'),
+    ('ul.smallList', 'collect', 'lists'),
+])
+
+
 def pp_noop(html):
     """ Simply return the imput as is
 
-    :param html:    String containing the HTML document
+    :param html:    String containing the HTML document or soup object
     :returns:       Processed HTML
     """
     return html
 
 
-def pp_fixheaders(html):
+pp_noop.soup_transform = True  # Works with soup objects as well
+
+
+@lxmlutils.fast_path(lxmlutils.fixheaders)
+@soup_transform
+def pp_fixheaders(soup):
     """ Fixes all headers so that top-most is always H1
 
+    HTML source is processed by ``artexin.lxmlutils.fixheaders()`` when
+    possible, which gives the same result without building a soup object.
+
     It promotes all headers so that H1 is the top-most header::
 
         >>> html = "<h2>This should be h1</h2><h3>Should be h2</h3>"
@@ -41,22 +91,21 @@ def pp_fixheaders(html):
         '<html><body><h1>This should be h1</h1><h3>But this is not h2</h3></body></html>'
 
 
-    :param html:    String containing the HTML document
-    :returns:       Processed HTML
+    :param soup:    Soup object (or HTML string, see ``soup_transform()``)
+    :returns:       Processed soup object
     """
-    soup = BeautifulSoup(html, 'lxml')
-    adjust = None
-    for level, h in enumerate(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'], start=1):
-        headings = soup.find_all(h)
-        if headings and adjust is None:
-            adjust = level - 1
-        if adjust:
-            for elem in headings:
-                elem.name = 'h%s' % (level - adjust)
-    return str(soup)
-
-
-def pp_wikipedia(html):
+    headings = HEADINGS_RULES.apply(soup).get('headings')
+    if not headings:
+        return soup
+    adjust = min(int(elem.name[1]) for elem in headings) - 1
+    if adjust:
+        for elem in headings:
+            elem.name = 'h%s' % (int(elem.name[1]) - adjust)
+    return soup
+
+
+@soup_transform
+def pp_wikipedia(soup):
     """ Preprocess Wikipedia article before extraction
 
     Simply calling the ``pp_wikipedia()`` function with HTML string returns
@@ -90,100 +139,60 @@ def pp_wikipedia(html):
         >>> 'title="Enlarge">' in s
         False
 
-    :param html:    String containing the HTML document
-    :returns:       Processed HTML
+    :param soup:    Soup object (or HTML string, see ``soup_transform()``)
+    :returns:       Processed soup object
     """
-    soup = BeautifulSoup(html, 'lxml')
 
-    # Move H1 into article body container and extract the body container
+    found = WIKIPEDIA_PAGE_RULES.apply(soup)
+
+    # Extract the body container and move H1 into it
+    artbody = found.get('body')
+    if not artbody:
+        WIKIPEDIA_RULES.apply(soup)
+        return soup
+    # There is a body, so we can use it to replace the entire contents of the
+    # <body> tag. Only the body needs to be cleaned up after that.
+    artbody = artbody[0]
+    artbody.extract()
+    soup.body.clear()
+    soup.body.append(artbody)
+    WIKIPEDIA_RULES.apply(artbody)
     title = soup.new_tag('h1')
-    title.string = soup.h1.string
-    artbody = soup.find('div', {'id': 'mw-content-text'})
-    if artbody:
-        # There is a body, so we can use it to replace the entire contents of
-        # the <body> tag.
-        artbody.insert(0, title)
-        artbody.extract()
-        soup.body.clear()
-        soup.body.append(artbody)
+    title.string = found['title'][0].get_text()
+    artbody.insert(0, title)
+    return soup
 
-    # Strip [EDIT] links
-    for tag in soup.find_all('span', {'class': 'mw-editsection'}):
-        tag.decompose()
 
-    # Strip links to larger image
-    for tag in soup.find_all('a', {'class': 'image'}):
-        tag.unwrap()
-
-    # Strip magnify icon
-    for tag in soup.find_all('div', {'class': 'magnify'}):
-        tag.decompose()
-
-    # Convert all div.thumbcaption to p.thumbcaption
-    for tag in soup.find_all('div', {'class': 'thumbcaption'}):
-        tag.wrap(soup.new_tag('p'))
-        tag.unwrap()
-
-    # Remove all internal wiki links
-    for tag in soup.find_all('a'):
-        if tag.get('href', '').startswith('/wiki/'):
-            tag.unwrap()
-
-    # Remove create new page link
-    for tag in soup.find_all('a', {'class': 'new'}):
-        if tag.get('href', '').startswith('/w/index.php'):
-            tag.unwrap()
-
-    # Remove navbox
-    for tag in soup.find_all('table', {'class': 'navbox'}):
-        tag.decompose()
-
-    # Remove wiki metadata
-    for tag in soup.find_all('table', {'class': 'metadata'}):
-        tag.decompose()
-
-    # Remove small plainlinks
-    for tag in soup.find_all('table', {'class': 'plainlinks'}):
-        tag.decompose()
-
-    # Remove hat notes
-    for tag in soup.find_all('div', {'class': 'hatnote'}):
-        tag.decompose()
-
-    return str(soup)
-
-
-def pp_dwelle(html):
+@soup_transform
+def pp_dwelle(soup):
     """ Fixes DW's page layout
 
     This preprocessor moves the article title, date, lead, and main image into
     the article container element (``DIV.longText``).
 
-    :param html:    String containing the HTML document
-    :returns:       Processed HTML
+    :param soup:    Soup object (or HTML string, see ``soup_transform()``)
+    :returns:       Processed soup object
     """
-    soup = BeautifulSoup(html, 'lxml')
-    intro = soup.find_all('p', {'class': 'intro'})[0]
+    found = DWELLE_RULES.apply(soup)
+    intro = found['intro'][0]
     ppicture = soup.new_tag('p')
     try:
-        picture = soup.find_all('div', {'class': 'picBox'})[0].a.img
+        picture = found['picture'][0].a.img
         if picture:
             ppicture.append(picture)
-    except IndexError:
-        print('IndexError')
-    except AttributeError:
-        print('AttributeError')
-    long_text = soup.find_all('div', {'class': 'longText'})[0]
+    except (IndexError, AttributeError):
+        logging.debug('No main image found in DW article')
+    long_text = found['body'][0]
     pdate = soup.new_tag('p')
-    date = soup.find_all('ul', {'class': 'smallList'})[1].li
+    date = found['lists'][1].li
     pdate.append(date)
     date.unwrap()
     pdate.strong.string.replace_with('Deutsche Welle')
-    for elem in [ppicture, intro, pdate, soup.h1]:
+    for elem in [ppicture, intro, pdate, found['title'][0]]:
         long_text.insert(0, elem)
     soup.body.replace_with(long_text)
     long_text.name = 'body'
-    return soup.prettify()
+    return soup
 
 
 if __name__ == '__main__':
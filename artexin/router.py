@@ -0,0 +1,189 @@
+"""
+router.py: compiled URL routing tables
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import re
+
+from urllib.parse import urlsplit
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('Router', 'pattern_host')
+
+
+# Matches the scheme and host portion of patterns like ``^https?://a\.b/``,
+# where the host ends at a label boundary
+SCHEME_HOST_RE = re.compile(r'\^http(?:s\??)?://([^/:$()\[\]{}|*+?^]*)'
+                            r'[/:$]')
+LABEL_RE = re.compile(r'[a-z0-9-]+\Z', re.IGNORECASE)
+RULES = None  # Trie node key for rule numbers (never clashes with labels)
+
+
+def pattern_host(pattern):
+    """ Return host name suffix that all URLs matching ``pattern`` share
+
+    Only patterns anchored at the scheme are considered. The suffix is made of
+    the trailing literal labels of the host portion of the pattern. The host
+    portion must be followed by a path, port, or end anchor. Otherwise, its
+    last label may be the beginning of a longer label (e.g.,
+    ``^http://example\\.co`` matches ``http://example.com/``), and no suffix
+    is returned.
+
+    Example::
+
+        >>> pattern_host(r'^https?://..\\.wikipedia\\.org/')
+        'wikipedia.org'
+        >>> pattern_host(r'^https?://..\\.wikipedia\\.org') is None
+        True
+        >>> pattern_host(r'^http://www\\.dw\\.de/')
+        'www.dw.de'
+        >>> pattern_host(r'.*') is None
+        True
+        >>> pattern_host(r'^http://(www\\.)?example\\.com/') is None
+        True
+
+    :param pattern:     Regexp pattern
+    :returns:           Lower-case host name suffix or ``None``
+    """
+    if '|' in pattern:
+        return None
+    match = SCHEME_HOST_RE.match(pattern)
+    if not match:
+        return None
+    labels = []
+    for label in reversed(match.group(1).split(r'\.')):
+        if not LABEL_RE.match(label):
+            break
+        labels.append(label.lower())
+    if not labels:
+        return None
+    return '.'.join(reversed(labels))
+
+
+def url_host(url):
+    """ Return lower-case host name of the URL or empty string """
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+
+
+class Router(object):
+    """ Ordered table of URL rules with a host-based index
+
+    Each rule consists of a regexp pattern, an optional host name suffix, and
+    a value. A URL matches a rule if its host name ends with the rule's host
+    (at a label boundary) and it matches the pattern. Patterns are compiled
+    once, and matched case-insensitively against the beginning of the URL.
+
+    Rules with a host are indexed in a trie of reversed host name labels, so
+    only rules for the URL's host and its parent domains are tried, no matter
+    how many per-site rules there are. If no host is given, it is derived
+    from the pattern where possible (see ``pattern_host()``). The remaining
+    rules are tried for every URL.
+
+    Matches are always returned in registration order, except that rules
+    added with ``final=True`` come after all other rules.
+
+    Example::
+
+        >>> r = Router()
+        >>> r.add(r'^https?://..\\.wikipedia\\.org', 'wiki')
+        >>> r.add(None, 'news', host='dw.de')
+        >>> r.add(r'.*', 'any', final=True)
+        >>> r.add(r'^http://www\\.dw\\.de/de/', 'german')
+        >>> r.match('http://www.dw.de/de/foo')
+        ['news', 'german', 'any']
+        >>> r.match('https://EN.wikipedia.org/wiki/Foo')
+        ['wiki', 'any']
+        >>> r.first('http://example.com/')
+        'any'
+
+    :param rules:   Iterable of two-tuples containing pattern and value to
+                    add right away
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []  # (sort key, compiled pattern or None, value)
+        self.trie = {}  # label -> child node, RULES -> rule numbers
+        self.unindexed = []  # numbers of rules without a host
+        for pattern, value in rules:
+            self.add(pattern, value)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, pattern, value, host=None, final=False):
+        """ Add a rule
+
+        :param pattern: Regexp pattern or ``None`` to match any URL on
+                        ``host``
+        :param value:   Value returned for matching URLs
+        :param host:    Host name suffix (derived from pattern if omitted)
+        :param final:   Whether the rule goes after all non-final rules
+        """
+        if host is None and pattern is not None:
+            host = pattern_host(pattern)
+        if pattern is not None:
+            pattern = re.compile(pattern, re.IGNORECASE)
+        number = len(self.rules)
+        self.rules.append(((final, number), pattern, value))
+        if not host:
+            self.unindexed.append(number)
+            return
+        node = self.trie
+        for label in reversed(host.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(RULES, []).append(number)
+
+    def candidates(self, url):
+        """ Return numbers of rules that may match ``url`` """
+        numbers = list(self.unindexed)
+        node = self.trie
+        for label in reversed(url_host(url).split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            numbers.extend(node.get(RULES, ()))
+        return numbers
+
+    def iter_match(self, url):
+        """ Iterate over values of rules matching ``url`` in order """
+        rules = self.rules
+        numbers = self.candidates(url)
+        numbers.sort(key=lambda n: rules[n][0])
+        for number in numbers:
+            _, pattern, value = rules[number]
+            if pattern is None or pattern.match(url):
+                yield value
+
+    def match(self, url):
+        """ Return a list of values of all rules matching ``url``
+
+        :param url:     URL to match
+        :returns:       List of values in rule order
+        """
+        return list(self.iter_match(url))
+
+    def first(self, url, default=None):
+        """ Return the value of the first rule matching ``url``
+
+        :param url:     URL to match
+        :param default: Value to return if no rule matches
+        :returns:       Value of the matching rule or ``default``
+        """
+        return next(self.iter_match(url), default)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,164 @@
+"""
+scheduler.py: per-host politeness scheduling for batch jobs
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import collections
+import time
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('DomainScheduler',)
+
+
+MAX_PER_HOST = 2  # Maximum number of jobs running for a single host
+MIN_INTERVAL = 0.5  # Minimum number of seconds between job starts per host
+
+
+class DomainScheduler(object):
+    """ Queue of jobs that interleaves hosts and enforces per-host limits
+
+    Jobs are grouped by host, and hosts take turns in round-robin order, so
+    that jobs for many hosts are spread across workers even when the input is
+    dominated by a single host. A job is only handed out if its host has fewer
+    than ``max_per_host`` running jobs and no job for the same host was
+    started in the last ``min_interval`` seconds.
+
+    Example::
+
+        >>> s = DomainScheduler(max_per_host=1, min_interval=10)
+        >>> for job in ['a1', 'a2', 'a3', 'b1', 'c1']:
+        ...     s.add(job[0], job)
+        >>> s.next(now=0), s.next(now=0), s.next(now=0), s.next(now=0)
+        ('a1', 'b1', 'c1', None)
+        >>> s.done('a')
+        >>> s.next(now=5) is None  # too soon for host 'a'
+        True
+        >>> s.wait_time(now=5)
+        5
+        >>> s.next(now=10)
+        'a2'
+        >>> len(s)
+        1
+        >>> list(s.started)  # 'b' and 'c' no longer need to wait
+        ['a']
+
+    :param max_per_host:    Maximum number of running jobs per host
+    :param min_interval:    Minimum number of seconds between job starts for
+                            a single host
+    """
+
+    def __init__(self, max_per_host=MAX_PER_HOST, min_interval=MIN_INTERVAL):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self.queues = {}  # host -> deque of jobs
+        # Hosts with queued jobs, in turn (values are unused)
+        self.hosts = collections.OrderedDict()
+        self.running = collections.Counter()  # host -> running jobs
+        # host -> time when last job was started, oldest first, only for
+        # jobs started within the last ``min_interval`` seconds
+        self.started = collections.OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, host, job):
+        """ Add job for given host to the queue """
+        if host not in self.queues:
+            self.queues[host] = collections.deque()
+            self.hosts[host] = None
+        self.queues[host].append(job)
+        self.size += 1
+
+    def ready_at(self, host):
+        """ Return time at which host can start another job, or ``None``
+
+        ``None`` is returned if host has too many jobs running.
+        """
+        if self.running[host] >= self.max_per_host:
+            return None
+        started = self.started.get(host)
+        if started is None:
+            return 0
+        return started + self.min_interval
+
+    def next(self, now=None):
+        """ Return next job that can be started or ``None``
+
+        The job's host is considered to have one more running job until
+        ``done()`` is called for it.
+
+        :param now:     Current time (defaults to ``time.time()``)
+        :returns:       Job or ``None`` if no job can be started right now
+        """
+        if now is None:
+            now = time.time()
+        self.prune(now)
+        for _ in range(len(self.hosts)):
+            host = next(iter(self.hosts))
+            self.hosts.move_to_end(host)
+            ready_at = self.ready_at(host)
+            if ready_at is None or ready_at > now:
+                continue
+            queue = self.queues[host]
+            job = queue.popleft()
+            if not queue:
+                del self.queues[host]
+                del self.hosts[host]
+            self.running[host] += 1
+            self.started.pop(host, None)
+            self.started[host] = now
+            self.size -= 1
+            return job
+        return None
+
+    def prune(self, now):
+        """ Forget start times that no longer hold back any job
+
+        Start times are kept in the order in which jobs were started, so
+        expired ones are removed from the front. This keeps ``started``
+        limited to hosts that started a job in the last ``min_interval``
+        seconds, regardless of how many hosts were seen.
+        """
+        started = self.started
+        while started:
+            host, last = next(iter(started.items()))
+            if last + self.min_interval > now:
+                break
+            del started[host]
+
+    def done(self, host):
+        """ Mark a job for given host as finished """
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+
+    def wait_time(self, now=None):
+        """ Return number of seconds until a rate-limited job can start
+
+        Returns ``None`` if no queued job is waiting on the rate limit alone,
+        i.e., all queued jobs wait for other jobs of their hosts to finish.
+
+        :param now:     Current time (defaults to ``time.time()``)
+        :returns:       Number of seconds or ``None``
+        """
+        if now is None:
+            now = time.time()
+        times = [t for t in map(self.ready_at, self.hosts) if t is not None]
+        if not times:
+            return None
+        return max(min(times) - now, 0)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,194 @@
+"""
+session.py: shared HTTP session with per-host connection pools
+
+All HTTP requests made by the ``artexin.fetch`` module go through a session
+that is shared by all threads of a process. The session keeps connections to
+each host alive between requests, so that fetching many images from the same
+server does not require a new TCP connection and TLS handshake for each image.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import logging
+import os
+import threading
+
+from urllib.error import URLError, HTTPError
+
+import urllib3
+
+from . import __version__ as _version, __author__ as _author
+
+
+__version__ = _version
+__author__ = _author
+__all__ = ('Session', 'get_session', 'close_session', 'set_cache')
+
+
+NUM_POOLS = 50  # Number of hosts for which connections are kept alive
+POOL_SIZE = 10  # Number of connections kept alive for each host
+MAX_REDIRECTS = 10
+HTTP2 = False  # Set to True to use HTTP/2 where possible (requires ``h2``)
+DEFAULT_HEADERS = urllib3.make_headers(keep_alive=True, accept_encoding=True)
+
+_cache = None  # HTTP cache used by sessions
+_session = None  # session belonging to the current process
+_session_pid = None  # pid of the process that created the session
+_session_lock = threading.Lock()
+
+
+def enable_http2():
+    """ Make urllib3 negotiate HTTP/2 with servers that support it
+
+    HTTP/2 support in urllib3 is experimental and requires the ``h2`` package.
+    If it is not available, a warning is logged and HTTP/1.1 is used.
+
+    :returns:   ``True`` if HTTP/2 was enabled, ``False`` otherwise
+    """
+    try:
+        from urllib3 import http2
+        http2.inject_into_urllib3()
+    except ImportError:
+        logging.warning('HTTP/2 is not available, using HTTP/1.1')
+        return False
+    return True
+
+
+class Session(object):
+    """ HTTP session with per-host pools of keep-alive connections
+
+    Requests fail with the same exceptions as ``urllib.request.urlopen()``:
+    ``HTTPError`` for HTTP error statuses and ``URLError`` for other failures.
+    Redirects are followed.
+
+    :param num_pools:   Number of hosts for which connections are kept
+    :param pool_size:   Number of connections kept for each host
+    :param http2:       Whether to enable HTTP/2 (see ``enable_http2()``)
+    :param cache:       ``artexin.httpcache.HTTPCache`` instance used by
+                        ``fetch()``
+    """
+
+    def __init__(self, num_pools=NUM_POOLS, pool_size=POOL_SIZE, http2=HTTP2,
+                 cache=None):
+        self.cache = cache
+        if http2:
+            enable_http2()
+        retries = urllib3.Retry(connect=0, read=0, status=0, other=0,
+                                redirect=MAX_REDIRECTS)
+        self.manager = urllib3.PoolManager(num_pools=num_pools,
+                                           maxsize=pool_size,
+                                           headers=DEFAULT_HEADERS,
+                                           retries=retries)
+
+    def request(self, url, timeout=None, headers=None, stream=False):
+        """ Perform a GET request
+
+        When ``stream`` is ``True``, the response body is not read, and it's
+        the caller's responsibility to read it (using ``read()`` or
+        ``stream()`` methods of the response) and call ``release_conn()`` on
+        the response when done.
+
+        :param url:     URL to fetch
+        :param timeout: Connect and read timeout in seconds
+        :param headers: Dict of additional request headers
+        :param stream:  Whether to leave reading the body to the caller
+        :returns:       ``urllib3.HTTPResponse`` object
+        """
+        if headers:
+            headers = dict(DEFAULT_HEADERS, **headers)
+        try:
+            resp = self.manager.request('GET', url, headers=headers,
+                                        timeout=timeout,
+                                        preload_content=not stream)
+        except urllib3.exceptions.HTTPError as err:
+            raise URLError(err)
+        if resp.status >= 400:
+            resp.drain_conn()
+            resp.release_conn()
+            raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return resp
+
+    def fetch(self, url, timeout=None):
+        """ Fetch content from specified URL
+
+        If the session has a cache, the content is fetched through it.
+
+        :param url:     URL to fetch
+        :param timeout: Connect and read timeout in seconds
+        :returns:       Response body as bytestring
+        """
+        if self.cache is not None:
+            return self.cache.fetch(self, url, timeout=timeout)
+        return self.request(url, timeout=timeout).data
+
+    def close(self):
+        """ Close all connections kept by the session """
+        self.manager.clear()
+
+
+def get_session():
+    """ Return the HTTP session for the current process
+
+    The session is created on first use. Connections cannot be shared between
+    processes, so processes started by forking (e.g., batch workers) get a
+    new session instead of the one inherited from the parent.
+
+    Example::
+
+        >>> get_session() is get_session()
+        True
+
+    :returns:   ``Session`` instance
+    """
+    global _session, _session_pid
+    with _session_lock:
+        pid = os.getpid()
+        if _session is None or _session_pid != pid:
+            _session = Session(cache=_cache)
+            _session_pid = pid
+        return _session
+
+
+def set_cache(cache):
+    """ Set the HTTP cache used by sessions
+
+    The cache is used by the session of the current process, as well as
+    sessions of worker processes started afterwards. Pass ``None`` to disable
+    caching.
+
+    Example::
+
+        >>> import tempfile
+        >>> from artexin.httpcache import HTTPCache
+        >>> set_cache(HTTPCache(tempfile.mkdtemp()))
+        >>> get_session().cache is not None
+        True
+        >>> set_cache(None)
+        >>> get_session().cache is None
+        True
+
+    :param cache:   ``artexin.httpcache.HTTPCache`` instance or ``None``
+    """
+    global _cache
+    with _session_lock:
+        _cache = cache
+        if _session is not None and _session_pid == os.getpid():
+            _session.cache = cache
+
+
+def close_session():
+    """ Close the session of the current process if there is one """
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None and _session_pid == os.getpid():
+        session.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,130 @@
+"""
+test_asyncbatch.py: Unit tests for ``artexin.asyncbatch`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import asyncio
+import os
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ..asyncbatch import Collector
+
+
+PAGE = """<html><head><title>Foo</title></head><body>
+<h1>Foo</h1>
+<p><img src="/foo.png"><img src="/bad.png"><img src="/foo.png"></p>
+</body></html>"""
+
+
+def fake_fetch_image(url, path):
+    if 'bad' in url:
+        raise OSError('Not an image')
+    path += '.png'
+    with open(path, 'wb') as f:
+        f.write(b'image data')
+    return 'PNG', path
+
+
+def run_collect(tmpdir, url, fetch_content, fetch_image):
+    fetch_content.return_value = PAGE
+    fetch_image.side_effect = fake_fetch_image
+
+    async def run():
+        executor = ThreadPoolExecutor(2)
+        async with Collector(base_dir=str(tmpdir), javascript=False,
+                             do_extract=False, executor=executor) as c:
+            result = await c.collect(url, meta={'license': 'GFDL'})
+        executor.shutdown()
+        return result
+    return asyncio.run(run())
+
+
+@mock.patch('artexin.asyncbatch.aiohttp', None)
+@mock.patch('artexin.asyncbatch.fetch_image')
+@mock.patch('artexin.asyncbatch.fetch_content')
+def test_collect(fetch_content, fetch_image, tmpdir):
+    """ Should fetch, process and package the page """
+    url = 'http://www.example.com/foo'
+    meta = run_collect(tmpdir, url, fetch_content, fetch_image)
+    assert 'error' not in meta
+    assert meta['title'] == 'Foo'
+    assert meta['license'] == 'GFDL'
+    assert meta['images'] == 1
+    assert meta['domain'] == 'www.example.com'
+    fetch_content.assert_called_once_with(url)
+    assert fetch_image.call_count == 2
+    with zipfile.ZipFile(meta['zipfile']) as zipball:
+        names = zipball.namelist()
+        html = zipball.read(os.path.join(meta['hash'], 'index.html'))
+    assert os.path.join(meta['hash'], 'image0000.png') in names
+    assert html.count(b'src="./image0000.png"') == 2
+    assert b'bad.png' not in html
+
+
+@mock.patch('artexin.asyncbatch.aiohttp', None)
+@mock.patch('artexin.asyncbatch.fetch_image')
+@mock.patch('artexin.asyncbatch.fetch_content')
+def test_collect_fail(fetch_content, fetch_image, tmpdir):
+    """ Should report fetch errors using the 'error' key """
+    fetch_content.side_effect = RuntimeError('Bad luck')
+    meta = run_collect(tmpdir, 'http://www.example.com/', fetch_content,
+                       fetch_image)
+    assert meta['error'] == 'Bad luck'
+    assert 'timestamp' in meta
+    assert not fetch_image.called
+
+
+def run_batch(urls, collect, **kwargs):
+    async def run():
+        with mock.patch.object(Collector, 'collect', collect):
+            async with Collector(executor=executor) as c:
+                return await c.batch(urls, **kwargs)
+    executor = ThreadPoolExecutor(1)
+    try:
+        return asyncio.run(run())
+    finally:
+        executor.shutdown()
+
+
+@mock.patch('artexin.asyncbatch.aiohttp', None)
+def test_batch_limits():
+    """ Should bound the number of pages in flight, overall and per host """
+    running = []
+    peaks = {'all': 0, 'a': 0}
+
+    async def collect(self, url, prep=[], meta={}, ready=None):
+        running.append(url)
+        peaks['all'] = max(peaks['all'], len(running))
+        peaks['a'] = max(peaks['a'], len([u for u in running if '//a' in u]))
+        await asyncio.sleep(0.01)
+        running.remove(url)
+        return {'url': url}
+
+    urls = ['http://a/%s' % i for i in range(6)]
+    urls += ['http://b%s/' % i for i in range(6)]
+    results = run_batch(urls, collect, max_per_host=2, min_interval=0,
+                        max_pages=3)
+    assert [meta['url'] for meta in results] == urls
+    assert peaks == {'all': 3, 'a': 2}
+
+
+@mock.patch('artexin.asyncbatch.aiohttp', None)
+def test_batch_timeout():
+    """ Should report pages that take too long using the 'error' key """
+    async def collect(self, url, prep=[], meta={}, ready=None):
+        if 'slow' in url:
+            await asyncio.sleep(10)
+        return {'url': url}
+
+    results = run_batch(['http://a/slow', 'http://a/fast'], collect,
+                        timeout=0.05, min_interval=0)
+    assert results[0]['error'] == 'Timed out after 0.05 seconds'
+    assert results[1] == {'url': 'http://a/fast'}
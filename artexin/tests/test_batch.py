@@ -0,0 +1,146 @@
+"""
+test_batch.py: Unit tests for ``artexin.batch`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import time
+
+from unittest import mock
+
+from ..batch import POLL_INTERVAL, ibatch, batch, make_job, run_jobs
+from ..scheduler import DomainScheduler
+
+
+def fake_collect(url, *args, **kwargs):
+    if 'slow' in url:
+        time.sleep(0.5)
+    if 'hung' in url:
+        time.sleep(60)
+    if 'crash' in url:
+        os._exit(1)
+    if 'bad' in url:
+        raise ValueError('Bad page')
+    return {'url': url}
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_completion_order():
+    """ Should yield results in order of completion """
+    urls = ['http://slow.example.com/', 'http://fast.example.com/']
+    results = [m['url'] for m in ibatch(urls, max_procs=2)]
+    assert results == ['http://fast.example.com/', 'http://slow.example.com/']
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_errors():
+    """ Should report exceptions using the 'error' key """
+    results = list(ibatch(['http://bad.example.com/'], max_procs=1))
+    assert results[0]['error'] == 'Bad page'
+    assert results[0]['domain'] == 'bad.example.com'
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_bounded_input():
+    """ Should not consume input faster than results are produced """
+    consumed = []
+
+    def urls():
+        for i in range(20):
+            consumed.append(i)
+            yield 'http://example.com/%s' % i
+
+    results = ibatch(urls(), max_procs=2, max_pending=3)
+    next(results)
+    assert len(consumed) == 3
+    assert len(list(results)) == 19
+    assert len(consumed) == 20
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_timeout():
+    """ Should give up on jobs that take too long and replace the worker """
+    urls = ['http://hung.example.com/', 'http://example.com/1',
+            'http://example.com/2']
+    start = time.time()
+    results = list(ibatch(urls, max_procs=1, timeout=0.5))
+    assert time.time() - start < 10
+    assert results[0]['url'] == 'http://hung.example.com/'
+    assert results[0]['error'] == 'Timed out after 0.5 seconds'
+    assert [m['url'] for m in results[1:]] == urls[1:]
+    assert 'error' not in results[1]
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_worker_crash():
+    """ Should report jobs whose worker died and replace the worker """
+    urls = ['http://crash.example.com/', 'http://example.com/']
+    results = list(ibatch(urls, max_procs=1))
+    assert results[0]['error'] == 'Worker process died'
+    assert results[1] == {'url': 'http://example.com/'}
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_batch_order():
+    """ Should return results in input order """
+    urls = ['http://slow.example.com/', 'http://hung.example.com/',
+            'http://fast.example.com/']
+    results = batch(urls, max_procs=3, timeout=1)
+    assert [m['url'] for m in results] == urls
+    assert 'error' in results[1]
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_per_host_limit():
+    """ Should not process more pages from a host than allowed at a time """
+    urls = ['http://slow.example.com/1', 'http://slow.example.com/2',
+            'http://example.org/']
+    start = time.time()
+    results = [m['url'] for m in ibatch(urls, max_procs=2, max_per_host=1,
+                                        min_interval=0)]
+    assert time.time() - start >= 1
+    # The page from the other host is not held up by the busy host
+    assert results == ['http://example.org/', 'http://slow.example.com/1',
+                       'http://slow.example.com/2']
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+def test_min_interval():
+    """ Should space out the start of pages from the same host """
+    urls = ['http://example.com/1', 'http://example.com/2']
+    start = time.time()
+    results = batch(urls, max_procs=2, min_interval=1)
+    assert time.time() - start >= 1
+    assert [m['url'] for m in results] == urls
+
+
+class StalledScheduler(DomainScheduler):
+    """ Scheduler that cannot tell when the first few jobs can start """
+
+    stalls = 3
+
+    def next(self, now=None):
+        if self.stalls:
+            self.stalls -= 1
+            return None
+        return super(StalledScheduler, self).next(now)
+
+    def wait_time(self, now=None):
+        return None if self.stalls else 0
+
+
+@mock.patch('artexin.batch.collect', fake_collect)
+@mock.patch('artexin.batch.time.sleep')
+def test_poll_when_idle(sleep):
+    """ Should poll instead of spinning when no job can be started """
+    jobs = [make_job('http://example.com/', None, None, None, '.', False)]
+    results = list(run_jobs(jobs, max_procs=1, scheduler=StalledScheduler()))
+    assert results[0][1] == {'url': 'http://example.com/'}
+    # Polls while the start time is unknown, then waits for the start time
+    assert sleep.call_args_list == [mock.call(POLL_INTERVAL)] * 2 + [
+        mock.call(0)]
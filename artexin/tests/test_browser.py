@@ -0,0 +1,138 @@
+"""
+test_browser.py: Unit tests for ``artexin.browser`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import threading
+
+from unittest import mock
+
+import pytest
+
+from ..browser import BrowserPool, get_pool, close_pool
+from ..fetch import fetch_rendered
+
+
+class FakeDriver(object):
+    """ Stand-in for WebDriver that records its usage """
+    started = 0
+
+    def __init__(self):
+        FakeDriver.started += 1
+        self.quit_called = False
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def execute_script(self, script, *args):
+        return ['complete', 10, 2, 0]
+
+    @property
+    def page_source(self):
+        return '<html><body>%s</body></html>' % self.urls[-1]
+
+    def quit(self):
+        self.quit_called = True
+
+
+def setup_function(function):
+    FakeDriver.started = 0
+
+
+def test_reuses_session():
+    """ Should keep the session warm between uses """
+    pool = BrowserPool(FakeDriver)
+    with pool.session() as d1:
+        pass
+    with pool.session() as d2:
+        pass
+    assert d1 is d2
+    assert FakeDriver.started == 1
+    assert not d1.quit_called
+
+
+def test_recycles_after_max_pages():
+    """ Should quit and replace session after ``max_pages`` pages """
+    pool = BrowserPool(FakeDriver, max_pages=2)
+    drivers = []
+    for i in range(3):
+        with pool.session() as driver:
+            drivers.append(driver)
+    assert drivers[0] is drivers[1]
+    assert drivers[0].quit_called
+    assert drivers[2] is not drivers[0]
+    assert FakeDriver.started == 2
+
+
+@mock.patch('artexin.browser.get_rss')
+def test_recycles_on_memory_growth(get_rss):
+    """ Should quit session when browser uses too much memory """
+    get_rss.return_value = 2048
+    pool = BrowserPool(FakeDriver, max_memory=1024)
+    with pool.session() as d1:
+        pass
+    assert d1.quit_called
+    with pool.session() as d2:
+        pass
+    assert d1 is not d2
+
+
+def test_discards_on_error():
+    """ Should quit session if an error occurs while it is in use """
+    pool = BrowserPool(FakeDriver)
+    with pytest.raises(ValueError):
+        with pool.session() as driver:
+            raise ValueError()
+    assert driver.quit_called
+    assert pool.count == 0
+
+
+def test_waits_for_free_session():
+    """ Should not start more than ``size`` sessions """
+    pool = BrowserPool(FakeDriver, size=1)
+    session = pool.acquire()
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    thread.start()
+    thread.join(0.1)
+    assert not acquired
+    pool.release(session)
+    thread.join(1)
+    assert acquired == [session]
+    assert FakeDriver.started == 1
+
+
+def test_close():
+    """ Should quit all sessions when closed """
+    pool = BrowserPool(FakeDriver, size=2)
+    s1 = pool.acquire()
+    s2 = pool.acquire()
+    pool.release(s1)
+    pool.close()
+    assert s1.driver.quit_called
+    assert not s2.driver.quit_called
+    pool.release(s2)
+    assert s2.driver.quit_called
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+
+@mock.patch('artexin.fetch.AJAX_TIMEOUT', 0)
+@mock.patch('artexin.fetch.start_browser', FakeDriver)
+def test_fetch_rendered_uses_pool():
+    """ Should render pages using pooled sessions """
+    close_pool()
+    try:
+        html = fetch_rendered('http://foo/')
+        assert html == '<html><body>http://foo/</body></html>'
+        fetch_rendered('http://bar/')
+        assert FakeDriver.started == 1
+        assert get_pool(FakeDriver).count == 1
+    finally:
+        close_pool()
@@ -0,0 +1,151 @@
+"""
+test_fetch.py: Unit tests for ``artexin.fetch`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import io
+
+from unittest import mock
+
+import pytest
+
+from PIL import Image
+
+from ..fetch import (wait_until_ready, read_image, fetch_image, sniff_image,
+                     SELECTOR_SCRIPT, CHUNK_SIZE, SNIFF_SIZE)
+
+
+def scripted_driver(*states):
+    """ Return driver whose readiness script yields ``states`` in order """
+    driver = mock.Mock()
+    states = list(states)
+    driver.execute_script.side_effect = lambda *args: (
+        states.pop(0) if len(states) > 1 else states[0])
+    return driver
+
+
+@mock.patch('artexin.fetch.READY_CHECKS', 2)
+def test_dom_quiescence():
+    """ Should be ready once DOM and resources stop changing """
+    driver = scripted_driver(['loading', 10, 1, 0],
+                             ['complete', 20, 4, 0],
+                             ['complete', 30, 6, 0],
+                             ['complete', 30, 6, 0],
+                             ['complete', 30, 6, 0])
+    assert wait_until_ready(driver, timeout=5, poll=0)
+    assert driver.execute_script.call_count == 5
+
+
+@mock.patch('artexin.fetch.READY_CHECKS', 2)
+def test_pending_ajax():
+    """ Should not be ready while there are AJAX requests in progress """
+    driver = scripted_driver(['complete', 30, 6, 1])
+    assert not wait_until_ready(driver, timeout=0.05, poll=0.01)
+
+
+def test_selector():
+    """ Should be ready once selector matches """
+    driver = scripted_driver(False, False, True)
+    assert wait_until_ready(driver, '#content', timeout=5, poll=0)
+    driver.execute_script.assert_called_with(SELECTOR_SCRIPT, '#content')
+    assert driver.execute_script.call_count == 3
+
+
+def test_callable():
+    """ Should be ready when callable returns ``True`` """
+    ready = mock.Mock(side_effect=[False, True])
+    driver = mock.Mock()
+    assert wait_until_ready(driver, ready, timeout=5, poll=0)
+    ready.assert_called_with(driver)
+
+
+def test_timeout():
+    """ Should give up after timeout """
+    ready = mock.Mock(return_value=False)
+    assert not wait_until_ready(mock.Mock(), ready, timeout=0.05, poll=0.01)
+    assert ready.call_count > 1
+
+
+class FakeResponse(object):
+
+    def __init__(self, chunks, headers={}):
+        self.chunks = chunks
+        self.headers = headers
+        self.read_chunks = 0
+
+    def stream(self, amt):
+        for chunk in self.chunks:
+            self.read_chunks += 1
+            yield chunk
+
+
+def test_read_image():
+    """ Should return the content of images """
+    resp = FakeResponse([b'\x89PNG\r\n', b'\x1a\n' + b'\x00' * 20])
+    content = read_image(resp, 'http://example.com/a.png')
+    assert content == b'\x89PNG\r\n\x1a\n' + b'\x00' * 20
+
+
+def test_read_image_not_image():
+    """ Should stop reading as soon as the content turns out not an image """
+    resp = FakeResponse([b'<!DOCTYPE html><html>' + b'x' * SNIFF_SIZE] +
+                        [b'x' * CHUNK_SIZE] * 10)
+    with pytest.raises(OSError):
+        read_image(resp, 'http://example.com/a.png')
+    assert resp.read_chunks == 1
+
+
+@pytest.mark.parametrize('fmt', ['EPS', 'IM', 'PCX', 'PPM', 'PNG', 'XBM'])
+def test_sniff_image(fmt):
+    """ Should recognize formats the same way as PIL """
+    buff = io.BytesIO()
+    Image.new('1' if fmt == 'XBM' else 'RGB', (4, 4)).save(buff, fmt)
+    assert sniff_image(buff.getvalue()[:SNIFF_SIZE]) == fmt
+    assert Image.open(buff).format == fmt
+
+
+def test_read_image_late_signature():
+    """ Should keep reading formats identified further into the content """
+    resp = FakeResponse([b'\xff' * 1024] * 4)
+    with pytest.raises(OSError):
+        read_image(resp, 'http://example.com/a.pcd')
+    assert resp.read_chunks == 3
+    resp = FakeResponse([b'\xff' * 1024] * 2 + [b'PCD_' + b'\x00' * 100])
+    content = read_image(resp, 'http://example.com/a.pcd')
+    assert content.startswith(b'PCD_', 2048)
+
+
+def test_read_image_too_large():
+    """ Should stop reading when image exceeds maximum size """
+    resp = FakeResponse([b'GIF89a' + b'x' * 100] * 10)
+    with pytest.raises(OSError):
+        read_image(resp, 'http://example.com/a.gif', max_size=250)
+    assert resp.read_chunks == 3
+    resp = FakeResponse([b'GIF89a'], {'Content-Length': '251'})
+    with pytest.raises(OSError):
+        read_image(resp, 'http://example.com/a.gif', max_size=250)
+    assert resp.read_chunks == 0
+
+
+@mock.patch('artexin.fetch.get_store', mock.Mock(return_value=None))
+@mock.patch('artexin.fetch.get_session')
+def test_fetch_image_streams(get_session, tmpdir):
+    """ Should stream the image and drop connection on bad content """
+    session = get_session.return_value
+    session.cache = None
+    resp = FakeResponse([b'<html>' + b'x' * 100])
+    resp.close = mock.Mock()
+    resp.release_conn = mock.Mock()
+    session.request.return_value = resp
+    with pytest.raises(OSError):
+        fetch_image('http://example.com/a.png', str(tmpdir.join('image')))
+    session.request.assert_called_once_with('http://example.com/a.png',
+                                            timeout=2, stream=True)
+    assert resp.close.called
+    assert resp.release_conn.called
+    assert tmpdir.listdir() == []
@@ -0,0 +1,151 @@
+"""
+test_htmlrules.py: Unit tests for declarative cleanup rules
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import pytest
+
+from unittest import mock
+
+from bs4 import BeautifulSoup
+from bs4.element import Tag
+
+from .. import preprocessors
+from ..htmlrules import RuleSet
+from ..preprocessors import pp_fixheaders, pp_wikipedia
+
+
+WIKI_PAGE = """<html><body>
+<h1 id="firstHeading" class="firstHeading"><span>Helianthus</span></h1>
+<div id="mw-content-text"><div class="hatnote">See also</div>
+<p><a href="/wiki/Plant">Plant</a> <a class="new" href="/w/index.php?a">new</a>
+<a href="http://example.com/">external</a></p>
+<h2>History<span class="mw-editsection"><a href="/w/e">edit</a></span></h2>
+<div class="thumb"><a class="image" href="/wiki/File:x"><img src="x.jpg"></a>
+<div class="thumbcaption"><div class="magnify">zoom</div>Caption</div></div>
+<table class="navbox"><tr><td>nav</td></tr></table>
+<table class="metadata plainlinks"><tr><td>meta</td></tr></table></div>
+<div id="footer">Footer</div></body></html>"""
+
+
+def parse(html):
+    return BeautifulSoup(html, 'lxml')
+
+
+class TestRuleSet(object):
+
+    def test_decompose_skips_contents(self):
+        """ Should not visit elements inside removed elements """
+        rules = RuleSet([('div.gone', 'decompose'), ('p', 'collect', 'p')])
+        soup = parse('<div class="gone"><p>a</p></div><p>b</p>')
+        found = rules.apply(soup)
+        assert [p.string for p in found['p']] == ['b']
+        assert str(soup.body) == '<body><p>b</p></body>'
+
+    def test_first_structural_rule_wins(self):
+        """ Should apply only the first structural action to an element """
+        rules = RuleSet([
+            ('a.image', 'unwrap'),
+            ('a[href^="/wiki/"]', 'unwrap'),
+            ('a', 'decompose'),
+        ])
+        soup = parse('<p><a class="image" href="/wiki/x"><b>x</b></a>'
+                     '<a href="/wiki/y">y</a><a href="z">z</a></p>')
+        rules.apply(soup)
+        assert str(soup.p) == '<p><b>x</b>y</p>'
+
+    def test_attribute_selectors(self):
+        """ Should match attribute presence, value, and prefix """
+        rules = RuleSet([
+            ('[data-x]', 'collect', 'present'),
+            ('*[lang=en]', 'collect', 'equal'),
+            ("span[class^='fo']", 'collect', 'prefix'),
+        ])
+        soup = parse('<span data-x="" lang="en" class="foo bar">a</span>'
+                     '<span lang="de" class="bar foo">b</span>')
+        found = rules.apply(soup)
+        assert len(found['present']) == 1
+        assert len(found['equal']) == 1
+        assert len(found['prefix']) == 1
+
+    def test_move(self):
+        """ Should move elements into the collected container """
+        rules = RuleSet([
+            ('div#main', 'collect', 'main'),
+            ('p.note', 'move', 'main'),
+            ('h1', 'move', 'main', 0),
+        ])
+        soup = parse('<h1>T</h1><p class="note">n</p><div id="main">'
+                     '<p>a</p></div>')
+        rules.apply(soup)
+        assert str(soup.body) == ('<body><div id="main"><h1>T</h1><p>a</p>'
+                                  '<p class="note">n</p></div></body>')
+
+    def test_move_without_target(self):
+        """ Should leave elements in place if there is no container """
+        rules = RuleSet([('h1', 'move', 'main')])
+        soup = parse('<h1>T</h1>')
+        rules.apply(soup)
+        assert soup.h1.parent.name == 'body'
+
+    @pytest.mark.parametrize('rule', [
+        ('div > p', 'decompose'),
+        ('div p', 'decompose'),
+        ('', 'decompose'),
+        ('p', 'remove'),
+    ])
+    def test_invalid_rules(self, rule):
+        """ Should reject unsupported selectors and actions """
+        with pytest.raises(ValueError):
+            RuleSet([rule])
+
+
+class TestPreprocessors(object):
+
+    def test_single_walk(self):
+        """ Should not scan the document with find_all() """
+        soup = parse(WIKI_PAGE)
+        with mock.patch.object(Tag, 'find_all') as find_all:
+            pp_wikipedia(soup)
+            pp_fixheaders(soup)
+        assert not find_all.called
+
+    def test_wikipedia(self):
+        """ Should keep only cleaned up article body with title """
+        soup = pp_wikipedia(parse(WIKI_PAGE))
+        body = soup.body
+        assert [c.name for c in body.children] == ['div']
+        assert str(body.div.h1) == '<h1>Helianthus</h1>'
+        assert body.div.h1 is body.div.contents[0]
+        text = str(body)
+        for removed in ['See also', 'edit', 'zoom', 'nav', 'meta', 'Footer',
+                        '/wiki/', 'index.php']:
+            assert removed not in text
+        assert '<img src="x.jpg"/>' in text
+        assert '<p>Caption</p>' in text
+        assert '<a href="http://example.com/">external</a>' in text
+
+    def test_wikipedia_cleans_body_only(self):
+        """ Should apply cleanup rules only to the extracted body """
+        soup = parse(WIKI_PAGE)
+        rules = preprocessors.WIKIPEDIA_RULES
+        with mock.patch.object(rules, 'apply', wraps=rules.apply) as apply:
+            pp_wikipedia(soup)
+        apply.assert_called_once_with(soup.body.div)
+
+    def test_wikipedia_without_body(self):
+        """ Should clean up the whole page if there is no body container """
+        soup = pp_wikipedia(parse('<h1>T</h1><p><a href="/wiki/A">A</a>'
+                                  '<span class="mw-editsection">e</span></p>'))
+        assert str(soup.body) == '<body><h1>T</h1><p>A</p></body>'
+
+    def test_fixheaders(self):
+        """ Should promote headings so that the top-most is H1 """
+        html = '<h3>a</h3><div><h4>b</h4></div><h3>c</h3>'
+        assert pp_fixheaders(html) == ('<html><body><h1>a</h1><div><h2>b</h2>'
+                                       '</div><h1>c</h1></body></html>')
@@ -0,0 +1,97 @@
+"""
+test_httpcache.py: Unit tests for ``artexin.httpcache`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+from unittest import mock
+
+from ..httpcache import HTTPCache
+
+
+URL = 'http://example.com/foo.png'
+
+
+def response(status=200, data=b'', **headers):
+    return mock.Mock(status=status, data=data, headers=headers)
+
+
+def test_fresh_response_is_not_requested(tmpdir):
+    """ Fresh responses should be read from the cache """
+    cache = HTTPCache(str(tmpdir))
+    session = mock.Mock()
+    session.request.return_value = response(data=b'foo',
+                                            **{'Cache-Control': 'max-age=60'})
+    assert cache.fetch(session, URL) == b'foo'
+    assert cache.fetch(session, URL) == b'foo'
+    assert session.request.call_count == 1
+
+
+def test_conditional_request(tmpdir):
+    """ Stale responses should be revalidated """
+    cache = HTTPCache(str(tmpdir))
+    session = mock.Mock()
+    session.request.return_value = response(
+        data=b'foo', ETag='"abc"', **{'Last-Modified': 'yesterday'})
+    cache.fetch(session, URL)
+    session.request.return_value = response(status=304)
+    assert cache.fetch(session, URL, timeout=2) == b'foo'
+    session.request.assert_called_with(
+        URL, timeout=2, headers={'If-None-Match': '"abc"',
+                                 'If-Modified-Since': 'yesterday'})
+
+
+def test_changed_response(tmpdir):
+    """ Changed responses should replace stored ones """
+    cache = HTTPCache(str(tmpdir))
+    session = mock.Mock()
+    session.request.return_value = response(data=b'foo', ETag='"abc"')
+    cache.fetch(session, URL)
+    session.request.return_value = response(data=b'bar', ETag='"def"')
+    assert cache.fetch(session, URL) == b'bar'
+    assert cache.get(URL)['etag'] == '"def"'
+
+
+def test_uncacheable(tmpdir):
+    """ Should not store responses that cannot be reused """
+    cache = HTTPCache(str(tmpdir))
+    assert not cache.store(URL, {'Cache-Control': 'no-store',
+                                 'ETag': '"abc"'}, b'foo')
+    assert not cache.store(URL, {}, b'foo')
+    assert cache.get(URL) is None
+
+
+def test_lru_eviction(tmpdir):
+    """ Should evict least recently used responses when over the limit """
+    cache = HTTPCache(str(tmpdir), max_size=35)
+    headers = {'ETag': '"abc"'}
+    for i in range(3):
+        url = 'http://example.com/%s' % i
+        cache.store(url, headers, b'x' * 10)
+        body_path = cache.paths(url)[0]
+        os.utime(body_path, (i, i))
+    # Use the oldest response so that it becomes the most recently used
+    assert cache.read('http://example.com/0') == b'x' * 10
+    cache.store('http://example.com/3', headers, b'x' * 10)
+    assert cache.get('http://example.com/0') is not None
+    assert cache.get('http://example.com/1') is None
+    assert cache.get('http://example.com/2') is not None
+    assert cache.get('http://example.com/3') is not None
+
+
+def test_replaced_response_size(tmpdir):
+    """ Replacing a response should not count the old body """
+    cache = HTTPCache(str(tmpdir), max_size=35)
+    headers = {'ETag': '"abc"'}
+    cache.store('http://example.com/0', headers, b'x' * 10)
+    cache.store(URL, headers, b'x' * 10)
+    for _ in range(3):
+        cache.store(URL, headers, b'y' * 10)
+    assert cache.size == 20
+    assert cache.get('http://example.com/0') is not None
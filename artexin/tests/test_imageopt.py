@@ -0,0 +1,34 @@
+"""
+test_imageopt.py: Unit tests for ``artexin.imageopt`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from PIL import Image
+
+from ..imageopt import ORIENTATION, optimize_image
+
+
+def test_exif_orientation(tmpdir):
+    """ Should rotate images according to their EXIF orientation """
+    path = str(tmpdir.join('image0000.jpg'))
+    img = Image.new('RGB', (40, 20), 'red')
+    # Left half is red and right half is blue when stored
+    img.paste((0, 0, 255), (20, 0, 40, 20))
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6  # Rotate 90 degrees clockwise for display
+    img.save(path, 'JPEG', exif=exif, quality=95)
+    new_path, before, after = optimize_image(path, quality=95)
+    assert new_path == path
+    with Image.open(new_path) as optimized:
+        assert optimized.size == (20, 40)
+        assert ORIENTATION not in optimized.getexif()
+        # Rotated clockwise, so the left half ends up at the top
+        red, green, blue = optimized.getpixel((10, 5))
+        assert red > 200 and blue < 50
+        red, green, blue = optimized.getpixel((10, 35))
+        assert blue > 200 and red < 50
@@ -0,0 +1,140 @@
+"""
+test_imagestore.py: Unit tests for ``artexin.imagestore`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import datetime
+import io
+import os
+import zipfile
+
+from unittest import mock
+
+from PIL import Image
+
+from ..fetch import fetch_image
+from ..imagestore import ImageStore, set_store
+from ..pack import create_package, find_shared, package_page
+
+
+def make_png(color='red'):
+    buff = io.BytesIO()
+    Image.new('RGB', (4, 4), color).save(buff, 'PNG')
+    return buff.getvalue()
+
+
+class TestImageStore(object):
+
+    def teardown_method(self, method):
+        set_store(None)
+
+    def make_store(self, tmpdir, **kwargs):
+        store = ImageStore(str(tmpdir.mkdir('store')), **kwargs)
+        set_store(store)
+        return store
+
+    @mock.patch('artexin.fetch.fetch_image_content')
+    def test_fetch_once(self, fetch_image_content, tmpdir):
+        """ Should download each image URL only once """
+        self.make_store(tmpdir)
+        fetch_image_content.return_value = make_png()
+        imgdir = tmpdir.mkdir('img')
+        first = fetch_image('http://example.com/a.png',
+                            str(imgdir.join('image0000')))
+        second = fetch_image('http://example.com/a.png',
+                             str(imgdir.join('image0001')))
+        assert fetch_image_content.call_count == 1
+        assert first == ('PNG', str(imgdir.join('image0000.png')))
+        assert second == ('PNG', str(imgdir.join('image0001.png')))
+        assert (imgdir.join('image0001.png').read_binary() ==
+                fetch_image_content.return_value)
+
+    @mock.patch('artexin.fetch.fetch_image_content')
+    def test_dedupe_content(self, fetch_image_content, tmpdir):
+        """ Should store identical images from different URLs once """
+        store = self.make_store(tmpdir)
+        fetch_image_content.return_value = make_png()
+        imgdir = tmpdir.mkdir('img')
+        fetch_image('http://a.example.com/logo.png',
+                    str(imgdir.join('image0000')))
+        fetch_image('http://b.example.com/logo.png',
+                    str(imgdir.join('image0001')))
+        assert fetch_image_content.call_count == 2
+        blobs = [f for _, _, files in os.walk(os.path.join(store.path,
+                                                           'blobs'))
+                 for f in files]
+        assert len(blobs) == 1
+
+    @mock.patch('artexin.fetch.fetch_image_content')
+    def test_invalid_image(self, fetch_image_content, tmpdir):
+        """ Should not store content that is not an image """
+        store = self.make_store(tmpdir)
+        fetch_image_content.return_value = b'not an image'
+        try:
+            fetch_image('http://example.com/a.png',
+                        str(tmpdir.join('image0000')))
+            assert False, 'Did not raise an exception'
+        except OSError:
+            pass
+        assert store.lookup('http://example.com/a.png') is None
+
+    def test_max_age(self, tmpdir):
+        """ Should ignore index entries older than max_age """
+        store = self.make_store(tmpdir, max_age=60)
+        store.add('http://example.com/a.png', make_png(), 'PNG', '.png')
+        assert store.lookup('http://example.com/a.png') is not None
+        with mock.patch('time.time', return_value=2 ** 40):
+            assert store.lookup('http://example.com/a.png') is None
+
+    @mock.patch('artexin.fetch.fetch_image_content')
+    def test_shared_images(self, fetch_image_content, tmpdir):
+        """ Should reference published images instead of packaging them """
+        store = self.make_store(tmpdir)
+        fetch_image_content.return_value = make_png()
+        imgdir = tmpdir.mkdir('img')
+        path = fetch_image('http://example.com/a.png',
+                           str(imgdir.join('image0000')))[1]
+        digest = store.lookup('http://example.com/a.png')['digest']
+        assert find_shared([path]) == ({}, {'image0000.png': digest})
+        store.publish(digest)
+        shared, unpublished = find_shared([path])
+        assert shared == {'image0000.png': digest}
+        assert unpublished == {}
+        meta = {'url': 'http://example.com/',
+                'timestamp': datetime.datetime.utcnow()}
+        meta = create_package('<html></html>', [path], meta,
+                              str(tmpdir.mkdir('out')), shared=shared)
+        assert meta['shared_images'] == shared
+        with zipfile.ZipFile(meta['zipfile']) as zipball:
+            names = [os.path.basename(n) for n in zipball.namelist()]
+        assert sorted(names) == ['index.html', 'info.json']
+
+    @mock.patch('artexin.fetch.fetch_image_content')
+    def test_first_package_includes_images(self, fetch_image_content,
+                                           tmpdir):
+        """ Should include images until a package has published them """
+        self.make_store(tmpdir)
+        fetch_image_content.return_value = make_png()
+        out_dir = str(tmpdir.mkdir('out'))
+        names = []
+        for page in ('first', 'second'):
+            src_dir = tmpdir.mkdir(page)
+            path = fetch_image('http://example.com/a.png',
+                               str(src_dir.join('image0000')))[1]
+            meta = {'url': 'http://example.com/%s' % page,
+                    'timestamp': datetime.datetime.utcnow()}
+            meta = package_page('<html></html>', meta, str(src_dir),
+                                base_dir=out_dir, images=[path],
+                                share_images=True)
+            with zipfile.ZipFile(meta['zipfile']) as zipball:
+                names.append(sorted(os.path.basename(n)
+                                    for n in zipball.namelist()))
+        assert fetch_image_content.call_count == 1
+        assert names == [['image0000.png', 'index.html', 'info.json'],
+                         ['index.html', 'info.json']]
+        assert 'shared_images' in meta
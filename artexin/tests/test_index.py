@@ -0,0 +1,50 @@
+"""
+test_index.py: Unit tests for ``artexin.index`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from ..index import (get_counts, get_corpus_counts, iter_shard_counts,
+                     split_sentences, SHARDS_AHEAD)
+
+
+TEXTS = [
+    'The quick brown fox jumps. The lazy dog sleeps.',
+    'A quick brown dog. Foxes are quick.',
+    'Nothing to see here.',
+    'The dog and the fox are friends.',
+    'Brown is a color. The fox is brown.',
+] * 3
+
+
+def test_corpus_counts():
+    """ Should count corpus in parallel the same as sequentially """
+    sentences = [s for text in TEXTS for s in split_sentences(text)]
+    expected = get_counts(sentences)
+    assert get_corpus_counts(TEXTS, processes=2, shard_size=4) == expected
+    assert get_corpus_counts(TEXTS, processes=1, shard_size=4) == expected
+    assert get_corpus_counts(iter(TEXTS), processes=2,
+                             shard_size=1) == expected
+
+
+def test_shards_read_lazily():
+    """ Should not read texts far ahead of counting them """
+    consumed = []
+
+    def texts():
+        for text in TEXTS:
+            consumed.append(text)
+            yield text
+
+    results = iter_shard_counts(texts(), processes=2, shard_size=1)
+    next(results)
+    assert len(consumed) <= 2 * SHARDS_AHEAD + 1
+    assert len(list(results)) == len(TEXTS) - 1
+
+
+def test_corpus_counts_empty():
+    assert get_corpus_counts([], processes=2) == ({}, {}, 0)
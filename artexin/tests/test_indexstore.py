@@ -0,0 +1,121 @@
+"""
+test_indexstore.py: Unit tests for ``artexin.indexstore`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from unittest import mock
+
+from ..indexstore import IndexStore, Segment, write_segment
+
+
+def add_docs(store):
+    store.add('http://example.com/1', {'foo': 2, 'bar': 1}, {'foo bar': 1}, 3)
+    store.add('http://example.com/2', {'bar': 4}, {}, 4)
+    store.add('http://example.com/3', {'foo': 1, 'čaj': 1}, {'foo čaj': 1},
+              2)
+
+
+def test_persistence(tmpdir):
+    """ Should find flushed documents after reopening the index """
+    with IndexStore(str(tmpdir)) as store:
+        add_docs(store)
+    with IndexStore(str(tmpdir)) as store:
+        assert store.lookup('foo') == [('http://example.com/1', 2),
+                                       ('http://example.com/3', 1)]
+        assert store.lookup('čaj') == [('http://example.com/3', 1)]
+        assert store.lookup_pair('foo', 'bar') == [('http://example.com/1',
+                                                    1)]
+        assert store.lookup('missing') == []
+        assert store.count('bar') == 5
+        assert store.docs[1] == ('http://example.com/2', 4)
+
+
+def test_segments_and_merge(tmpdir):
+    """ Should look up across segments and merge them into one """
+    store = IndexStore(str(tmpdir), flush_docs=1)
+    add_docs(store)
+    assert len(store.segments) == 3
+    before = store.lookup('foo'), store.lookup('bar')
+    store.merge()
+    assert len(store.segments) == 1
+    assert (store.lookup('foo'), store.lookup('bar')) == before
+    assert len(tmpdir.listdir(lambda p: p.basename.startswith('seg'))) == 1
+    store.add('http://example.com/4', {'foo': 7}, {}, 7)
+    store.close()
+    store = IndexStore(str(tmpdir))
+    assert store.lookup('foo')[-1] == ('http://example.com/4', 7)
+    store.close()
+
+
+def test_unflushed_documents_ignored(tmpdir):
+    """ Should ignore document records written after the last flush """
+    with IndexStore(str(tmpdir)) as store:
+        add_docs(store)
+    tmpdir.join('docs.tsv').write('1\thttp://example.com/partial\n',
+                                  mode='a')
+    with IndexStore(str(tmpdir)) as store:
+        assert len(store.docs) == 3
+
+
+def test_segment_lexicon_order(tmpdir):
+    """ Should find every key in a segment using binary search """
+    keys = sorted(['a', 'ab', 'b', 'ba', 'z', 'ž', 'a b', 'ab c'])
+    path = str(tmpdir.join('seg'))
+    write_segment(path, [(key, [(n, n + 1)]) for n, key in enumerate(keys)])
+    seg = Segment(path)
+    try:
+        assert len(seg) == len(keys)
+        for n, key in enumerate(keys):
+            assert seg.postings(key) == [(n, n + 1)]
+        assert seg.postings('') == []
+        assert seg.postings('zz') == []
+        assert [key for key, _ in seg.items()] == keys
+    finally:
+        seg.close()
+
+
+@mock.patch('artexin.indexstore.SPILL_SIZE', 3)
+def test_segment_streamed(tmpdir):
+    """ Should write segments from a generator, spilling offsets in parts """
+    keys = ['k%03d' % n for n in range(10)]
+    path = str(tmpdir.join('seg'))
+    write_segment(path, ((key, [(n, 1), (n + 1, 2)])
+                         for n, key in enumerate(keys)))
+    seg = Segment(path)
+    try:
+        assert list(seg.items()) == [(key, [(n, 1), (n + 1, 2)])
+                                     for n, key in enumerate(keys)]
+    finally:
+        seg.close()
+    assert tmpdir.listdir() == [tmpdir.join('seg')]
+
+
+TEXTS = [
+    'The quick brown fox jumps. The lazy dog sleeps.',
+    'A quick brown dog. Foxes are quick.',
+    'Nothing to see here.',
+    'The dog and the fox are friends.',
+    'Brown is a color. The fox is brown.',
+]
+
+
+def test_add_corpus(tmpdir):
+    """ Should index documents in parallel the same as one by one """
+    docs = [('doc%s' % n, text) for n, text in enumerate(TEXTS)]
+    serial = IndexStore(str(tmpdir.mkdir('serial')))
+    for doc_id, text in docs:
+        serial.add_text(doc_id, text)
+    serial.flush()
+    parallel = IndexStore(str(tmpdir.mkdir('parallel')))
+    assert parallel.add_corpus(iter(docs), processes=2, shard_size=1) == 5
+    assert len(parallel.segments) == 1
+    assert parallel.docs == serial.docs
+    for key in ('the', 'fox', 'brown', 'quick brown', 'the fox'):
+        assert parallel.lookup(key) == serial.lookup(key)
+    serial.close()
+    parallel.close()
@@ -0,0 +1,77 @@
+"""
+test_lxmlutils.py: Unit tests for the lxml fast path
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import pytest
+
+from unittest import mock
+
+from bs4 import BeautifulSoup
+
+from .. import lxmlutils
+from ..extract import strip_links
+from ..preprocessors import pp_fixheaders
+
+
+DOCUMENTS = [
+    '',
+    '<p>plain</p>',
+    '﻿<p>byte order mark</p>',
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd"><p>a</p>',
+    '<!DOCTYPE html SYSTEM "about:legacy-compat"><p>a</p>',
+    '<pre>  \n  <a href="x">  </a>  </pre>   \n  <p>  </p>',
+    '<textarea>  </textarea><!--   --><!-- c --><?php echo 1 ?>',
+    '<a href="/x"><a href="#y">n</a>t</a>tail',
+    '<script>if (a < b && c > d) {}</script><style>p>a{}</style>',
+    '<p title=\'say "hi"\' data-x="it\'s &quot;x&quot;">q</p>',
+    '<DIV CLASS=" A  B">U</DIV><a rel=" nofollow  me" href=x>r</a>',
+    '&amp; &lt; &gt; &nbsp; &copy; &#x1F600;',
+    '<h6>a</h6><h5>b<a href=#>c</a></h5>',
+    '<br><img src=a><wbr>x<p>y',
+    '<head><meta http-equiv="Content-Type" '
+    'content="text/html; charset=ISO-8859-1"></head>',
+    '<meta charset=latin1><input checked disabled value="">',
+    '<!-- before --><html>x</html><!-- after -->',
+    '<p>a</p>\r\n\t\x0c<p>b</p>',
+]
+
+
+@pytest.mark.parametrize('html', DOCUMENTS)
+@pytest.mark.parametrize('fast_fn,transform', [
+    (lxmlutils.strip_links, strip_links),
+    (lxmlutils.fixheaders, pp_fixheaders),
+])
+def test_same_as_soup(html, fast_fn, transform):
+    """ Should give the same output as the BeautifulSoup implementation """
+    soup = BeautifulSoup(html, 'lxml')
+    assert fast_fn(html) == str(transform(soup))
+
+
+def test_fast_path_for_source():
+    """ Should not build a soup object for HTML source """
+    with mock.patch('artexin.htmlutils.BeautifulSoup') as soup_cls:
+        assert strip_links('<a href="/x">x</a>') == \
+            '<html><body>x</body></html>'
+    assert not soup_cls.called
+
+
+def test_soup_not_serialized():
+    """ Should transform soup objects in place """
+    soup = BeautifulSoup('<h2>a</h2>', 'lxml')
+    assert pp_fixheaders(soup) is soup
+    assert str(soup.h1) == '<h1>a</h1>'
+
+
+@mock.patch.object(lxmlutils, 'ENABLED', False)
+def test_disabled():
+    """ Should fall back to BeautifulSoup when lxml cannot be used """
+    assert lxmlutils.fixheaders('<h2>a</h2>') is None
+    html = pp_fixheaders('<h2>a</h2>')
+    assert html == '<html><body><h1>a</h1></body></html>'
@@ -0,0 +1,133 @@
+"""
+test_manifest.py: Unit tests for incremental collection
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import asyncio
+import datetime
+import os
+
+from unittest import mock
+
+from ..asyncbatch import Collector
+from ..htmlutils import get_soup
+from ..manifest import Manifest, fingerprint, set_manifest
+from ..pack import collect
+
+
+PAGE = """<html><head><title>Foo</title></head>
+<body><p>This is some paragraph text for the page.</p></body></html>"""
+URL = 'http://example.com/foo'
+
+
+class TestIncrementalCollect(object):
+
+    def teardown_method(self, method):
+        set_manifest(None)
+
+    def collect(self, tmpdir, page=PAGE, meta={}, **kwargs):
+        with mock.patch('artexin.pack.fetch_content', return_value=page):
+            return collect(URL, meta=meta, base_dir=str(tmpdir),
+                           javascript=False, do_extract=False, **kwargs)
+
+    def test_unchanged(self, tmpdir):
+        """ Should reuse the package when the page has not changed """
+        set_manifest(Manifest(str(tmpdir.mkdir('manifest'))))
+        out_dir = tmpdir.mkdir('out')
+        first = self.collect(out_dir)
+        assert 'unchanged' not in first
+        with mock.patch('artexin.pack.package_page') as package_page:
+            second = self.collect(out_dir)
+        assert package_page.call_count == 0
+        assert second['unchanged'] is True
+        assert second['zipfile'] == first['zipfile']
+        assert second['hash'] == first['hash']
+        assert isinstance(second['timestamp'], datetime.datetime)
+        assert sorted(second) == sorted(dict(first, unchanged=True))
+
+    def test_changed(self, tmpdir):
+        """ Should package the page again when its content changed """
+        set_manifest(Manifest(str(tmpdir.mkdir('manifest'))))
+        out_dir = tmpdir.mkdir('out')
+        self.collect(out_dir)
+        page = PAGE.replace('some', 'other')
+        changed = self.collect(out_dir, page=page)
+        assert 'unchanged' not in changed
+        changed_meta = self.collect(out_dir, page=page,
+                                    meta={'license': 'GFDL'})
+        assert 'unchanged' not in changed_meta
+
+    def test_options_changed(self, tmpdir):
+        """ Should package the page again when packaging options changed """
+        set_manifest(Manifest(str(tmpdir.mkdir('manifest'))))
+        out_dir = tmpdir.mkdir('out')
+        self.collect(out_dir, minify=False)
+        for options in ({'minify': True},
+                        {'optimize_images': True},
+                        {'share_images': True}):
+            changed = self.collect(out_dir, **options)
+            assert 'unchanged' not in changed, options
+        self.collect(out_dir, minify=True)
+        # Default options are the same as when they are passed explicitly
+        with mock.patch('artexin.pack.MINIFY', True):
+            unchanged = self.collect(out_dir)
+        assert unchanged['unchanged'] is True
+
+    def test_missing_package(self, tmpdir):
+        """ Should package the page again if the package is gone """
+        set_manifest(Manifest(str(tmpdir.mkdir('manifest'))))
+        out_dir = tmpdir.mkdir('out')
+        first = self.collect(out_dir)
+        os.unlink(first['zipfile'])
+        second = self.collect(out_dir)
+        assert 'unchanged' not in second
+        assert os.path.exists(second['zipfile'])
+
+    @mock.patch('artexin.asyncbatch.aiohttp', None)
+    def test_engines_agree(self, tmpdir):
+        """ Should see pages collected by either engine as unchanged """
+        set_manifest(Manifest(str(tmpdir.mkdir('manifest'))))
+        out_dir = tmpdir.mkdir('out')
+        page = PAGE.replace('</p>', '<img src="/a.png"><img></p>')
+        meta = {'license': 'GFDL'}
+
+        def fetch_image(url, path):
+            with open(path + '.png', 'wb') as f:
+                f.write(b'image data')
+            return 'PNG', path + '.png'
+
+        async def run():
+            async with Collector(base_dir=str(out_dir), javascript=False,
+                                 do_extract=False) as collector:
+                return await collector.collect(URL, meta=meta)
+
+        with mock.patch('artexin.extract.fetch_image', fetch_image):
+            first = self.collect(out_dir, page=page, meta=meta)
+        assert first['images'] == 1
+        with mock.patch('artexin.asyncbatch.fetch_content',
+                        return_value=page):
+            second = asyncio.run(run())
+        assert second['unchanged'] is True
+        assert second['zipfile'] == first['zipfile']
+
+    def test_disabled(self, tmpdir):
+        """ Should always package the page when there's no manifest """
+        out_dir = tmpdir.mkdir('out')
+        self.collect(out_dir)
+        assert 'unchanged' not in self.collect(out_dir)
+
+
+def test_fingerprint_ignores_timestamp():
+    meta = {'license': 'GFDL'}
+    assert fingerprint('<p>foo</p>', meta) == fingerprint(
+        '<p>foo</p>', dict(meta, timestamp=datetime.datetime.utcnow()))
+
+
+def test_fingerprint_soup():
+    soup = get_soup(PAGE)
+    assert fingerprint(soup) == fingerprint(str(soup))
@@ -2,10 +2,16 @@ import copy
 import datetime
 import os
 import urllib
+import zipfile
 
 from unittest import mock
 
-from ..pack import json, create_zipball, collect, serialize_datetime
+from bs4 import BeautifulSoup
+
+from ..htmlutils import get_soup
+from ..pack import (json, create_zipball, create_package, write_zipball,
+                    collect, prepare_page, serialize_datetime)
+from ..preprocessors import pp_fixheaders, pp_noop
 
 
 class TestCreateZipball(object):
@@ -201,6 +207,107 @@ class TestCreateZipball(object):
         assert meta == expected_meta
 
 
+class TestCreatePackage(object):
+
+    meta = {'url': 'http://en.wikipedia.org/wiki/Outernet',
+            'title': 'Outernet',
+            'timestamp': datetime.datetime(2014, 1, 1)}
+
+    def make_images(self, tmpdir):
+        images = []
+        for idx, ext in enumerate(['png', 'jpg']):
+            path = tmpdir.join('image%04d.%s' % (idx, ext))
+            path.write_binary(b'image %d' % idx)
+            images.append(str(path))
+        return images
+
+    def test_create_package(self, tmpdir):
+        images = self.make_images(tmpdir.mkdir('src'))
+        out_dir = tmpdir.mkdir('out')
+        meta = create_package('<html></html>', images, self.meta,
+                              str(out_dir))
+        checksum = meta['hash']
+        assert meta['zipfile'] == str(out_dir.join(checksum + '.zip'))
+        assert meta['timestamp'] == self.meta['timestamp']
+        assert meta['size'] == os.stat(meta['zipfile']).st_size
+        # Only the zipball is created
+        assert out_dir.listdir() == [out_dir.join(checksum + '.zip')]
+        with zipfile.ZipFile(meta['zipfile']) as zipball:
+            assert sorted(zipball.namelist()) == [
+                checksum + '/image0000.png',
+                checksum + '/image0001.jpg',
+                checksum + '/index.html',
+                checksum + '/info.json']
+            assert zipball.read(checksum + '/index.html') == b'<html></html>'
+            assert zipball.read(checksum + '/image0001.jpg') == b'image 1'
+            info = json.loads(zipball.read(checksum + '/info.json').decode())
+        assert info['timestamp'] == '2014-01-01 00:00:00 UTC'
+        assert info['title'] == 'Outernet'
+
+    def test_create_package_compression(self, tmpdir):
+        images = self.make_images(tmpdir.mkdir('src'))
+        out_dir = tmpdir.mkdir('out')
+        meta = create_package('<html></html>', images, self.meta,
+                              str(out_dir))
+        with zipfile.ZipFile(meta['zipfile']) as zipball:
+            types = dict((os.path.basename(i.filename), i.compress_type)
+                         for i in zipball.infolist())
+        assert types == {'image0000.png': zipfile.ZIP_STORED,
+                         'image0001.jpg': zipfile.ZIP_STORED,
+                         'index.html': zipfile.ZIP_DEFLATED,
+                         'info.json': zipfile.ZIP_DEFLATED}
+
+    @mock.patch('artexin.pack.verify_zipball')
+    def test_write_zipball_verify(self, verify_zipball, tmpdir):
+        path = str(tmpdir.join('test.zip'))
+        write_zipball(path, 'abc', '<html></html>', [], '{}')
+        assert verify_zipball.call_count == 0
+        write_zipball(path, 'abc', '<html></html>', [], '{}', verify=True)
+        assert verify_zipball.call_count == 1
+
+    def test_write_zipball_soup(self, tmpdir):
+        path = str(tmpdir.join('test.zip'))
+        soup = get_soup('<p>caf\xe9 <!-- x -->  <b>&amp;</b></p>\n<p>x</p>')
+        write_zipball(path, 'abc', soup, [], '{}')
+        with zipfile.ZipFile(path) as zipball:
+            assert zipball.read('abc/index.html') == str(soup).encode('utf-8')
+        write_zipball(path, 'abc', soup, [], '{}', minify=True)
+        with zipfile.ZipFile(path) as zipball:
+            assert zipball.read('abc/index.html') == (
+                '<html><body><p>caf\xe9 <b>&amp;</b></p><p>x</p></body>'
+                '</html>').encode('utf-8')
+
+    def test_write_zipball_minify_inline_space(self, tmpdir):
+        path = str(tmpdir.join('test.zip'))
+        soup = get_soup('<div>\n<p>Hello<span> </span>world</p>\n</div>')
+        write_zipball(path, 'abc', soup, [], '{}', minify=True)
+        with zipfile.ZipFile(path) as zipball:
+            assert zipball.read('abc/index.html') == (
+                b'<html><body><div><p>Hello<span> </span>world</p></div>'
+                b'</body></html>')
+
+    def test_create_package_keep_dir(self, tmpdir):
+        images = self.make_images(tmpdir.mkdir('src'))
+        out_dir = tmpdir.mkdir('out')
+        meta = create_package(get_soup('<p>foo</p>'), images, self.meta,
+                              str(out_dir), keep_dir=True, minify=True)
+        dest = out_dir.join(meta['hash'])
+        assert sorted(p.basename for p in dest.listdir()) == [
+            'image0000.png', 'image0001.jpg', 'index.html', 'info.json']
+        with zipfile.ZipFile(meta['zipfile']) as zipball:
+            for name in zipball.namelist():
+                assert zipball.read(name) == out_dir.join(name).read_binary()
+
+    @mock.patch('artexin.pack.sign_content')
+    def test_create_package_with_crypto_fail(self, sign_content, tmpdir):
+        sign_content.return_value = str(tmpdir.join('missing.sig'))
+        meta = create_package('<html></html>', [], self.meta, str(tmpdir),
+                              keyring='keyring', key='key',
+                              passphrase='passphrase')
+        assert meta['error'].startswith('Error signing')
+        assert tmpdir.listdir() == []
+
+
 class TestCollect(object):
 
     @classmethod
@@ -231,15 +338,17 @@ class TestCollect(object):
 
     @mock.patch('shutil.rmtree')
     @mock.patch('tempfile.mkdtemp')
-    @mock.patch('artexin.pack.create_zipball')
+    @mock.patch('artexin.pack.create_package')
     @mock.patch('artexin.pack.process_images')
     @mock.patch('artexin.pack.strip_links')
     @mock.patch('artexin.pack.extract')
+    @mock.patch('artexin.pack.get_soup')
     @mock.patch('artexin.pack.fetch_rendered')
-    def test_collect(self, fetch_rendered, extract, strip_links,
-                     process_images, create_zipball, tempfile_mkdtemp,
+    def test_collect(self, fetch_rendered, get_soup, extract, strip_links,
+                     process_images, create_package, tempfile_mkdtemp,
                      shutil_rmtree):
         page = 'html page'
+        soup = mock.Mock()
         page_title = 'page title'
         page_source = 'page source'
         processed_source = 'processed source'
@@ -249,14 +358,15 @@ class TestCollect(object):
         prep_func = mock.Mock()
         prep_func.side_effect = lambda x: x
         fetch_rendered.return_value = page
+        get_soup.return_value = soup
         extract.return_value = (page_title, page_source)
         strip_links.return_value = page_source
         process_images.return_value = (processed_source, images)
         tempfile_mkdtemp.return_value = temp_dir
 
-        def mocked_create_zipball(meta, **kwargs):
-            return meta
-        create_zipball.side_effect = mocked_create_zipball
+        def mocked_create_package(html, images, meta, **kwargs):
+            return copy.copy(meta)
+        create_package.side_effect = mocked_create_package
 
         m_open = mock.mock_open()
         with mock.patch('builtins.open', m_open):
@@ -270,7 +380,8 @@ class TestCollect(object):
         expected_meta.update({'url': self.url,
                               'domain': urllib.parse.urlparse(self.url).netloc,
                               'title': page_title,
-                              'images': len(images)})
+                              'images': len(images),
+                              'image_stats': {}})
 
         assert len(meta) == len(expected_meta) + 1
 
@@ -279,30 +390,34 @@ class TestCollect(object):
 
         assert isinstance(meta['timestamp'], datetime.datetime)
 
-        extract.assert_called_once_with(page)
-        prep_func.assert_called_once_with(page)
+        get_soup.assert_called_once_with(page)
+        extract.assert_called_once_with(soup)
+        prep_func.assert_called_once_with(soup)
         strip_links.assert_called_once_with(page_source)
         tempfile_mkdtemp.assert_called_once_with()
         shutil_rmtree.assert_called_once_with(temp_dir)
-        assert create_zipball.call_count == 1
+        assert create_package.call_count == 1
+        assert create_package.call_args[0][:2] == (processed_source, images)
+        # Statistics are only returned, not packaged
+        assert 'image_stats' not in create_package.call_args[0][2]
 
-        html_path = os.path.join(temp_dir, 'index.html')
-        m_open.assert_called_once_with(html_path, 'w', encoding='utf-8')
-
-        file_handle = m_open()
-        file_handle.write.assert_called_once_with(processed_source)
+        # The page is zipped from memory
+        assert m_open.call_count == 0
 
     @mock.patch('shutil.rmtree')
     @mock.patch('tempfile.mkdtemp')
-    @mock.patch('artexin.pack.create_zipball')
+    @mock.patch('artexin.pack.create_package')
     @mock.patch('artexin.pack.process_images')
     @mock.patch('artexin.pack.strip_links')
     @mock.patch('artexin.pack.extract')
+    @mock.patch('artexin.pack.get_soup')
     @mock.patch('artexin.pack.fetch_rendered')
-    def test_collect_override_title(self, fetch_rendered, extract, strip_links,
-                                    process_images, create_zipball,
-                                    tempfile_mkdtemp, shutil_rmtree):
+    def test_collect_override_title(self, fetch_rendered, get_soup, extract,
+                                    strip_links, process_images,
+                                    create_package, tempfile_mkdtemp,
+                                    shutil_rmtree):
         page = 'html page'
+        soup = mock.Mock()
         page_title = 'page title'
         page_source = 'page source'
         processed_source = 'processed source'
@@ -315,14 +430,15 @@ class TestCollect(object):
         prep_func = mock.Mock()
         prep_func.side_effect = lambda x: x
         fetch_rendered.return_value = page
+        get_soup.return_value = soup
         extract.return_value = (page_title, page_source)
         strip_links.return_value = page_source
         process_images.return_value = (processed_source, images)
         tempfile_mkdtemp.return_value = temp_dir
 
-        def mocked_create_zipball(meta, **kwargs):
-            return meta
-        create_zipball.side_effect = mocked_create_zipball
+        def mocked_create_package(html, images, meta, **kwargs):
+            return copy.copy(meta)
+        create_package.side_effect = mocked_create_package
 
         m_open = mock.mock_open()
         with mock.patch('builtins.open', m_open):
@@ -336,7 +452,8 @@ class TestCollect(object):
         expected_meta.update({'url': self.url,
                               'domain': urllib.parse.urlparse(self.url).netloc,
                               'title': overridden_title,
-                              'images': len(images)})
+                              'images': len(images),
+                              'image_stats': {}})
 
         assert len(meta) == len(expected_meta) + 1
 
@@ -345,15 +462,36 @@ class TestCollect(object):
 
         assert isinstance(meta['timestamp'], datetime.datetime)
 
-        extract.assert_called_once_with(page)
-        prep_func.assert_called_once_with(page)
+        get_soup.assert_called_once_with(page)
+        extract.assert_called_once_with(soup)
+        prep_func.assert_called_once_with(soup)
         strip_links.assert_called_once_with(page_source)
         tempfile_mkdtemp.assert_called_once_with()
         shutil_rmtree.assert_called_once_with(temp_dir)
-        assert create_zipball.call_count == 1
-
-        html_path = os.path.join(temp_dir, 'index.html')
-        m_open.assert_called_once_with(html_path, 'w', encoding='utf-8')
-
-        file_handle = m_open()
-        file_handle.write.assert_called_once_with(processed_source)
+        assert create_package.call_count == 1
+        assert create_package.call_args[0][:2] == (processed_source, images)
+        # Statistics are only returned, not packaged
+        assert 'image_stats' not in create_package.call_args[0][2]
+
+        # The page is zipped from memory
+        assert m_open.call_count == 0
+
+
+class TestPreparePage(object):
+
+    def test_string_preprocessors(self):
+        """ Should give HTML source to preprocessors that expect it """
+        def pp_strings(html):
+            assert isinstance(html, str)
+            soup = BeautifulSoup(html, 'lxml')
+            for tag in soup.find_all('h1'):
+                tag.name = 'h2'
+            return str(soup)
+
+        page = '<h1>Title</h1><h3>Heading</h3><p>Text</p>'
+        title, soup = prepare_page(page, [pp_noop, pp_strings, pp_fixheaders,
+                                          pp_strings], do_extract=False)
+        assert title == 'Title'
+        assert isinstance(soup, BeautifulSoup)
+        assert str(soup.body) == ('<body><h2>Title</h2><h2>Heading</h2>'
+                                  '<p>Text</p></body>')
@@ -0,0 +1,116 @@
+"""
+test_router.py: Unit tests for URL routing
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import json
+import re
+
+import pytest
+
+from .. import preprocessor_mappings as mappings
+from ..preprocessors import pp_noop, pp_dwelle, pp_fixheaders
+from ..router import Router
+
+
+def linear_match(rules, url):
+    return [value for pattern, value in rules
+            if re.match(pattern, url, re.IGNORECASE)]
+
+
+class TestRouter(object):
+
+    def test_same_as_linear_scan(self):
+        """ Should match the same rules in the same order as a linear scan """
+        rules = [(r'^https?://www\.site%d\.com/' % n, n) for n in range(300)]
+        rules.insert(100, (r'.*/print/', 'print'))
+        rules.append((r'^https?://..\.wikipedia\.org/', 'wiki'))
+        router = Router(rules)
+        assert len(router.unindexed) == 1
+        for url in ['http://www.site42.com/print/foo',
+                    'https://www.site299.com/',
+                    'http://www.site4.com.evil/',
+                    'http://de.wikipedia.org/wiki/Foo',
+                    'http://example.com/print/']:
+            assert router.match(url) == linear_match(rules, url)
+
+    def test_partial_label(self):
+        """ Should not index patterns whose host may continue past a label """
+        rules = [(r'^http://example\.co', 'co'),
+                 (r'^https?://..\.wikipedia\.org', 'wiki')]
+        router = Router(rules)
+        assert len(router.unindexed) == 2
+        for url in ['http://example.com/', 'http://example.co/',
+                    'http://en.wikipedia.org.evil/',
+                    'http://en.wikipedia.org/wiki/Foo']:
+            assert router.match(url) == linear_match(rules, url)
+        assert router.match('http://example.com/') == ['co']
+
+    def test_only_host_rules_tried(self):
+        """ Should not try patterns of rules for other hosts """
+        router = Router()
+        for n in range(100):
+            router.add(r'^http://site%d\.com/' % n, n)
+        assert router.candidates('http://site7.com/') == [7]
+        assert router.match('http://site7.com/') == [7]
+
+    def test_subdomains(self):
+        """ Should match host rules for subdomains at label boundaries """
+        router = Router()
+        router.add(None, 'example', host='example.com')
+        assert router.match('http://a.b.EXAMPLE.com:8080/') == ['example']
+        assert router.match('http://notexample.com/') == []
+        assert router.match('not a url') == []
+
+    def test_final(self):
+        """ Should keep final rules after rules added later """
+        router = Router()
+        router.add(r'.*', 'last', final=True)
+        router.add(None, 'site', host='example.com')
+        assert router.match('http://example.com/') == ['site', 'last']
+        assert router.first('http://example.com/') == 'site'
+        assert router.first('http://foo.com/') == 'last'
+
+
+class TestMappings(object):
+
+    def setup_method(self, method):
+        self.routers = mappings.PREPS_ROUTER, mappings.READY_ROUTER
+        mappings.PREPS_ROUTER, mappings.READY_ROUTER = \
+            mappings.build_routers()
+
+    def teardown_method(self, method):
+        mappings.PREPS_ROUTER, mappings.READY_ROUTER = self.routers
+
+    def test_default_mappings(self):
+        """ Should apply site preprocessors before the last set """
+        preps = mappings.get_preps('http://www.dw.de/foo')
+        assert preps == (pp_dwelle, pp_fixheaders)
+        assert mappings.get_ready('http://www.dw.de/foo') == 'div.longText'
+
+    def test_load_mappings(self, tmpdir):
+        """ Should add mappings from a JSON file in order """
+        path = tmpdir.join('mappings.json')
+        path.write(json.dumps([
+            {'host': 'example.com', 'preps': ['pp_noop'], 'ready': '#main'},
+            {'pattern': r'^https?://www\.example\.com/news/',
+             'preps': ['artexin.preprocessors.pp_dwelle']},
+        ]))
+        assert mappings.load_mappings(str(path)) == 2
+        url = 'https://www.example.com/news/1'
+        preps = mappings.get_preps(url)
+        assert preps == (pp_noop, pp_dwelle, pp_fixheaders)
+        assert mappings.get_ready(url) == '#main'
+        assert mappings.get_preps('http://foo.com/') == (pp_fixheaders,)
+
+    def test_unknown_preprocessor(self, tmpdir):
+        """ Should reject unknown preprocessor names """
+        path = tmpdir.join('mappings.json')
+        path.write(json.dumps([{'host': 'example.com', 'preps': ['pp_nx']}]))
+        with pytest.raises(ValueError):
+            mappings.load_mappings(str(path))
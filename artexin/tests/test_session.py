@@ -0,0 +1,60 @@
+"""
+test_session.py: Unit tests for ``artexin.session`` module
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from unittest import mock
+from urllib.error import URLError, HTTPError
+
+import pytest
+import urllib3
+
+from ..session import Session
+
+
+@mock.patch('artexin.session.urllib3.PoolManager')
+def test_fetch(PoolManager):
+    """ Should return response body """
+    manager = PoolManager.return_value
+    manager.request.return_value = mock.Mock(status=200, data=b'foo')
+    assert Session().fetch('http://example.com/', timeout=2) == b'foo'
+    manager.request.assert_called_once_with('GET', 'http://example.com/',
+                                            headers=None, timeout=2,
+                                            preload_content=True)
+
+
+@mock.patch('artexin.session.urllib3.PoolManager')
+def test_extra_headers(PoolManager):
+    """ Should merge extra headers with default ones """
+    manager = PoolManager.return_value
+    manager.request.return_value = mock.Mock(status=200)
+    Session().request('http://example.com/', headers={'X-Foo': 'bar'})
+    headers = manager.request.call_args[1]['headers']
+    assert headers['X-Foo'] == 'bar'
+    assert 'gzip' in headers['accept-encoding']
+
+
+@mock.patch('artexin.session.urllib3.PoolManager')
+def test_http_error(PoolManager):
+    """ Should raise ``HTTPError`` for error statuses """
+    manager = PoolManager.return_value
+    resp = mock.Mock(status=404, reason='Not Found', headers={})
+    manager.request.return_value = resp
+    with pytest.raises(HTTPError):
+        Session().fetch('http://example.com/')
+    resp.release_conn.assert_called_once_with()
+
+
+@mock.patch('artexin.session.urllib3.PoolManager')
+def test_connection_error(PoolManager):
+    """ Should raise ``URLError`` on connection failures """
+    manager = PoolManager.return_value
+    manager.request.side_effect = urllib3.exceptions.NewConnectionError(
+        None, 'Connection refused')
+    with pytest.raises(URLError):
+        Session().fetch('http://example.com/')
@@ -19,7 +19,7 @@ from . import __version__ as _version, __author__ as _author
 __version__ = _version
 __author__ = _author
 __all__ = ('mask', 'split', 'normalize', 'base_path', 'join', 'absolute_path',
-           'is_http_url', 'normalize_scheme', 'full_url')
+           'is_http_url', 'normalize_scheme', 'full_url', 'URLResolver')
 
 
 MULTISLASH = re.compile(r'\/+')
@@ -75,6 +75,8 @@ def split(url):
         ('http://localhost', '/foo?bar=baz')
         >>> split('http://localhost?foo=bar')
         ('http://localhost', '/?foo=bar')
+        >>> split('http://localhost')
+        ('http://localhost', '/')
 
     :param url:     URL to strip the root from
     :returns:       path with root stripped
@@ -82,7 +84,7 @@ def split(url):
     parsed = urlparse.urlparse(url)
     base = urlparse.urlunparse(mask(parsed, ROOT_MASK))
     stripped = urlparse.urlunparse(mask(parsed, TAIL_MASK))
-    if stripped[0] != '/':
+    if not stripped.startswith('/'):
         stripped = '/' + stripped
     return base, stripped
 
@@ -256,6 +258,67 @@ def normalize_scheme(url, scheme='http'):
         return scheme + ':' + url
     return url
 
+
+class URLResolver(object):
+    """ Resolve URLs found in a document to full URLs
+
+    The resolver does the same thing as calling ``split()`` on the document
+    URL, and ``absolute_path()``, ``full_url()`` and ``normalize_scheme()``
+    on each URL, but the document's base URL and path are only processed
+    once, and each distinct URL is resolved only once. This matters for
+    documents that reference the same images many times.
+
+    Example::
+
+        >>> resolver = URLResolver('https://www.example.com/foo/bar')
+        >>> resolver.resolve('baz.png')
+        'https://www.example.com/foo/baz.png'
+        >>> resolver.resolve('../baz.png?s=1')
+        'https://www.example.com/baz.png?s=1'
+        >>> resolver.resolve('//img.example.com/baz.png')
+        'https://img.example.com/baz.png'
+        >>> resolver.resolve_many(['/a.png', 'http://example.com/b.png'])
+        ['https://www.example.com/a.png', 'http://example.com/b.png']
+
+    :param url:     URL of the document
+    """
+
+    def __init__(self, url):
+        base, docpath = split(url)
+        self.scheme = base.split(':')[0]
+        self.root = urlparse.urlparse(base)[:2]  # scheme and network location
+        self.base = base_path(docpath)
+        self.cache = {}
+
+    def resolve(self, url):
+        """ Return full URL for ``url``
+
+        :param url:     Absolute or relative URL
+        :returns:       Full URL
+        """
+        try:
+            return self.cache[url]
+        except KeyError:
+            pass
+        if is_http_url(url):
+            resolved = normalize_scheme(url, self.scheme)
+        else:
+            path = normalize(join(self.base, url))
+            resolved = urlparse.urlunparse(self.root +
+                                           urlparse.urlparse(path)[2:])
+        self.cache[url] = resolved
+        return resolved
+
+    def resolve_many(self, urls):
+        """ Return list of full URLs for ``urls``
+
+        :param urls:    Iterable of absolute or relative URLs
+        :returns:       List of full URLs in the same order
+        """
+        resolve = self.resolve
+        return [resolve(url) for url in urls]
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,75 @@
+"""
+bench_counts.py: Compare memory and time of term counting representations
+
+This script counts the same synthetic corpus using ``artexin.index.get_counts``
+(plain dicts with string pair keys) and ``artexin.index.CompactCounts``
+(interned terms and packed integer pair keys), and reports time and memory
+used per million tokens.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from artexin.index import get_counts, CompactCounts
+
+
+__author__ = 'Outernet Inc <branko@outernet.is>'
+__version__ = 0.1
+
+
+TOKENS = 1000000
+VOCABULARY = 50000
+SENTENCE_LENGTH = 20
+
+
+def make_corpus(tokens, vocabulary, length, seed=0):
+    """ Return list of sentences with Zipf-like distribution of words """
+    rand = random.Random(seed)
+    words = ['word%d' % i for i in range(vocabulary)]
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary)]
+    sample = rand.choices(words, weights, k=tokens)
+    return [sample[i:i + length] for i in range(0, tokens, length)]
+
+
+def measure(fn, sentences):
+    """ Return result, time taken, and memory held by the result """
+    start = time.time()
+    fn(sentences)
+    took = time.time() - start
+    # Tracing slows down allocations, so memory is measured in a second run
+    tracemalloc.start()
+    result = fn(sentences)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, took, size
+
+
+def run_dicts(sentences):
+    return get_counts(sentences)
+
+
+def run_compact(sentences):
+    counts = CompactCounts()
+    counts.add_sentences(sentences)
+    return counts
+
+
+if __name__ == '__main__':
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else TOKENS
+    sentences = make_corpus(tokens, VOCABULARY, SENTENCE_LENGTH)
+    millions = tokens / 1000000.0
+    results = {}
+    for name, fn in (('dicts', run_dicts), ('compact', run_compact)):
+        result, took, size = measure(fn, sentences)
+        results[name] = result
+        print('%-8s %8.2f s/M tokens %10.1f MiB/M tokens' % (
+            name, took / millions, size / millions / 1024 / 1024))
+    assert results['compact'].to_dicts() == results['dicts']
@@ -0,0 +1,81 @@
+"""
+bench_transforms.py: Compare BeautifulSoup and lxml versions of transforms
+
+This script runs ``artexin.extract.strip_links`` and
+``artexin.preprocessors.pp_fixheaders`` on HTML source using the
+BeautifulSoup implementation (parse, transform, ``str()``) and the lxml fast
+path from ``artexin.lxmlutils``, checks that both give the same output, and
+reports time per page.
+
+Only the HTML source entry points are measured. Soup objects, as passed
+around by ``artexin.pack.collect()``, are always transformed in place by the
+BeautifulSoup implementation.
+
+Pass paths of HTML files to use them as input. By default, a synthetic
+article page is used.
+
+Copyright 2014, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import sys
+import time
+
+from artexin import lxmlutils
+from artexin.extract import strip_links
+from artexin.preprocessors import pp_fixheaders
+
+
+__author__ = 'Outernet Inc <branko@outernet.is>'
+__version__ = 0.1
+
+
+ROUNDS = 20
+SECTIONS = 100
+
+SECTION = """<h3 id="s%(n)d">Section %(n)d</h3>
+<p>Paragraph with a <a href="/wiki/Link_%(n)d">link</a>, a
+<a href="#s%(n)d">fragment link</a>, and some <b>bold</b> &amp; <i>italic</i>
+text.<br>Second line.</p>
+<div class="thumb"><a class="image" href="/wiki/File:%(n)d.jpg">
+<img src="/img/%(n)d.jpg" alt="Image %(n)d"></a></div>
+<ul><li><a href="http://example.com/%(n)d">External</a></li></ul>
+"""
+
+
+def make_page(sections):
+    """ Return synthetic article page with given number of sections """
+    body = ''.join(SECTION % {'n': n} for n in range(sections))
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+            '<title>Page</title></head><body><h2>Title</h2>%s'
+            '</body></html>' % body)
+
+
+def measure(fn, pages, rounds):
+    """ Return outputs and average time per page """
+    start = time.time()
+    for _ in range(rounds):
+        outputs = [fn(page) for page in pages]
+    return outputs, (time.time() - start) / rounds / len(pages)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        pages = []
+        for path in sys.argv[1:]:
+            with open(path, 'r', encoding='utf-8') as f:
+                pages.append(f.read())
+    else:
+        pages = [make_page(SECTIONS)]
+    for fn in (strip_links, pp_fixheaders):
+        lxmlutils.ENABLED = False
+        slow, slow_time = measure(fn, pages, ROUNDS)
+        lxmlutils.ENABLED = True
+        fast, fast_time = measure(fn, pages, ROUNDS)
+        assert slow == fast, 'Output differs for %s' % fn.__name__
+        print('%-14s bs4 %8.2f ms/page   lxml %8.2f ms/page   %5.1fx' % (
+            fn.__name__, slow_time * 1000, fast_time * 1000,
+            slow_time / fast_time))
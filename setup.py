@@ -16,7 +16,8 @@ install_requires = [
     'Pillow',
     'python-gnupg',
     'selenium',
-    'simplejson'
+    'simplejson',
+    'urllib3'
 ]
 
 
@@ -48,10 +49,11 @@ setup(name='artexin',
       zip_safe=False,
       classifiers=[
           "Programming Language :: Python",
-          "Programming Language :: Python :: 3.3",
-          "Programming Language :: Python :: 3.4",
+          "Programming Language :: Python :: 3.7",
+          "Programming Language :: Python :: 3.8",
           "Development Status :: 3 - Alpha"
       ],
       install_requires=install_requires,
+      extras_require={'async': ['aiohttp']},
       tests_require=['pytest'],
       cmdclass={'test': PyTest})